@@ -0,0 +1,110 @@
+import sys
+import asyncio
+import argparse
+import importlib
+import json
+from l1_cache import L1Cache
+from ids import logical_name
+from protocols import shard_names
+from coherence_protocol import ApplyQueue
+from workload import add_arguments as add_workload_arguments, spec_from_args as workload_spec_from_args
+
+# Persistent per-host driver: imports the app and connects to Redis once, then
+# runs every (layer, read probability) cell network.py writes to its stdin as
+# one JSON object per line, e.g.
+#   {"cell": 3, "read_probability": 0.8, "layers_traversed": 1, "sim_time": 60}
+# plus "home_shards" (names) once the shards in use change and "workload"
+# (workload.Workload arguments) for cells with their own access pattern, and
+# answers each with a DONE_MARKER line on stdout. {"cmd": "exit"} or EOF stops it.
+# Start and end of a cell are synchronised by the manager's coordinator.
+DONE_MARKER = "CELL_DONE "
+
+
+async def read_command():
+    line = await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+    if not line:
+        return {"cmd": "exit"}
+    return json.loads(line)
+
+
+def make_nodes(args):
+    module = importlib.import_module(args.app)
+    apps = []
+    for index in range(args.nodes):
+        app = module.CacheApp(logical_name(args.host_name, index))
+        app.local_db = index  # logical nodes of one host share its Redis, not its data
+        app.workers = args.workers
+        app.read_batch = args.read_batch
+        if args.output_dir:
+            app.output_dir = args.output_dir
+        app.target_rate = args.rate
+        app.home_shards = shard_names(args.home_shards)[1:]
+        app.workload_spec = workload_spec_from_args(args)
+        app.record_trace = args.record_trace
+        app.replay_root = args.replay
+        app.replay_speed = args.replay_speed
+        if hasattr(app, "coherence"):
+            app.coherence = args.coherence
+            app.tracking = args.tracking
+            app.batcher.window = args.batch_window
+            app.applier = ApplyQueue(app.apply_lines, app.applier.clock, args.apply_queue)
+            app.write_policy = args.write_policy
+            app.selector.policy = args.protocol
+            app.state_machine = args.state_machine
+            app.aggregation = args.aggregation
+            if args.l1_bytes > 0:
+                app.l1 = L1Cache(args.l1_bytes)
+        apps.append(app)
+    return apps
+
+
+async def serve(args):
+    apps = make_nodes(args)
+    await asyncio.gather(*(app.connect_to_redis(40) for app in apps))
+    listeners = [asyncio.ensure_future(app.listen_for_updates()) for app in apps]
+
+    while True:
+        command = await read_command()
+        if command.get("cmd") == "exit":
+            break
+        for app in apps:
+            if "home_shards" in command:
+                await app.reshard(command["home_shards"])
+            if "workload" in command:
+                app.workload_spec = command["workload"]
+            app.reset(command["read_probability"], command["layers_traversed"], command["sim_time"], command["cell"])
+        await asyncio.gather(*(app.run_cell() for app in apps))
+        result = {"cell": command["cell"], "host": args.host_name, "nodes": len(apps),
+                  "ops": sum(app.ops_completed for app in apps)}
+        print(DONE_MARKER + json.dumps(result), flush=True)
+
+    for listener in listeners:
+        listener.cancel()
+    for app in apps:
+        await app.home.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="persistent cache node driver for one host")
+    parser.add_argument("host_name")
+    parser.add_argument("--app", default="cache_app", help="cache_app (MESI) or cache_app2 (baseline)")
+    parser.add_argument("--nodes", type=int, default=1, help="logical cache nodes hosted in this process")
+    parser.add_argument("--output-dir", default=None, help="latency and stats directory, the app's default if unset")
+    parser.add_argument("--l1-bytes", type=int, default=0, help="in-process L1 budget in bytes (0 disables the L1)")
+    parser.add_argument("--coherence", choices=["broadcast", "directory", "tracking"], default="broadcast")
+    parser.add_argument("--tracking", choices=["default", "bcast"], default="default", help="client tracking mode of tracking coherence")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent closed-loop clients per node")
+    parser.add_argument("--read-batch", type=int, default=1, help="consecutive reads issued together as one get_many")
+    parser.add_argument("--rate", type=float, default=None, help="open-loop Poisson arrival rate per node [ops/s]")
+    parser.add_argument("--batch-window", type=float, default=0.0)
+    parser.add_argument("--apply-queue", type=int, default=1024, help="coherence messages waiting to be applied per node")
+    parser.add_argument("--write-policy", choices=["write-back", "write-through"], default="write-back")
+    parser.add_argument("--protocol", choices=["adaptive", "invalidate", "update"], default="adaptive")
+    parser.add_argument("--state-machine", choices=["MESI", "MOESI", "MESIF"], default="MESI")
+    parser.add_argument("--aggregation", type=int, default=None, help="layers per aggregator cache")
+    parser.add_argument("--home-shards", type=int, nargs="*", default=[], metavar="LAYER", help="switch layers of extra home shards")
+    parser.add_argument("--record-trace", action="store_true", help="write every op to trace.bin in the cell directory")
+    parser.add_argument("--replay", default=None, metavar="DIR", help="output directory of a recorded run to replay")
+    parser.add_argument("--replay-speed", choices=["original", "max"], default="original")
+    add_workload_arguments(parser)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,90 @@
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from latency_histogram import LatencyHistogram
+from latency_store import open_cell, OP_READ, OP_WRITE
+
+# Per-cell summaries of a run's output directory for plotting. A cell is
+# parsed (in a process pool) only when its files changed since the last time:
+# the summaries are kept in SUMMARY_FILE keyed by the size and mtime of every
+# file they were built from. The sweep layout comes from MANIFEST_FILE, which
+# network.run writes as the cells finish.
+MANIFEST_FILE = "manifest.json"
+SUMMARY_FILE = "summaries.json"
+SOURCE_PATTERNS = ("ops.bin", "stats_*.json")
+
+
+def write_json(path, data):
+    # write-then-rename, readers never see half a file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_json(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def load_manifest(output_dir):
+    manifest = load_json(os.path.join(output_dir, MANIFEST_FILE))
+    if manifest is None:
+        raise FileNotFoundError(f"{output_dir} has no {MANIFEST_FILE}, it was not written by network.run")
+    return manifest
+
+
+def cell_path(output_dir, cell):
+    return os.path.join(output_dir, str(cell["layers_traversed"]), str(cell["read_probability"]))
+
+
+def signature(cell_dir, write_offset):
+    # (name, size, mtime) of every source file, plus what the summary depends on
+    files = []
+    for pattern in SOURCE_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(cell_dir, pattern))):
+            info = os.stat(path)
+            files.append([os.path.basename(path), info.st_size, info.st_mtime_ns])
+    return {"files": files, "write_offset": write_offset}
+
+
+def summarize_cell(cell_dir, write_offset=0.0):
+    # read and write histograms (writes shifted by write_offset seconds) and summed node throughput
+    records = open_cell(cell_dir)
+    reads = LatencyHistogram().record_array(records["latency_ns"][records["op"] == OP_READ] / 1e9)
+    writes = LatencyHistogram().record_array(records["latency_ns"][records["op"] == OP_WRITE] / 1e9 + write_offset)
+    throughput = 0.0
+    for path in glob.glob(os.path.join(cell_dir, "stats_*.json")):
+        throughput += load_json(path, {}).get("throughput", 0.0)
+    return {"read": reads.to_dict(), "write": writes.to_dict(), "throughput": throughput}
+
+
+def aggregate(output_dir, write_offset=0.0, workers=None):
+    # [(manifest cell, {"read": LatencyHistogram, "write": LatencyHistogram, "throughput": ops/s})]
+    manifest = load_manifest(output_dir)
+    cache_path = os.path.join(output_dir, SUMMARY_FILE)
+    cache = load_json(cache_path, {})
+    signatures = {}
+    stale = []
+    for cell in manifest["cells"]:
+        cell_dir = cell_path(output_dir, cell)
+        signatures[cell_dir] = signature(cell_dir, write_offset)
+        entry = cache.get(cell_dir)
+        if entry is None or entry["signature"] != signatures[cell_dir]:
+            stale.append(cell_dir)
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for cell_dir, summary in zip(stale, pool.map(summarize_cell, stale, [write_offset] * len(stale))):
+                cache[cell_dir] = {"signature": signatures[cell_dir], "summary": summary}
+        write_json(cache_path, cache)
+    results = []
+    for cell in manifest["cells"]:
+        summary = cache[cell_path(output_dir, cell)]["summary"]
+        results.append((cell, {"read": LatencyHistogram.from_dict(summary["read"]),
+                               "write": LatencyHistogram.from_dict(summary["write"]),
+                               "throughput": summary["throughput"]}))
+    return results
@@ -0,0 +1,110 @@
+import asyncio
+import argparse
+import aioredis
+from aioredis import RedisError
+from coherence_protocol import decode_batch, node_channel, UPDATE, INVALIDATE, UPDATE_INVALIDATE
+from latency_store import node_id
+from ids import key_name
+from manager_app import Manager, REDIS_PORT, CHANNEL
+from protocols import node_address, shard_names
+
+REDIS_HOME_HOST = "10.0.0.254"
+
+
+# Aggregator cache of a group of switch layers (DynamicTopology(aggregation=k)).
+# Nodes below read through its Redis (TieredHomeStore), this process keeps that
+# copy coherent: broadcast writes drop or refresh it, and in directory mode it
+# is the home's sharer for its readers and relays targeted invalidations to
+# the readers in its own sharer sets. With a sharded home it listens to the
+# coherence traffic of every shard.
+class Aggregator(Manager):
+    def __init__(self, host_name):
+        super().__init__()
+        self.host_name = host_name
+        self.node = node_id(host_name)
+        self.coherence = "broadcast"
+        self.home_shards = []  # extra home shards (protocols.shard_names)
+        self.pub_subs = []  # one per shard, home first
+        self.cache = None
+        self.dropped = 0
+        self.refreshed = 0
+
+    async def connect_to_redis(self, max_retries):
+        tries = 0
+        delay = 0.5
+        while tries < max_retries:
+            try:
+                self.cache = await aioredis.Redis(host="127.0.0.1", port=REDIS_PORT)
+                self.directory = self.cache
+                self.pool = aioredis.BlockingConnectionPool(host=REDIS_HOME_HOST, port=REDIS_PORT, max_connections=50)
+                self.home = await aioredis.Redis(connection_pool=self.pool)
+                shards = [self.home]
+                for name in self.home_shards:
+                    address, db = node_address(name)
+                    shards.append(aioredis.Redis(host=address, port=REDIS_PORT, db=db))
+                self.pub_subs = [shard.pubsub() for shard in shards]
+                for pub_sub in self.pub_subs:
+                    await pub_sub.subscribe(*self.channels())
+                self.pub_sub = self.pub_subs[0]
+                break
+            except RedisError as e:
+                print(f"Connection error: {e}. Retrying in {delay} seconds...")
+                tries += 1
+            await asyncio.sleep(delay)
+        if (tries == max_retries):
+            raise ConnectionError("Failed to connect to Redis after retries")
+
+    def channels(self):
+        if self.coherence == "directory":
+            return [node_channel(self.host_name)]
+        return [CHANNEL]
+
+    async def stop_event_loop(self):
+        print(f"{self.host_name}: {self.dropped} copies dropped, {self.refreshed} refreshed")
+        await super().stop_event_loop()
+
+    async def apply(self, payload):
+        # our own copies: invalidations drop them, updates replace them
+        async with self.cache.pipeline(transaction=False) as pipe:
+            for command, origin, kid, value in decode_batch(payload):
+                if command in (INVALIDATE, UPDATE_INVALIDATE):
+                    pipe.delete(key_name(kid))
+                    self.dropped += 1
+                elif command == UPDATE:
+                    pipe.set(key_name(kid), value)
+                    self.refreshed += 1
+            await pipe.execute()
+
+    async def listen_for_updates(self):
+        await asyncio.gather(*(self.listen(index) for index in range(len(self.pub_subs))))
+
+    async def listen(self, index):
+        while True:
+            try:
+                async for message in self.pub_subs[index].listen():
+                    if message['type'] != 'message':
+                        continue
+                    await self.apply(message['data'])
+                    if self.coherence == "directory":
+                        await self.handle_directory(message['data'])
+            except aioredis.exceptions.ConnectionError as e:
+                print(f"Connection error: {e}")
+                await asyncio.sleep(5)
+                await self.connect_to_redis(40)
+
+
+async def run_event_loop(aggregator):
+    await aggregator.connect_to_redis(40)
+    await aggregator.listen_for_updates()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="aggregator cache for a group of switch layers")
+    parser.add_argument("host_name")
+    parser.add_argument("--coherence", choices=["broadcast", "directory"], default="broadcast")
+    parser.add_argument("--home-shards", type=int, nargs="*", default=[], metavar="LAYER", help="switch layers of extra home shards")
+    args = parser.parse_args()
+    aggregator = Aggregator(args.host_name)
+    aggregator.coherence = args.coherence
+    aggregator.home_shards = shard_names(args.home_shards)[1:]
+    asyncio.run(run_event_loop(aggregator))
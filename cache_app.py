@@ -1,13 +1,29 @@
 import sys
 import asyncio
 import random
-import string
 import aioredis
 from aioredis import RedisError
 import time
 import signal
 import os
-import sys
+import argparse
+import json
+from l1_cache import L1Cache
+from single_flight import SingleFlight
+from home_store import HomeStore, ShardedHomeStore, TieredHomeStore
+from hash_ring import HashRing
+from client_tracking import TrackingConnection, InvalidationListener
+from connection_manager import ConnectionManager, TRANSIENT
+from latency_store import node_id, node_name, OP_READ, OP_WRITE
+from ids import key_id, key_name, KEY_PREFIX
+from coherence_protocol import (PublishBatcher, ApplyQueue, encode_message, encode_batch, decode_batch, node_channel,
+                                DIRECTORY_CHANNEL, UPDATE, INVALIDATE, UPDATE_INVALIDATE, TERMINATE, START, FETCHED)
+from workload import add_arguments as add_workload_arguments, spec_from_args as workload_spec_from_args
+from cache_state import StateTable, INVALID, EXCLUSIVE, MODIFIED
+from protocols import (PROTOCOLS, FILL_HOME, FILL_PEER, FILL_EXCLUSIVE, WRITE, EVICT, PEER_FETCH, PEER_WRITE, PEER_UPDATE, hops,
+                       node_address, aggregator_for, shard_names)
+from protocol_selector import ProtocolSelector
+from load_driver import LoadDriver
 
 sys.setrecursionlimit(5000)
 
@@ -21,240 +37,663 @@ startup_nodes = [
 ]
 
 # Cache application with MESI protocol states and invalidation
-class CacheApp:
+class CacheApp(LoadDriver):
     def __init__(self, host_name):
-        self.host_name = host_name
+        super().__init__(host_name, "./latencies")
         self.loop = asyncio.get_event_loop()  # Get event loop
         self.cache = None
         self.home = None
+        self.home_host = REDIS_HOME_HOST  # e.g. 127.0.0.1 to run a node against a local redis-server
         self.pub_sub = None
-        self.read_probability = 0.8 # Default read probability (80%)
-        self.layers_traversed = 1
-        self.cache_state = "I"  # Initial state: Invalid
-        self.write_latencies = []
-        self.read_latencies = []  
-        self.is_last_node = False
-        self.sim_time = 10
+        self.states = StateTable()  # per-key coherence state, everything starts Invalid
+        self.state_machine = "MESI"  # or "MOESI"/"MESIF": misses are served by nearby forwarders
+        self.forwarder_hints = {}  # key id -> node id last known to hold the line in a forwarding state
+        self.peers = {}  # node id -> client of that node's local Redis
+        self.peer_fills = 0
+        self.peer_fill_failures = 0
+        self.aggregation = None  # layers per aggregator cache to read home through, None for the flat chain
+        self.home_shards = []  # extra home shards (protocols.shard_names), keys spread over them and home
+        self.shards = {}  # shard name -> client, home included
+        self.ring = None  # HashRing over the shards, None with home alone
+        self.pub_subs = {}  # shard name -> subscription to its coherence channels
+        self.listeners = {}  # shard name -> listener task, home's runs in listen_for_updates
+        self.shard_batchers = {}  # publish batchers of the shards besides home
+        self.l1 = None  # optional in-process L1Cache in front of the local Redis
+        self.home_flights = SingleFlight()  # one in-flight home fetch per key
+        self.local_flights = SingleFlight()  # one in-flight local Redis read per key
+        self.coherence = "broadcast"  # or "directory": targeted invalidations via manager_app, "tracking": by home itself
+        self.tracking = "default"  # tracking coherence: "default" (keys this node read) or "bcast" (every data_ key)
+        self.tracker = None  # InvalidationListener of tracking coherence
+        self.epochs = {}  # key id -> peer writes applied during its fill in flight
+        self.tracked_invalidations = 0
+        self.write_policy = "write-back"  # or "write-through": a write completes once home has it
+        self.dirty = {}  # write-back: key -> latest value not yet at home, rewrites coalesce here
+        self.written = set()  # keys written here since their line was last dropped
+        self.write_back_delay = 0.05  # seconds a dirty line waits for its timer flush
+        self.write_back_task = None
+        self.writes_coalesced = 0
+        self.selector = ProtocolSelector()  # per-key write-invalidate or write-update
+        # coherence messages sent while a publish is in flight share the next one
+        self.batcher = PublishBatcher(lambda payload: self.home.publish(self.publish_channel(), payload))
+        # peers' writes are applied in drained, deduplicated batches off the listeners
+        self.applier = ApplyQueue(self.apply_lines, lambda: self.clock())
+        self.local_db = 0  # database on the local Redis, one per logical node sharing a host
+        # pools and subscriptions, shared by the data path and the listeners
+        self.connections = ConnectionManager(self.open_connections, self.close_connections, self.check_connections)
+        self.local_pool = None
 
     async def stop_event_loop(self):
-        app.write_read_latency(app.read_latencies)
-        app.write_write_latency(app.write_latencies)
-        await self.pub_sub.unsubscribe()
+        await self.flush_dirty()
+        self.finish_cell()
+        for pub_sub in self.pub_subs.values():
+            await pub_sub.unsubscribe()
         # await self.home.client_kill(f"{REDIS_HOME_HOST}:{REDIS_PORT}")
         await self.home.close()
         #print(f"Kill signal for {app.host_name}. Sending latencies...")
         os._exit(1)
+
+    def reset(self, read_probability, layers_traversed, sim_time, cell):
+        # next cell on an already connected node; everything starts Invalid again
+        super().reset(read_probability, layers_traversed, sim_time, cell)
+        self.states = StateTable()
+        self.forwarder_hints = {}
+        self.peer_fills = self.peer_fill_failures = 0
+        if self.l1 is not None:
+            self.l1 = L1Cache(self.l1.max_bytes)
+        self.home_flights = SingleFlight()
+        self.local_flights = SingleFlight()
+        for batcher in self.batchers():
+            batcher.batches = batcher.messages = 0
+        self.applier.reset_stats()
+        self.dirty = {}
+        self.written = set()
+        self.writes_coalesced = 0
+        self.selector = ProtocolSelector(self.selector.policy)
+        self.epochs = {}
+        self.tracked_invalidations = 0
+        self.connections.reset_stats()
+        self.home_store = self.make_home_store()
     
-    async def connect_to_redis(self, max_retries):
-        tries = 0
-        delay = 0.5
-        while tries < max_retries:
-            try:
-                self.cache = await aioredis.Redis(host="127.0.0.1", port=REDIS_PORT)
-                self.pool = aioredis.BlockingConnectionPool(host=REDIS_HOME_HOST, port=REDIS_PORT, health_check_interval=30, max_connections=500)
-                self.home = await aioredis.Redis(connection_pool=self.pool)
-                # self.home = await aioredis.Redis(host=REDIS_HOME_HOST, port=REDIS_PORT, health_check_interval=30)
-                self.pub_sub = self.home.pubsub()
-                await self.pub_sub.subscribe(CHANNEL)
-                #print(f"{self.host_name}: Connected to Redis successfully")
-                break
-            except RedisError as e:
-                print(f"Connection error: {e}. Retrying in {delay} seconds...")
-                tries += 1
-            await asyncio.sleep(delay)
-        if (tries == max_retries):
-            raise ConnectionError("Failed to connect to Redis after retries")
-
-    def gen_random_data(self):
-        data = ''
-        for _ in range(10):
-            data += random.choice(string.ascii_letters + string.digits)
-        return data
+    async def open_connections(self):
+        self.local_pool = aioredis.ConnectionPool(host="127.0.0.1", port=REDIS_PORT, db=self.local_db, max_connections=50)
+        self.cache = await aioredis.Redis(connection_pool=self.local_pool)
+        if self.coherence == "tracking":
+            # a new listener loses what the old one was told, nothing local is trusted
+            self.forget_lines()
+            self.tracker = InvalidationListener(self.home_host, REDIS_PORT, self.tracking_prefixes())
+            redirect = await self.tracker.connect()
+        if self.coherence == "tracking" and self.tracking == "default":
+            self.pool = aioredis.BlockingConnectionPool(connection_class=TrackingConnection, redirect=redirect,
+                                                        host=self.home_host, port=REDIS_PORT,
+                                                        health_check_interval=30, max_connections=500)
+        else:
+            self.pool = aioredis.BlockingConnectionPool(host=self.home_host, port=REDIS_PORT, health_check_interval=30, max_connections=500)
+        self.home = await aioredis.Redis(connection_pool=self.pool)
+        self.shards = {}
+        self.connect_shards()
+        self.home_store = self.make_home_store()
+        await self.subscribe(self.shards)
+
+    async def close_connections(self):
+        # everything open_connections() made, before it makes them again
+        for pub_sub in self.pub_subs.values():
+            await pub_sub.reset()
+        self.pub_subs = {}
+        if self.tracker is not None:
+            await self.tracker.close()
+        for client in self.shards.values():
+            await client.connection_pool.disconnect()
+        if self.local_pool is not None:
+            await self.local_pool.disconnect()
+
+    async def check_connections(self):
+        await self.cache.ping()
+        for client in self.shards.values():
+            await client.ping()
+
+    def connect_shard(self, shard_name):
+        address, db = node_address(shard_name)
+        pool = aioredis.BlockingConnectionPool(host=address, port=REDIS_PORT, db=db, health_check_interval=30, max_connections=500)
+        return aioredis.Redis(connection_pool=pool)
+
+    def connect_shards(self):
+        # clients, ring and publish batchers for home plus home_shards, existing clients are kept
+        names = ["home"] + self.home_shards
+        self.shards = {name: self.home if name == "home" else self.shards.get(name) or self.connect_shard(name)
+                       for name in names}
+        self.ring = HashRing(names) if len(names) > 1 else None
+        self.shard_batchers = {name: self.shard_batchers.get(name) or PublishBatcher(
+            lambda payload, client=self.shards[name]: client.publish(self.publish_channel(), payload), self.batcher.window)
+            for name in self.home_shards}
+
+    async def subscribe(self, names):
+        for name in names:
+            if name in self.pub_subs:
+                await self.pub_subs[name].reset()  # never two subscriptions to one shard
+            self.pub_subs[name] = self.shards[name].pubsub()
+            await self.pub_subs[name].subscribe(*self.channels())
+        self.pub_sub = self.pub_subs["home"]
+
+    async def reshard(self, home_shards):
+        # shards joining or leaving (e.g. their switch layer was removed): only
+        # the keys of those shards change owner, the rest of the ring stays put
+        if home_shards == self.home_shards:
+            return
+        for name in set(self.home_shards) - set(home_shards):
+            listener = self.listeners.pop(name, None)
+            if listener is not None:
+                listener.cancel()
+            self.pub_subs.pop(name, None)  # no unsubscribe, the shard may be unreachable
+        added = [name for name in home_shards if name not in self.shards]
+        self.home_shards = list(home_shards)
+        self.connect_shards()
+        self.home_store = self.make_home_store()
+        await self.subscribe(added)
+        for name in added:
+            self.listeners[name] = asyncio.ensure_future(self.listen(name))
 
-    def write_latency_to_file(self, latency_type, values):
-        filename = f"{latency_type}_{self.host_name}.txt"
-        filepath = os.path.join(f"./latencies/{str(self.layers_traversed)}/{str(self.read_probability)}/", filename)
+    def batchers(self):
+        return [self.batcher] + list(self.shard_batchers.values())
+
+    def batcher_for(self, key):
+        # a key's coherence messages go through the shard that owns it
+        if self.ring is None:
+            return self.batcher
+        return self.shard_batchers.get(self.ring.node_for(key), self.batcher)
+
+    def tracking_prefixes(self):
+        return [KEY_PREFIX] if self.tracking == "bcast" else None
+
+    def make_home_store(self):
+        if self.coherence == "tracking" and (self.ring is not None or self.aggregation):
+            raise ValueError("tracking coherence needs every read to go to home: no home shards or aggregators")
+        store = HomeStore(self.home, self.gen_random_data)
+        if self.ring is not None:
+            store = ShardedHomeStore({name: HomeStore(client, self.gen_random_data) for name, client in self.shards.items()},
+                                     self.ring, self.clock)
+        if self.aggregation:
+            aggregator = aggregator_for(self.host_name, self.aggregation)
+            store = TieredHomeStore(store, self.connect_peer(aggregator), node_id(aggregator))
+        return store
+
+    def channels(self):
+        # TERMINATE always arrives on the shared channel
+        if self.coherence == "directory":
+            return [CHANNEL, node_channel(self.host_name)]
+        return [CHANNEL]
+
+    def publish_channel(self):
+        return DIRECTORY_CHANNEL if self.coherence == "directory" else CHANNEL
+
+    def collect_stats(self):
+        hits, misses = self.states.totals()
+        stats = {"hits": hits, "misses": misses, "hit_ratio": self.states.hit_ratio(),
+                 "home_fetches": self.home_flights.stats(), "local_reads": self.local_flights.stats(),
+                 "home_round_trips": self.home_store.round_trips, "write_policy": self.write_policy,
+                 "home_keys_written": self.home_store.keys_written,
+                 "home_write_round_trips": self.home_store.write_round_trips,
+                 "writes_coalesced": self.writes_coalesced, "protocol": self.selector.stats(),
+                 "state_machine": self.state_machine, "peer_fills": self.peer_fills,
+                 "peer_fill_failures": self.peer_fill_failures,
+                 "tracked_invalidations": self.tracked_invalidations, "connections": self.connections.stats(),
+                 "applied_coherence": self.applier.stats(),
+                 "coherence_batches": sum(batcher.batches for batcher in self.batchers()),
+                 "coherence_messages": sum(batcher.messages for batcher in self.batchers()),
+                 "ops_completed": self.ops_completed, "throughput": self.throughput(),
+                 "workers": self.workers, "target_rate": self.target_rate}
+        if self.l1 is not None:
+            stats["l1"] = self.l1.stats()
+        if self.ring is not None:
+            stats["shards"] = self.home_store.shard_stats()
+        if self.aggregation:
+            stats["aggregator"] = {"round_trips": self.home_store.tier_round_trips,
+                                   "hits": self.home_store.tier_hits, "misses": self.home_store.tier_misses}
+        return stats
+
+    def write_stats(self):
+        # one "key hits misses" line per accessed key plus a stats_<host>.json summary
+        filepath = os.path.join(self.latency_dir(), f"keys_{self.host_name}.txt")
+        stats = self.collect_stats()
         try:
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, "a") as f:
-                for val in values:
-                    f.write(f"{val}\n")
+            self.states.write_stats(filepath)
+            with open(os.path.join(self.latency_dir(), f"stats_{self.host_name}.json"), "w") as f:
+                json.dump(stats, f)
         except (IOError, OSError) as e:
             print(f"Error writing to file: {e}")
 
-    def write_read_latency(self, latency):
-        self.write_latency_to_file("read", latency)
+    async def read_local(self, key):
+        # L1 first, then the per-host Redis over the long-lived pool
+        if self.l1 is not None:
+            data = self.l1.get(key)
+            if data:
+                return data
+        data = await self.local_flights.do(key, lambda: self.cache.get(key))
+        if data and self.l1 is not None:
+            self.l1.put(key, data)
+        return data
 
-    def write_write_latency(self, latency):
-        self.write_latency_to_file("write", latency)
+    async def read_local_many(self, keys):
+        # read_local for several lines, those not in L1 in one MGET
+        values = [self.l1.get(key) if self.l1 is not None else None for key in keys]
+        remote = [i for i, data in enumerate(values) if not data]
+        if remote:
+            for i, data in zip(remote, await self.cache.mget([keys[i] for i in remote])):
+                values[i] = data
+                if data and self.l1 is not None:
+                    self.l1.put(keys[i], data)
+        return values
+
+    async def write_local(self, key, data):
+        await self.cache.set(key, data)
+        if self.l1 is not None:
+            self.l1.put(key, data)
+
+    def invalidate_local(self, key):
+        key = key if isinstance(key, str) else key_name(key)
+        self.transition(key, PEER_WRITE)
+        self.written.discard(key)
+        if self.l1 is not None:
+            self.l1.invalidate(key)
 
     async def get_data(self, key):
-        start_time = time.time()  # Start time for read latency
-        async with aioredis.Redis(host="localhost", port=REDIS_PORT) as local_cache:
-            try:
-                # Check cache state
-                if self.cache_state in ("S", "M"):  # Shared or Modified
-                    data = await local_cache.get(key)
-                    if data:
-                        # Read hit - update latency
-                        self.read_latencies.append(time.time() - start_time)
-                    else:
-                        # Cache miss -> read-through
-                        self.cache_state = "I"  # Invalidate for consistency
-                        data = await self.get_from_home_manager(key)
-                        if data:
-                            await local_cache.set(key, data)
-                            self.cache_state = "S"  # Update state to Shared
-                        self.read_latencies.append(time.time() - start_time)
-                else:  # Invalid or Exclusive
-                    data = await self.get_from_home_manager(key)
-                    if data:
-                        await local_cache.set(key, data)
-                        self.cache_state = "S"  # Update state to Shared
-                        self.read_latencies.append(time.time() - start_time)
-            except:
-                await asyncio.sleep(5)
-                await self.connect_to_redis(40)
+        start_time = self.clock()  # Start time for read latency
+        self.selector.read(key_id(key))
+        # retried in flight after a lost connection, the latency includes the recovery
+        await self.connections.call(lambda: self._get_data(key, start_time))
 
-    async def get_from_home_manager(self, key):
+    async def _get_data(self, key, start_time):
+        # Check the state of this key only
+        if self.states.is_valid(key):  # any state but Invalid
+            data = await self.read_local(key)
+            if data:
+                # Read hit - update latency
+                self.states.hit(key)
+                self.record_latency(OP_READ, key, start_time)
+            else:
+                # Cache miss -> read-through, a dirty evicted line goes home first
+                self.states.miss(key)
+                await self.flush_dirty([key])
+                self.transition(key, EVICT)  # Invalidate for consistency
+                data = await self.fill(key)
+                self.record_latency(OP_READ, key, start_time)
+        else:  # Invalid
+            self.states.miss(key)
+            data = await self.fill(key)
+            if data:
+                self.record_latency(OP_READ, key, start_time)
+
+    async def get_many(self, keys):
+        # batched read, each key as get_data handles it: the valid lines come
+        # from one local MGET and the misses share one batched fill
+        start_time = self.clock()
+        for key in keys:
+            self.selector.read(key_id(key))
+        return await self.connections.call(lambda: self._get_many(keys, start_time))
+
+    async def _get_many(self, keys, start_time):
+        valid = [key for key in keys if self.states.is_valid(key)]
+        local = dict(zip(valid, await self.read_local_many(valid)))
+        missing = []
+        for key in keys:
+            if local.get(key):
+                self.states.hit(key)
+            else:
+                self.states.miss(key)
+                missing.append(key)
+        # valid but gone from the local Redis: a dirty evicted line goes home first
+        evicted = [key for key in missing if key in local]
+        if evicted:
+            await self.flush_dirty(evicted)
+            for key in evicted:
+                self.transition(key, EVICT)
+        fetched = dict(zip(missing, await self.fill_many(missing)))
+        values = []
+        for key in keys:
+            data = local.get(key) or fetched.get(key)
+            if data:
+                self.record_latency(OP_READ, key, start_time)
+            values.append(data)
+        return values
+
+    def machine(self):
+        return PROTOCOLS[self.state_machine]
+
+    def transition(self, key, event):
+        state = self.machine().next(self.states.get(key), event)
+        self.states.set(key, state)
+        return state
+
+    async def fill(self, key):
+        # concurrent misses on one key share a single fetch and local fill
+        return await self.home_flights.do(key, lambda: self._fill(key))
+
+    async def _fill(self, key):
+        # a peer's write applied while the fill is in flight (epoch bumped)
+        # leaves the line as that write left it: the data is served, not cached
+        kid = key_id(key)
+        event = FILL_PEER
+        sharers = 0
+        self.epochs[kid] = 0
         try:
-            # Fetch all keys from the Redis cache
-            keys = await self.home.keys('*')
+            data = await self.fetch_from_peer(key)
+            if not data:
+                data, sharers = await self.get_from_home_manager(key)
+                event = self.home_fill(sharers)
+            if data and not self.epochs[kid]:
+                await self.write_local(key, data)
+                if not self.epochs[kid]:
+                    self.filled(key, event, sharers)
+                elif self.l1 is not None:
+                    self.l1.invalidate(key)
+            return data
+        finally:
+            del self.epochs[kid]
 
-            # Fetch values for each key
-            values = []
-            for key in keys:
-                value = await self.home.get(key)
-                values.append(value.decode('utf-8'))
+    async def fill_many(self, keys):
+        # fill() for several keys, each still single-flight with every other fill
+        return await self.home_flights.do_many(keys, self._fill_many)
 
-            # print(f"all home keys: {keys}")
-            # print(f"all home values: {values}")
-            # #
+    async def _fill_many(self, keys):
+        # _fill for a batch: a line with a nearer forwarder is filled from it,
+        # the others share one home request
+        peered = [key for key in keys if self.nearer_forwarder(key_id(key)) is not None]
+        values = dict(zip(peered, await asyncio.gather(*(self._fill(key) for key in peered))))
+        batched = [key for key in keys if key not in values]
+        kids = [key_id(key) for key in batched]
+        for kid in kids:
+            self.epochs[kid] = 0
+        try:
+            sharer = self.node if self.coherence == "directory" else None
+            fetched, sharers = await self.home_store.get_many(batched, sharer, counts=True)
+            values.update(zip(batched, fetched))
+            current = [i for i, kid in enumerate(kids) if fetched[i] and not self.epochs[kid]]
+            if current:
+                await self.cache.mset({batched[i]: fetched[i] for i in current})
+            for i in current:
+                if not self.epochs[kids[i]]:
+                    if self.l1 is not None:
+                        self.l1.put(batched[i], fetched[i])
+                    self.filled(batched[i], self.home_fill(sharers[i]), sharers[i])
+        finally:
+            for kid in kids:
+                del self.epochs[kid]
+        return [values[key] for key in keys]
 
-            data = await self.home.get(key)
-            if data:
-                # print(f"{self.host_name}: Retrieved data from home manager for {key.decode('utf-8')}")
-                return data
-            else:
-                # Data not found on home manager
-                # print(f"{self.host_name}: Data not in home manager for {key}, setting data")
-                new_value = self.gen_random_data()
-                await self.home.set(key, new_value)
-                self.cache_state = "S"
-                return new_value
-        except:
-            # print(f"{self.host_name}: Error retrieving data from home manager ({key}): {e}")
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
-
-    async def set_data(self, key):
-        start_time = time.time()  # Start time for write latency
+    def home_fill(self, sharers):
+        # directory coherence: alone in the line's sharer set we hold it Exclusive
+        return FILL_EXCLUSIVE if sharers == 1 else FILL_HOME
+
+    def filled(self, key, event, sharers=0):
+        # a fill from a peer, or one that makes us the forwarder, is announced
+        # so the old forwarder downgrades and the others learn where the line is;
+        # so is the second sharer's, the first may still hold the line Exclusive,
+        # and one of a key peers write under the adaptive protocol, whose writers
+        # count the sharers (home's count instead where directory coherence has it)
+        kid = key_id(key)
+        state = self.transition(key, event)
+        self.selector.filled(kid, sharers)
+        if (event == FILL_PEER or state in self.machine().forwarders or sharers == 2
+                or (sharers == 0 and self.selector.announce_fill(kid))):
+            self.batcher_for(key).post(encode_message(FETCHED, self.node, key))
+
+    async def fetch_from_peer(self, key):
+        # cache-to-cache fill from the hinted forwarder, if it is closer than home
+        kid = key_id(key)
+        peer = self.nearer_forwarder(kid)
+        if peer is None:
+            return None
         try:
-            if self.cache_state == "I":  # Invalid
-                data = await self.get_from_home_manager(key)
-                if data:
-                    await self.cache.set(key, data)
-                    self.cache_state = "S"
-                    self.write_latencies.append(time.time() - start_time)
-            elif self.cache_state == "S":  # Shared - Update locally and invalidate others
-                new_value = self.gen_random_data()
-                await self.cache.set(key, new_value)
-                self.cache_state = "M"
-                await self.publish_update(key, new_value)
-                await self.publish_invalidate(key)
-                #print(f"{self.host_name}: Updated data for {key} (invalidated others)")
-                self.write_latencies.append(time.time() - start_time)
-            elif self.cache_state == "M":  # Modified - update locally
-                new_value = self.gen_random_data()
-                await self.cache.set(key, new_value)
-                await self.publish_update(key, new_value)  # Notify others
-                self.write_latencies.append(time.time() - start_time)
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+            data = await self.peer_cache(peer).get(key)
+        except RedisError:
+            data = None
+        if not data:
+            self.peer_fill_failures += 1
+            self.forwarder_hints.pop(kid, None)  # stale hint, the line moved on
+            return None
+        self.peer_fills += 1
+        return data
 
-    async def publish_update(self, key, value):
-        message = f"UPDATE|{key}|{value}"
+    def nearer_forwarder(self, kid):
+        # the hinted forwarder of kid if it is closer than home
+        peer = self.forwarder_hints.get(kid)
+        if peer is None or peer == self.node or hops(self.host_name, node_name(peer)) >= hops(self.host_name, "home"):
+            return None
+        return peer
+
+    def peer_cache(self, peer):
+        client = self.peers.get(peer)
+        if client is None:
+            client = self.peers[peer] = self.connect_peer(node_name(peer))
+        return client
+
+    def connect_peer(self, peer_name):
+        address, db = node_address(peer_name)
+        pool = aioredis.ConnectionPool(host=address, port=REDIS_PORT, db=db, max_connections=10)
+        return aioredis.Redis(connection_pool=pool)
+
+    async def get_from_home_manager(self, key):
+        # (value, sharers of the line counting us, 0 if unknown); errors reach
+        # the operation, which is retried as a whole
+        sharer = self.node if self.coherence == "directory" else None
+        return await self.home_store.get(key, sharer, counts=True)
+
+    async def set_data(self, key, value=None):
+        start_time = self.clock()  # Start time for write latency
+        self.selector.write(key_id(key))
+        await self.connections.call(lambda: self._set_data(key, start_time, value))
+
+    async def _set_data(self, key, start_time, value=None):
+        if not self.states.is_valid(key):  # Invalid: write-allocate, fill the line and write it
+            self.states.miss(key)
+            # a fill a peer's write raced is not cached, and under tracking its
+            # read is no longer tracked by home: fill again, or no later write
+            # would invalidate the line we are about to make Modified
+            while not self.states.is_valid(key):
+                if not await self.fill(key):
+                    return
+        else:
+            self.states.hit(key)
+        # Update locally, then home and the others
+        new_value = value or self.gen_random_data()
+        await self.write_local(key, new_value)
+        self.transition(key, WRITE)
+        self.written.add(key)
+        await self.write_home(key, new_value)
+        self.record_latency(OP_WRITE, key, start_time)
+
+    async def write_home(self, key, value):
+        # peers hear of a write only once home holds it, or an invalidated
+        # reader could fill the old value again: write-through announces it
+        # right away, write-back when flush_dirty has stored it
+        if self.write_policy == "write-through":
+            await self.home_store.set_many({key: value})
+            await self.publish_write(key, value)
+            return
+        if key in self.dirty:
+            self.writes_coalesced += 1
+        self.dirty[key] = value
+        self.schedule_write_back()
+
+    def schedule_write_back(self):
+        if self.dirty and self.write_back_task is None:
+            self.write_back_task = asyncio.ensure_future(self._write_back_later())
+
+    async def _write_back_later(self):
+        await asyncio.sleep(self.write_back_delay)
+        self.write_back_task = None
         try:
-            await self.home.publish(CHANNEL, message)
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+            await self.flush_dirty()
+        except RedisError as e:
+            print(f"{self.host_name}: write-back failed: {e}")
+            self.schedule_write_back()
 
-    async def publish_invalidate(self, key):
-        message = f"INVALIDATE|{key}"
+    async def flush_dirty(self, keys=None):
+        # all dirty lines (timer, end of cell) or just keys (eviction,
+        # invalidation), pipelined into one MSET and then announced
+        if keys is None:
+            batch, self.dirty = self.dirty, {}
+            if self.write_back_task is not None:
+                self.write_back_task.cancel()  # nothing left for the timer
+                self.write_back_task = None
+        else:
+            batch = {key: self.dirty.pop(key) for key in keys if key in self.dirty}
+        if not batch:
+            return
         try:
-            await self.home.publish(CHANNEL, message)
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
-    
+            await self.home_store.set_many(batch)
+        except Exception:
+            for key, value in batch.items():
+                self.dirty.setdefault(key, value)  # a newer write wins
+            raise
+        await asyncio.gather(*(self.publish_write(key, value) for key, value in batch.items()))
+
+    async def publish_write(self, key, value):
+        # others either install the new value or drop their copy, chosen per key;
+        # with tracking coherence home tells the readers once the write reaches it
+        if self.coherence == "tracking":
+            return
+        if self.selector.mode(key_id(key)) == UPDATE:
+            await self.publish_update(key, value)
+        else:
+            await self.publish_invalidate(key)
+
+    async def publish_update(self, key, value):
+        # only the publish is retried, the write itself is done
+        message = encode_message(UPDATE, self.node, key, value)
+        await self.connections.call(lambda: self.batcher_for(key).send(message))
+
+    async def publish_invalidate(self, key):
+        message = encode_message(INVALIDATE, self.node, key)
+        await self.connections.call(lambda: self.batcher_for(key).send(message))
+
     async def publish_terminate(self):
-        message = "TERMINATE"
-        try:
-            subscribers = await self.home.publish(CHANNEL, message)
-            print(f"subscribers: {subscribers}")
-            return subscribers
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+        message = encode_batch([encode_message(TERMINATE, self.node)])
+        subscribers = await self.connections.call(lambda: self.home.publish(CHANNEL, message), default=0)
+        return subscribers
+
+    async def install_update(self, key, value):
+        # write-update: the peer's value replaces ours and the line stays readable,
+        # unless ours is dirty: flushed after theirs reached home, ours is newer there
+        if key in self.dirty:
+            await self.flush_dirty([key])
+            return
+        # ours already went home too, which of the two landed last is unknown: drop the line
+        if key in self.written:
+            self.invalidate_local(key)
+            await self.connections.call(lambda: self.cache.delete(key))
+            return
+        await self.write_local(key, value)
+        self.transition(key, PEER_UPDATE)
+
+    async def apply_lines(self, lines):
+        # a drained batch, key id -> new value or None to invalidate: our dirty
+        # copies of the invalidated lines go home in one MSET, the lines go in one DEL;
+        # lines we do not hold only change state
+        for kid in lines:
+            if kid in self.epochs:
+                self.epochs[kid] += 1
+        invalidated = [kid for kid, value in lines.items() if value is None]
+        keys = [key_name(kid) for kid in invalidated if self.states.is_valid(kid) or key_name(kid) in self.dirty]
+        if keys:
+            await self.flush_dirty(keys)
+        for kid in invalidated:
+            self.invalidate_local(kid)
+        if keys:
+            await self.connections.call(lambda: self.cache.delete(*keys))
+        for kid, value in lines.items():
+            if value is not None:
+                await self.install_update(key_name(kid), value)
+
+    def forget_lines(self):
+        # tracking state lost (new listener, home flushed): every line is Invalid
+        self.states = StateTable()
+        if self.l1 is not None:
+            self.l1 = L1Cache(self.l1.max_bytes)
+
+    async def apply_tracked(self, keys):
+        if keys is None:
+            self.forget_lines()
+            return
+        for key in keys:
+            kid = key_id(key)
+            if kid in self.epochs:
+                self.epochs[kid] += 1
+            self.tracked_invalidations += 1
+            if self.states.is_valid(kid):
+                await self.applier.put(kid)
+
+    async def listen_for_invalidations(self):
+        # tracking coherence: home pushes the keys that changed, our own writes included
+        while True:
+            generation = self.connections.generation
+            try:
+                async for keys in self.tracker.invalidations():
+                    await self.apply_tracked(keys)
+            except TRANSIENT as e:
+                # the tracking pools redirect to the lost listener: reopen everything
+                print(f"Tracking connection error: {e}")
+                await self.connections.recover(generation, force=True)
+
+    def peer_wrote(self, kid, origin):
+        # the writer now holds the line Modified, a forwarding state in MOESI and MESIF
+        if MODIFIED in self.machine().forwarders:
+            self.forwarder_hints[kid] = origin
+
+    def peer_fetched(self, kid, origin):
+        self.selector.fetched(kid, origin)
+        protocol = self.machine()
+        state = self.states.get(kid)
+        if state in protocol.forwarders or state == EXCLUSIVE:
+            self.transition(kid, PEER_FETCH)
+        if protocol.fetch_moves_forwarder:
+            self.forwarder_hints[kid] = origin
 
     async def listen_for_updates(self):
+        # home here, every other shard in its own task (reshard() starts and cancels those)
+        for name in self.home_shards:
+            self.listeners[name] = asyncio.ensure_future(self.listen(name))
+        try:
+            if self.tracker is not None:
+                await asyncio.gather(self.listen("home"), self.listen_for_invalidations())
+            else:
+                await self.listen("home")
+        finally:
+            for listener in self.listeners.values():
+                listener.cancel()
+            self.listeners = {}
+            self.applier.stop()
+
+    async def listen(self, shard):
         while True:
-            try:    
-                async for message in self.pub_sub.listen():
+            generation = self.connections.generation
+            try:
+                async for message in self.pub_subs[shard].listen():
                     if message['type'] == 'message':
-                        data = message['data'].decode().split('|')
-                        command = data[0]
-                        if command == "UPDATE":
-                            # Store update
-                            self.received_update = {"key": data[1], "value": data[2]}
-                            # print(f"{self.host_name}: Stored update for {data[1]}")
-                        elif command == "INVALIDATE":
-                            # Invalidate local cache for the key
-                            self.cache_state = "I"
-                            await self.cache.delete(data[1])
-                            # print(f"{self.host_name}: Received invalidate for {data[1]}")
-                        if command == "TERMINATE":
-                            # print(f"{self.host_name}: Received terminate process")
-                            await self.stop_event_loop()
-            except aioredis.exceptions.ConnectionError as e:
+                        for command, origin, kid, value in decode_batch(message['data']):
+                            if origin == self.node and command != TERMINATE:
+                                continue  # our own write, already applied locally
+                            if command in (UPDATE, INVALIDATE, UPDATE_INVALIDATE):
+                                self.peer_wrote(kid, origin)
+                            if command == UPDATE:
+                                if self.selector.accept_update(kid, origin):
+                                    await self.applier.put(kid, value)
+                                else:
+                                    await self.applier.put(kid)
+                            elif command in (INVALIDATE, UPDATE_INVALIDATE):
+                                self.selector.remote_write(kid, origin)
+                                await self.applier.put(kid)
+                            elif command == TERMINATE:
+                                await self.stop_event_loop()
+                            elif command == START:
+                                self.start_cell(kid, float(value))
+                            elif command == FETCHED:
+                                self.peer_fetched(kid, origin)
+            except TRANSIENT as e:
                 print(f"Connection error: {e}")
-                await asyncio.sleep(5)
-                await self.connect_to_redis(40)
-
-    async def run_simulation(self):
-        if self.is_last_node == False:
-            while True:
-                # random key to access
-                key = f"data_{random.randint(1, 10)}"
-                
-                await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep)
-
-                if random.random() < 1 - self.read_probability: # write
-                    await self.set_data(key)
-                    # print(f"{self.host_name}: Updated data for key {key}")    
-                else: # read
-                    await self.get_data(key)
-                    # print(f"{self.host_name}: Retrieved data for key {key}")
-        else:
-            start_time = time.time()
-            while time.time() < self.sim_time + start_time:
-                # random key to access
-                key = f"data_{random.randint(1, 10)}"
-                
-                await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep)
-
-                if random.random() < 1 - self.read_probability: # write
-                    await self.set_data(key)
-                    print(f"{self.host_name}: Updated data for key {key}")    
-                else: # read
-                    await self.get_data(key)
-                    print(f"{self.host_name}: Retrieved data for key {key}")        
-            while (await self.publish_terminate() > 5):
-                await asyncio.sleep(1)
-            await self.stop_event_loop()
-        
+                if not await self.connections.recover(generation):
+                    await self.subscribe([shard])  # the pools are fine, only this subscription was lost
+
 async def run_event_loop(app):
     loop = asyncio.get_event_loop()
     await app.connect_to_redis(40)
@@ -265,12 +704,63 @@ async def run_event_loop(app):
     await asyncio.gather(simulation_task, update_task)
 
 if __name__ == "__main__":
-    if len(sys.argv) == 6:
-        app = CacheApp(sys.argv[1])
-        app.read_probability = float(sys.argv[2])
-        app.layers_traversed = int(sys.argv[3])
-        app.is_last_node = eval(sys.argv[4])
-        app.sim_time = int(sys.argv[5])
-        asyncio.run(run_event_loop(app)) # run in main thread
-    else:
-        print("Usage: python cache_app.py <read_probability>")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MESI cache node")
+    parser.add_argument("host_name")
+    parser.add_argument("read_probability", type=float)
+    parser.add_argument("layers_traversed", type=int)
+    parser.add_argument("is_last_node", type=lambda arg: arg == "True")
+    parser.add_argument("sim_time", type=int)
+    parser.add_argument("--l1-bytes", type=int, default=0, help="in-process L1 budget in bytes (0 disables the L1)")
+    parser.add_argument("--coherence", choices=["broadcast", "directory", "tracking"], default="broadcast",
+                        help="broadcast invalidations to every node, let manager_app target the sharers, or use Redis client tracking")
+    parser.add_argument("--tracking", choices=["default", "bcast"], default="default",
+                        help="tracking coherence: invalidate the keys this node read, or every data_ key that changes")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent closed-loop clients in this node")
+    parser.add_argument("--read-batch", type=int, default=1, help="consecutive reads issued together as one get_many")
+    parser.add_argument("--rate", type=float, default=None, help="open-loop Poisson arrival rate [ops/s] instead of closed loops")
+    parser.add_argument("--write-policy", choices=["write-back", "write-through"], default="write-back",
+                        help="coalesce writes and flush them to home in batches, or write every one to home")
+    parser.add_argument("--protocol", choices=["adaptive", "invalidate", "update"], default="adaptive",
+                        help="per-key choice between write-invalidate and write-update, or always one of them")
+    parser.add_argument("--state-machine", choices=sorted(PROTOCOLS), default="MESI",
+                        help="MOESI/MESIF serve misses from the nearest Owned/Forward holder instead of home")
+    parser.add_argument("--aggregation", type=int, default=None,
+                        help="read home through the aggregator cache shared by this many layers")
+    parser.add_argument("--home-shards", type=int, nargs="*", default=[], metavar="LAYER",
+                        help="switch layers of extra home shards, keys are spread over home and these by consistent hashing")
+    parser.add_argument("--batch-window", type=float, default=0.0, help="seconds to hold each coherence publish open for more messages")
+    parser.add_argument("--apply-queue", type=int, default=1024,
+                        help="peers' coherence messages waiting to be applied before the listener blocks")
+    parser.add_argument("--record-trace", action="store_true", help="write every op to trace.bin in the cell directory")
+    parser.add_argument("--replay", default=None, metavar="DIR", help="drive the load from the trace of this recorded run")
+    parser.add_argument("--replay-speed", choices=["original", "max"], default="original",
+                        help="replay at the recorded offsets, or as fast as possible")
+    parser.add_argument("--home-host", default=REDIS_HOME_HOST, help="address of home's redis-server")
+    add_workload_arguments(parser)
+    args = parser.parse_args()
+
+    app = CacheApp(args.host_name)
+    app.read_probability = args.read_probability
+    app.layers_traversed = args.layers_traversed
+    app.is_last_node = args.is_last_node
+    app.sim_time = args.sim_time
+    if args.l1_bytes > 0:
+        app.l1 = L1Cache(args.l1_bytes)
+    app.batcher.window = args.batch_window
+    app.applier = ApplyQueue(app.apply_lines, lambda: app.clock(), args.apply_queue)
+    app.coherence = args.coherence
+    app.tracking = args.tracking
+    app.home_host = args.home_host
+    app.write_policy = args.write_policy
+    app.selector.policy = args.protocol
+    app.state_machine = args.state_machine
+    app.aggregation = args.aggregation
+    app.home_shards = shard_names(args.home_shards)[1:]
+    app.workers = args.workers
+    app.read_batch = args.read_batch
+    app.target_rate = args.rate
+    app.workload_spec = workload_spec_from_args(args)
+    app.record_trace = args.record_trace
+    app.replay_root = args.replay
+    app.replay_speed = args.replay_speed
+    asyncio.run(run_event_loop(app)) # run in main thread
@@ -1,13 +1,19 @@
 import sys
 import asyncio
 import random
-import string
 import aioredis
 from aioredis import RedisError
 import time
 import signal
 import os
-import sys
+import json
+from home_store import HomeStore, ShardedHomeStore
+from hash_ring import HashRing
+from protocols import node_address
+from latency_store import OP_READ, OP_WRITE
+from coherence_protocol import encode_message, encode_batch, decode_batch, TERMINATE, START
+from connection_manager import ConnectionManager, TRANSIENT
+from load_driver import LoadDriver
 
 sys.setrecursionlimit(5000)
 
@@ -21,180 +27,150 @@ startup_nodes = [
 ]
 
 # Cache application with MESI protocol states and invalidation
-class CacheApp:
+class CacheApp(LoadDriver):
     def __init__(self, host_name):
-        self.host_name = host_name
+        super().__init__(host_name, "./latencies2")
         self.loop = asyncio.get_event_loop()  # Get event loop
         self.cache = None
         self.home = None
         self.pub_sub = None
-        self.read_probability = 0.8 # Default read probability (80%)
-        self.layers_traversed = 1
         self.cache_state = "I"  # Initial state: Invalid
-        self.write_latencies = []
-        self.read_latencies = []  
-        self.is_last_node = False
-        self.sim_time = 10
+        self.local_db = 0  # database on the local Redis, one per logical node sharing a host
+        # pools and subscription, shared by the data path and the listener
+        self.connections = ConnectionManager(self.open_connections, self.close_connections, self.check_connections)
+        self.home_shards = []  # extra home shards (protocols.shard_names), keys spread over them and home
+        self.shards = {}  # shard name -> client, home included
+        self.ring = None  # HashRing over the shards, None with home alone
 
     async def stop_event_loop(self):
-        app.write_read_latency(app.read_latencies)
-        app.write_write_latency(app.write_latencies)
+        self.finish_cell()
         await self.pub_sub.unsubscribe()
         # await self.home.client_kill(f"{REDIS_HOME_HOST}:{REDIS_PORT}")
         await self.home.close()
         #print(f"Kill signal for {app.host_name}. Sending latencies...")
         os._exit(1)
+
+    def reset(self, read_probability, layers_traversed, sim_time, cell):
+        # next cell on an already connected node; everything starts Invalid again
+        super().reset(read_probability, layers_traversed, sim_time, cell)
+        self.cache_state = "I"
+        self.home_store = self.make_home_store()
+        self.connections.reset_stats()
     
-    async def connect_to_redis(self, max_retries):
-        tries = 0
-        delay = 0.5
-        while tries < max_retries:
-            try:
-                self.cache = await aioredis.Redis(host="127.0.0.1", port=REDIS_PORT)
-                self.pool = aioredis.BlockingConnectionPool(host=REDIS_HOME_HOST, port=REDIS_PORT, health_check_interval=30, max_connections=500)
-                self.home = await aioredis.Redis(connection_pool=self.pool)
-                self.pub_sub = self.home.pubsub()
-                await self.pub_sub.subscribe(CHANNEL)
-                #print(f"{self.host_name}: Connected to Redis successfully")
-                break
-            except RedisError as e:
-                print(f"Connection error: {e}. Retrying in {delay} seconds...")
-                tries += 1
-            await asyncio.sleep(delay)
-        if (tries == max_retries):
-            raise ConnectionError("Failed to connect to Redis after retries")
-
-    def gen_random_data(self):
-        data = ''
-        for _ in range(10):
-            data += random.choice(string.ascii_letters + string.digits)
-        return data
-
-    def write_latency_to_file(self, latency_type, values):
-        filename = f"{latency_type}_{self.host_name}.txt"
-        filepath = os.path.join(f"./latencies2/{str(self.layers_traversed)}/{str(self.read_probability)}/", filename)
+    async def open_connections(self):
+        self.cache = await aioredis.Redis(host="127.0.0.1", port=REDIS_PORT, db=self.local_db)
+        self.pool = aioredis.BlockingConnectionPool(host=REDIS_HOME_HOST, port=REDIS_PORT, health_check_interval=30, max_connections=500)
+        self.home = await aioredis.Redis(connection_pool=self.pool)
+        self.shards = {}
+        self.connect_shards()
+        self.home_store = self.make_home_store()
+        await self.subscribe()
+
+    async def close_connections(self):
+        if self.pub_sub is not None:
+            await self.pub_sub.reset()
+            self.pub_sub = None
+        await self.cache.close()
+        for client in self.shards.values():
+            await client.connection_pool.disconnect()
+
+    async def check_connections(self):
+        for client in self.shards.values():
+            await client.ping()
+
+    async def subscribe(self):
+        if self.pub_sub is not None:
+            await self.pub_sub.reset()  # never two subscriptions
+        self.pub_sub = self.home.pubsub()
+        await self.pub_sub.subscribe(CHANNEL)
+
+    def connect_shard(self, shard_name):
+        address, db = node_address(shard_name)
+        pool = aioredis.BlockingConnectionPool(host=address, port=REDIS_PORT, db=db, health_check_interval=30, max_connections=500)
+        return aioredis.Redis(connection_pool=pool)
+
+    def connect_shards(self):
+        # clients and ring for home plus home_shards, existing clients are kept
+        names = ["home"] + self.home_shards
+        self.shards = {name: self.home if name == "home" else self.shards.get(name) or self.connect_shard(name)
+                       for name in names}
+        self.ring = HashRing(names) if len(names) > 1 else None
+
+    async def reshard(self, home_shards):
+        # only the keys of shards joining or leaving change owner
+        self.home_shards = list(home_shards)
+        self.connect_shards()
+        self.home_store = self.make_home_store()
+
+    def make_home_store(self):
+        if self.ring is None:
+            return HomeStore(self.home, self.gen_random_data)
+        return ShardedHomeStore({name: HomeStore(client, self.gen_random_data) for name, client in self.shards.items()},
+                                self.ring, self.clock)
+
+    def collect_stats(self):
+        stats = {"home_round_trips": self.home_store.round_trips, "ops_completed": self.ops_completed,
+                 "connections": self.connections.stats(),
+                 "throughput": self.throughput(), "workers": self.workers, "target_rate": self.target_rate}
+        if self.ring is not None:
+            stats["shards"] = self.home_store.shard_stats()
+        return stats
+
+    def write_stats(self):
         try:
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            with open(filepath, "a") as f:
-                for val in values:
-                    f.write(f"{val}\n")
+            os.makedirs(self.latency_dir(), exist_ok=True)
+            with open(os.path.join(self.latency_dir(), f"stats_{self.host_name}.json"), "w") as f:
+                json.dump(self.collect_stats(), f)
         except (IOError, OSError) as e:
             print(f"Error writing to file: {e}")
 
-    def write_read_latency(self, latency):
-        self.write_latency_to_file("read", latency)
-
-    def write_write_latency(self, latency):
-        self.write_latency_to_file("write", latency)
-
     async def get_data(self, key):
-        start_time = time.time()  # Start time for read latency
-        try:
-            data = await self.get_from_home_manager(key)
-            if data:
-                self.read_latencies.append(time.time() - start_time)
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+        start_time = self.clock()  # Start time for read latency
+        # retried in flight after a lost connection, the latency includes the recovery
+        data = await self.connections.call(lambda: self.get_from_home_manager(key))
+        if data:
+            self.record_latency(OP_READ, key, start_time)
+
+    async def get_many(self, keys):
+        # batched read of several keys, one home round trip for all of them
+        start_time = self.clock()
+        values = await self.connections.call(lambda: self.home_store.get_many(keys))
+        if values is not None:
+            for key in keys:  # every key of the batch completes together
+                self.record_latency(OP_READ, key, start_time)
+        return values
 
     async def get_from_home_manager(self, key):
-        try:
-            # Fetch all keys from the Redis cache
-            keys = await self.home.keys('*')
-
-            # Fetch values for each key
-            values = []
-            for key in keys:
-                value = await self.home.get(key)
-                values.append(value.decode('utf-8'))
-
-            # print(f"all home keys: {keys}")
-            # print(f"all home values: {values}")
-            # #
-
-            data = await self.home.get(key)
-            if data:
-                # print(f"{self.host_name}: Retrieved data from home manager for {key.decode('utf-8')}")
-                return data
-            else:
-                # Data not found on home manager
-                # print(f"{self.host_name}: Data not in home manager for {key}, setting data")
-                new_value = self.gen_random_data()
-                await self.home.set(key, new_value)
-                self.cache_state = "S"
-                return new_value
-        except:
-            # print(f"{self.host_name}: Error retrieving data from home manager ({key}): {e}")
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
-
-    async def set_data(self, key):
-        start_time = time.time()  # Start time for write latency
-        try:
-            data = await self.get_from_home_manager(key)
-            if data:
-                self.write_latencies.append(time.time() - start_time)
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+        return await self.home_store.get(key)
+
+    async def set_data(self, key, value=None):
+        start_time = self.clock()  # Start time for write latency
+        data = await self.connections.call(lambda: self.get_from_home_manager(key))
+        if data:
+            self.record_latency(OP_WRITE, key, start_time)
     
     async def publish_terminate(self):
-        message = "TERMINATE"
-        try:
-            subscribers = await self.home.publish(CHANNEL, message)
-            print(f"subscribers: {subscribers}")
-            return subscribers
-        except:
-            await asyncio.sleep(5)
-            await self.connect_to_redis(40)
+        message = encode_batch([encode_message(TERMINATE, self.node)])
+        subscribers = await self.connections.call(lambda: self.home.publish(CHANNEL, message), default=0)
+        return subscribers
 
     async def listen_for_updates(self):
         while True:
+            generation = self.connections.generation
             try:    
                 async for message in self.pub_sub.listen():
                     if message['type'] == 'message':
-                        data = message['data'].decode().split('|')
-                        command = data[0]
-                        if command == "TERMINATE":
-                            # print(f"{self.host_name}: Received terminate process")
-                            await self.stop_event_loop()
-            except aioredis.exceptions.ConnectionError as e:
+                        for command, origin, kid, value in decode_batch(message['data']):
+                            if command == TERMINATE:
+                                # print(f"{self.host_name}: Received terminate process")
+                                await self.stop_event_loop()
+                            elif command == START:
+                                self.start_cell(kid, float(value))
+            except TRANSIENT as e:
                 print(f"Connection error: {e}")
-                await asyncio.sleep(5)
-                await self.connect_to_redis(40)
-
-    async def run_simulation(self):
-        if self.is_last_node == False:
-            while True:
-                # random key to access
-                key = f"data_{random.randint(1, 10)}"
-                
-                await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep)
-
-                if random.random() < 1 - self.read_probability: # write
-                    await self.set_data(key)
-                    # print(f"{self.host_name}: Updated data for key {key}")    
-                else: # read
-                    await self.get_data(key)
-                    # print(f"{self.host_name}: Retrieved data for key {key}")
-        else:
-            start_time = time.time()
-            while time.time() < self.sim_time + start_time:
-                # random key to access
-                key = f"data_{random.randint(1, 10)}"
-                
-                await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep)
-
-                if random.random() < 1 - self.read_probability: # write
-                    await self.set_data(key)
-                    print(f"{self.host_name}: Updated data for key {key}")    
-                else: # read
-                    await self.get_data(key)
-                    print(f"{self.host_name}: Retrieved data for key {key}")        
-            while (await self.publish_terminate() > 5):
-                await asyncio.sleep(1)
-            await self.stop_event_loop()
-        
+                if not await self.connections.recover(generation):
+                    await self.subscribe()  # the pools are fine, only the subscription was lost
+
 async def run_event_loop(app):
     loop = asyncio.get_event_loop()
     await app.connect_to_redis(40)
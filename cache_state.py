@@ -0,0 +1,111 @@
+from array import array
+from ids import key_id, key_name
+
+# MESI states plus MOESI Owned and MESIF Forward, one byte per key
+INVALID = 0
+SHARED = 1
+EXCLUSIVE = 2
+MODIFIED = 3
+OWNED = 4
+FORWARD = 5
+STATE_NAMES = "ISEMOF"
+
+
+class _Columns:
+    # parallel arrays indexed by slot: state byte plus hit/miss counters
+    def __init__(self, capacity):
+        self.states = array('B', bytes(capacity))
+        self.hits = array('I', bytes(4 * capacity))
+        self.misses = array('I', bytes(4 * capacity))
+
+    def __len__(self):
+        return len(self.states)
+
+    def grow(self, slot):
+        size = len(self.states)
+        if slot < size:
+            return
+        new_size = max(size * 2, slot + 1)
+        extra = new_size - size
+        self.states.frombytes(bytes(extra))
+        self.hits.frombytes(bytes(4 * extra))
+        self.misses.frombytes(bytes(4 * extra))
+
+
+# Per-key coherence state directory. data_<n> keys below dense_limit index
+# the dense columns directly by n, with no per-key entry anywhere; larger
+# numbers and interned names get a slot in a small overflow table, so one
+# far-out key does not grow the dense columns to its number.
+class StateTable:
+    def __init__(self, capacity=1024, dense_limit=1 << 20):
+        self.dense_limit = dense_limit
+        self._dense = _Columns(capacity)
+        self._sparse = _Columns(16)
+        self._sparse_slots = {}  # key id -> overflow slot
+
+    def _locate(self, key, grow=False):
+        kid = key if isinstance(key, int) else key_id(key)
+        if kid < self.dense_limit:
+            columns, slot = self._dense, kid
+        else:
+            columns, slot = self._sparse, self._sparse_slots.get(kid)
+            if slot is None:
+                if not grow:
+                    return None, None
+                slot = self._sparse_slots[kid] = len(self._sparse_slots)
+        if grow:
+            columns.grow(slot)
+        elif slot >= len(columns):
+            return None, None
+        return columns, slot
+
+    def get(self, key):
+        columns, slot = self._locate(key)
+        if columns is None:
+            return INVALID
+        return columns.states[slot]
+
+    def set(self, key, state):
+        columns, slot = self._locate(key, grow=True)
+        columns.states[slot] = state
+
+    def invalidate(self, key):
+        columns, slot = self._locate(key)
+        if columns is not None:
+            columns.states[slot] = INVALID
+
+    def is_valid(self, key):
+        return self.get(key) != INVALID
+
+    def hit(self, key):
+        columns, slot = self._locate(key, grow=True)
+        columns.hits[slot] += 1
+
+    def miss(self, key):
+        columns, slot = self._locate(key, grow=True)
+        columns.misses[slot] += 1
+
+    def touched(self):
+        # (key id, hits, misses) for every key that was accessed at least once
+        dense = self._dense
+        for slot in range(len(dense)):
+            if dense.hits[slot] or dense.misses[slot]:
+                yield slot, dense.hits[slot], dense.misses[slot]
+        sparse = self._sparse
+        for kid, slot in self._sparse_slots.items():
+            if sparse.hits[slot] or sparse.misses[slot]:
+                yield kid, sparse.hits[slot], sparse.misses[slot]
+
+    def totals(self):
+        hits = sum(self._dense.hits) + sum(self._sparse.hits)
+        misses = sum(self._dense.misses) + sum(self._sparse.misses)
+        return hits, misses
+
+    def hit_ratio(self):
+        hits, misses = self.totals()
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def write_stats(self, filepath):
+        with open(filepath, "w") as f:
+            for kid, hits, misses in self.touched():
+                f.write(f"{key_name(kid)} {hits} {misses}\n")
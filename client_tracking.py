@@ -0,0 +1,59 @@
+import aioredis
+from aioredis.utils import str_if_bytes
+
+# Server-assisted client-side caching (Redis >= 6 CLIENT TRACKING) over RESP2,
+# which is what aioredis speaks: invalidations can't be pushed on the data
+# connections, so the server redirects them to one extra connection that is
+# subscribed to INVALIDATE_CHANNEL.
+#   default: every home connection is tracked and the server remembers the
+#            keys each of them read, a key's first change after the read is
+#            reported once, then it has to be read again to be tracked
+#   bcast:   changes of any key under the prefixes are reported, read or not
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+
+
+# Home connection whose reads are tracked, with invalidations sent to `redirect`
+class TrackingConnection(aioredis.Connection):
+    def __init__(self, *, redirect, **kwargs):
+        super().__init__(**kwargs)
+        self.redirect = redirect
+
+    async def on_connect(self):
+        await super().on_connect()
+        await self.send_command("CLIENT", "TRACKING", "on", "REDIRECT", self.redirect)
+        if str_if_bytes(await self.read_response()) != "OK":
+            raise aioredis.ConnectionError("CLIENT TRACKING failed")
+
+
+class InvalidationListener:
+    def __init__(self, host, port, prefixes=None):
+        self.connection = aioredis.Connection(host=host, port=port)
+        self.prefixes = prefixes  # bcast mode prefixes, None for default tracking
+        self.client_id = None
+
+    async def connect(self):
+        # client id to redirect to; in bcast mode the tracking is registered
+        # once, on this connection itself, instead of on every data connection
+        await self.connection.connect()
+        await self.connection.send_command("CLIENT", "ID")
+        self.client_id = int(await self.connection.read_response())
+        if self.prefixes is not None:
+            args = ["CLIENT", "TRACKING", "on", "REDIRECT", self.client_id, "BCAST"]
+            for prefix in self.prefixes:
+                args += ["PREFIX", prefix]
+            await self.connection.send_command(*args)
+            if str_if_bytes(await self.connection.read_response()) != "OK":
+                raise aioredis.ConnectionError("CLIENT TRACKING failed")
+        await self.connection.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+        await self.connection.read_response()
+        return self.client_id
+
+    async def invalidations(self):
+        # lists of invalidated keys, None when the server flushed all of them
+        while True:
+            message = await self.connection.read_response()
+            if str_if_bytes(message[0]) == "message":
+                yield message[2]
+
+    async def close(self):
+        await self.connection.disconnect()
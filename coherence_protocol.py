@@ -0,0 +1,222 @@
+import asyncio
+import struct
+import time
+from ids import key_id, key_name, INTERNED_BASE
+from latency_histogram import LatencyHistogram
+
+# Binary coherence messages. A publish carries a batch:
+#   batch header:   magic (u8), message count (u16)
+#   message header: type (u8), origin node id (u32), key id (u32)
+#   key name:       u16 length + bytes, only for interned (non data_<n>) keys
+#   value:          u16 length + bytes, only for UPDATE, UPDATE_INVALIDATE and START
+UPDATE = 1
+INVALIDATE = 2
+UPDATE_INVALIDATE = 3  # S->M transition: new value and invalidation in one message
+TERMINATE = 4
+# run barriers, key id = cell number: nodes send READY and FLUSHED to the
+# manager's coordinator, which answers READY with one START carrying the
+# common start time (time.time(), Mininet hosts share the clock) as its value
+# and repeats it to nodes whose READY comes in after the start
+READY = 5
+START = 6
+FLUSHED = 7
+START_DELAY = 0.5  # seconds between the last READY and the common start, for START to reach every node
+READY_TIMEOUT = 120  # cells start with the nodes that joined by then
+FLUSH_GRACE = 30  # seconds past the end of a cell to wait for FLUSHED
+# a node filled a line from a peer's cache (or became its MESIF forwarder):
+# the previous forwarder downgrades, the others update their forwarder hint
+FETCHED = 8
+
+# Directory mode: writers send to the home manager on DIRECTORY_CHANNEL, the
+# manager forwards invalidations to each sharer's own channel
+DIRECTORY_CHANNEL = "cache_directory"
+COORDINATOR_CHANNEL = "cache_coordinator"
+SHARERS_PREFIX = "sharers:"
+
+MAGIC = 0xC5
+BATCH_HEADER = struct.Struct("<BH")
+MESSAGE_HEADER = struct.Struct("<BII")
+LENGTH = struct.Struct("<H")
+MAX_BATCH = 0xFFFF
+MAX_VALUE = 0xFFFF  # largest value (and interned key name) a message can carry
+
+_WITH_VALUE = (UPDATE, UPDATE_INVALIDATE, START)
+
+
+def node_channel(host_name):
+    return f"cache_updates:{host_name}"
+
+
+def sharers_key(key):
+    # home-side set of node ids holding a copy of key
+    return f"{SHARERS_PREFIX}{key}"
+
+
+def _as_bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+def encode_message(kind, origin, key=None, value=None):
+    kid = 0 if key is None else key_id(key)
+    parts = [MESSAGE_HEADER.pack(kind, origin, kid)]
+    if kid >= INTERNED_BASE:
+        name = key_name(kid).encode()
+        parts.append(LENGTH.pack(len(name)) + name)
+    if kind in _WITH_VALUE:
+        value = _as_bytes(value)
+        parts.append(LENGTH.pack(len(value)) + value)
+    return b"".join(parts)
+
+
+def encode_batch(messages):
+    return BATCH_HEADER.pack(MAGIC, len(messages)) + b"".join(messages)
+
+
+def decode_batch(payload):
+    # yields (type, origin, key id, value or None); the key id of an interned
+    # key is translated to this process' own id for the same name
+    view = memoryview(payload)
+    magic, count = BATCH_HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError(f"not a coherence batch (magic {magic:#x})")
+    offset = BATCH_HEADER.size
+    for _ in range(count):
+        kind, origin, kid = MESSAGE_HEADER.unpack_from(view, offset)
+        offset += MESSAGE_HEADER.size
+        if kid >= INTERNED_BASE:
+            (length,) = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+            kid = key_id(bytes(view[offset:offset + length]))
+            offset += length
+        value = None
+        if kind in _WITH_VALUE:
+            (length,) = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+            value = bytes(view[offset:offset + length])
+            offset += length
+        yield kind, origin, kid, value
+
+
+# Coalesces coherence messages into publishes, one publish in flight at a
+# time and at most MAX_BATCH messages each. A message is published at once
+# when no publish is in flight, otherwise together with everything queued
+# behind that publish as soon as it completes; a window > 0 also holds every
+# batch open that many seconds. send() resolves once the batch holding the
+# message has been published, post() does not wait.
+class PublishBatcher:
+    def __init__(self, publish, window=0.0):
+        self.publish = publish  # async callable taking the encoded payload
+        self.window = window
+        self.pending = []
+        self.waiters = []  # one per pending message, None for post()
+        self.flush_task = None
+        self.in_flight = False
+        self.batches = 0
+        self.messages = 0
+
+    async def send(self, message):
+        waiter = asyncio.get_running_loop().create_future()
+        self._queue(message, waiter)
+        return await waiter
+
+    def post(self, message):
+        # send() without waiting for the publish, a failed publish drops it
+        self._queue(message, None)
+
+    def _queue(self, message, waiter):
+        self.pending.append(message)
+        self.waiters.append(waiter)
+        # behind a publish in flight the message goes out once that completes
+        if self.flush_task is None and not self.in_flight:
+            self.flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def close(self):
+        # publish what is pending now rather than after the window
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        while self.pending and not self.in_flight:
+            messages, waiters = self.pending[:MAX_BATCH], self.waiters[:MAX_BATCH]
+            del self.pending[:MAX_BATCH], self.waiters[:MAX_BATCH]
+            self.batches += 1
+            self.messages += len(messages)
+            self.in_flight = True
+            try:
+                result = await self.publish(encode_batch(messages))
+            except Exception as e:
+                # surfaces in every send() of the batch
+                for waiter in waiters:
+                    if waiter is not None and not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            finally:
+                self.in_flight = False
+            for waiter in waiters:
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(result)
+
+
+# Receiving side of the batcher. The listener only enqueues the lines peers
+# wrote; one consumer drains everything pending, keeps the last message per
+# key and applies the lot together. The queue is bounded, a consumer that
+# falls behind holds the listener back instead of growing without limit.
+class ApplyQueue:
+    def __init__(self, apply, clock=time.time, maxsize=1024):
+        self.apply = apply  # async callable taking {key id: new value, None to invalidate}
+        self.clock = clock
+        self.queue = asyncio.Queue(maxsize)
+        self.task = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.messages = 0
+        self.batches = 0
+        self.applied = 0  # lines after deduplication
+        self.max_depth = 0
+        self.depth_total = 0  # queue depth seen by each message, for the mean
+        self.lag = LatencyHistogram()  # seconds from receipt to apply
+
+    async def put(self, kid, value=None):
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self.depth_total += depth
+        self.messages += 1
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        await self.queue.put((kid, value, self.clock()))
+
+    async def run(self):
+        while True:
+            entries = [await self.queue.get()]
+            while not self.queue.empty():
+                entries.append(self.queue.get_nowait())
+            lines = {}
+            for kid, value, _ in entries:
+                lines[kid] = value  # the latest message wins
+            self.batches += 1
+            self.applied += len(lines)
+            try:
+                await self.apply(lines)
+            except Exception as e:
+                print(f"applying {len(lines)} coherence messages failed: {e}")
+            now = self.clock()
+            for _, _, received in entries:
+                self.lag.record(now - received)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self):
+        return {"messages": self.messages, "batches": self.batches, "applied": self.applied,
+                "max_depth": self.max_depth, "mean_depth": self.depth_total / self.messages if self.messages else 0,
+                "depth": self.queue.qsize(), "mean_lag": self.lag.mean(), "p99_lag": self.lag.percentile(99)}
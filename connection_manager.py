@@ -0,0 +1,107 @@
+import asyncio
+import random
+import time
+import aioredis
+from aioredis import RedisError
+
+# errors that a new connection can fix; anything else (e.g. a ResponseError) is the caller's
+TRANSIENT = (aioredis.ConnectionError, aioredis.TimeoutError, OSError, asyncio.TimeoutError)
+MAX_EVENTS = 100
+
+
+# One per node, shared by the data path and the subscribers. An operation
+# that fails with a transient error is retried after a capped, fully
+# jittered exponential backoff. Before the retry the pools are health
+# checked: when home still answers, only the broken connection was lost (the
+# pool has dropped it already) and the same pools are reused. Otherwise the
+# old pools and subscriptions are closed and opened again, once for all the
+# operations that failed together.
+class ConnectionManager:
+    def __init__(self, open_connections, close_connections, health_check, clock=time.time, base_delay=0.05, max_delay=5.0, attempts=4):
+        self.open_connections = open_connections  # async: creates the pools, clients and subscriptions
+        self.close_connections = close_connections  # async: releases them
+        self.health_check = health_check  # async: raises if home does not answer
+        self.clock = clock
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempts = attempts  # per operation, the first try included
+        self.generation = 0  # bumped by every open
+        self.reopening = None  # task of the reopen in progress
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.reconnects = 0
+        self.healthy_checks = 0  # failures after which the pools were still fine
+        self.retries = 0
+        self.failed_ops = 0
+        self.time_lost = 0.0  # seconds operations spent between an error and their retry
+        self.reconnect_time = 0.0
+        self.events = []  # (start, seconds) of the last MAX_EVENTS reopens
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def connect(self, max_retries):
+        for attempt in range(max_retries):
+            try:
+                await self.open_connections()
+                self.generation += 1
+                return
+            except (RedisError, OSError) as e:
+                delay = self.backoff(attempt)
+                print(f"Connection error: {e}. Retrying in {delay:.3f} seconds...")
+                await asyncio.sleep(delay)
+        raise ConnectionError("Failed to connect to Redis after retries")
+
+    async def recover(self, generation, force=False, max_retries=40):
+        # after a transient error on `generation`; returns True if the connections were
+        # reopened, force skips the health check (state tied to the lost connection)
+        if generation != self.generation:
+            return True  # someone else already did
+        if self.reopening is None:
+            self.reopening = asyncio.ensure_future(self._reopen(force, max_retries))
+        return await asyncio.shield(self.reopening)
+
+    async def _reopen(self, force, max_retries):
+        start = self.clock()
+        try:
+            if not force:
+                try:
+                    await self.health_check()
+                    self.healthy_checks += 1
+                    return False
+                except TRANSIENT:
+                    pass
+            try:
+                await self.close_connections()
+            except (RedisError, OSError):
+                pass  # the old connections are broken anyway
+            await self.connect(max_retries)
+            self.reconnects += 1
+            self.events = self.events[-(MAX_EVENTS - 1):] + [(start, self.clock() - start)]
+            return True
+        finally:
+            self.reconnect_time += self.clock() - start
+            self.reopening = None
+
+    async def call(self, operation, default=None):
+        # operation() with in-flight retry; default once every attempt failed
+        for attempt in range(self.attempts):
+            generation = self.generation
+            try:
+                return await operation()
+            except TRANSIENT as e:
+                if attempt + 1 == self.attempts:
+                    self.failed_ops += 1
+                    print(f"operation failed after {self.attempts} attempts: {e}")
+                    return default
+                start = self.clock()
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt))
+                await self.recover(generation)
+                self.time_lost += self.clock() - start
+
+    def stats(self):
+        return {"reconnects": self.reconnects, "healthy_checks": self.healthy_checks, "retries": self.retries,
+                "failed_ops": self.failed_ops, "time_lost": self.time_lost, "reconnect_time": self.reconnect_time,
+                "reconnect_events": self.events}
@@ -0,0 +1,695 @@
+import argparse
+import asyncio
+import importlib
+import random
+import selectors
+import sys
+import time
+from decimal import Decimal
+from aggregate import write_json, MANIFEST_FILE
+from home_store import HomeStore
+from coherence_protocol import DIRECTORY_CHANNEL
+from latency_histogram import LatencyHistogram
+from workload import add_arguments as add_workload_arguments, spec_from_args as workload_spec_from_args
+
+# Discrete-event version of the Mininet experiment. The unmodified CacheApp
+# coroutines run on an asyncio loop whose clock only moves when every task is
+# waiting, and the Redis servers are replaced by in-memory ones that charge
+# the hop latency of the DynamicTopology chain for each round trip. Nothing
+# here needs root, Mininet or a redis-server.
+
+HOME = "home"
+CHANNEL = "cache_updates"
+SETTLE_TIME = 0.1  # virtual seconds for coherence messages in flight at the end of a cell
+# check_speed: wall seconds one cell of 100 hosts, 30 virtual seconds at 0.8 reads may take
+SPEED_BUDGET = 10.0
+
+
+class _VirtualSelector(selectors.SelectSelector):
+    # never blocks: instead of waiting for the next timer, jump the clock to it
+    def __init__(self, loop):
+        super().__init__()
+        self._loop = loop
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if ready:
+            return ready
+        if timeout is None:
+            raise RuntimeError("simulation stalled: no task is scheduled to wake up")
+        self._loop.now += timeout
+        return []
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(selector=_VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+
+class SimNetwork:
+    # Latency model of DynamicTopology: home hangs off s0, the switches form a
+    # chain s0 - s1 - ... and hosts of s<L> are attached to switch L.
+    def __init__(self, num_switch_layers=20, hosts_per_switch=10, hop_latency=0.0001,
+                 local_latency=0.00005, service_time=0.00002, key_service_time=0.000002):
+        self.num_switch_layers = num_switch_layers
+        self.hosts_per_switch = hosts_per_switch
+        self.all_hosts = num_switch_layers * hosts_per_switch
+        self.hop_latency = hop_latency  # one-way latency of a single link
+        self.local_latency = local_latency  # one-way latency to the host's own redis-server
+        self.service_time = service_time  # per command on a server
+        self.key_service_time = key_service_time  # extra per key for multi-key commands
+        self.servers = {}
+
+    @staticmethod
+    def layer_of(node):
+        if node == HOME:
+            return -1
+        return int(node.split('_')[0][1:])
+
+    def hosts(self, active_layers):
+        return [f"s{layer}_n{i}" for layer in range(active_layers) for i in range(self.hosts_per_switch)]
+
+    def one_way(self, src, dst):
+        if src == dst:
+            return self.local_latency
+        a, b = self.layer_of(src), self.layer_of(dst)
+        # host->switch + switch chain + switch->host, home sits one link above s0
+        if a == -1 or b == -1:
+            links = 2 + max(a, b)
+        else:
+            links = 2 + abs(a - b)
+        return links * self.hop_latency
+
+    def server(self, node):
+        if node not in self.servers:
+            self.servers[node] = SimServer(node)
+        return self.servers[node]
+
+
+class SimServer:
+    # single-threaded redis-server: commands queue up behind each other
+    def __init__(self, node):
+        self.node = node
+        self.data = {}
+        self.channels = {}
+        self.busy_until = 0.0
+        self.commands = 0
+        self.trackers = {}  # client -> SimTracker of its CLIENT TRACKING redirect
+        self.tracked = {}  # key -> clients that read it, default tracking mode
+
+    def reserve(self, arrival, service):
+        start = max(arrival, self.busy_until)
+        self.busy_until = start + service
+        return self.busy_until
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _deliver(queues, payload):
+    for queue in queues:
+        queue.put_nowait(payload)
+
+
+class SimRedis:
+    # The subset of the aioredis client API that CacheApp uses
+    def __init__(self, net, client, server):
+        self.net = net
+        self.client = client
+        self.server = net.server(server)
+
+    async def _round_trip(self, commands, n_keys, apply):
+        loop = asyncio.get_running_loop()
+        one_way = self.net.one_way(self.client, self.server.node)
+        service = commands * self.net.service_time + n_keys * self.net.key_service_time
+        done = self.server.reserve(loop.time() + one_way, service)
+        self.server.commands += commands
+        if self.client == self.server.node:
+            # nobody else talks to a host's own server, apply on return
+            await asyncio.sleep(done + one_way - loop.time())
+            return apply()
+        await asyncio.sleep(done - loop.time())
+        result = apply()
+        await asyncio.sleep(one_way)
+        return result
+
+    def _track(self, keys):
+        tracker = self.server.trackers.get(self.client)
+        if tracker is not None and tracker.prefixes is None:
+            for key in keys:
+                self.server.tracked.setdefault(key, set()).add(self.client)
+
+    def _invalidate(self, keys):
+        # client tracking: push the changed keys to every client tracking them
+        loop = asyncio.get_running_loop()
+        for client, tracker in self.server.trackers.items():
+            if tracker.prefixes is None:
+                changed = [key for key in keys if client in self.server.tracked.get(key, ())]
+                for key in changed:
+                    self.server.tracked[key].discard(client)
+            else:
+                changed = [key for key in keys if key.startswith(tuple(tracker.prefixes))]
+            if changed:
+                loop.call_later(self.net.one_way(self.server.node, client), tracker.queue.put_nowait,
+                                [_encode(key) for key in changed])
+
+    # command bodies run on the server at the instant it executes them
+    def _get(self, key):
+        self._track([key])
+        return self.server.data.get(key)
+
+    def _set(self, key, value, nx=False):
+        if nx and key in self.server.data:
+            return None
+        self.server.data[key] = _encode(value)
+        self._invalidate([key])
+        return True
+
+    def _mget(self, keys):
+        self._track(keys)
+        return [self.server.data.get(key) for key in keys]
+
+    def _mset(self, mapping):
+        for key, value in mapping.items():
+            self.server.data[key] = _encode(value)
+        self._invalidate(list(mapping))
+        return True
+
+    def _delete(self, *keys):
+        self._invalidate(keys)
+        return sum(1 for key in keys if self.server.data.pop(key, None) is not None)
+
+    def _publish(self, channel, message):
+        loop = asyncio.get_running_loop()
+        subscribers = self.server.channels.get(channel, ())
+        payload = {'type': 'message', 'channel': channel.encode(), 'data': _encode(message)}
+        # one timer per distinct distance instead of one per subscriber
+        by_delay = {}
+        for pubsub in subscribers:
+            delay = self.net.one_way(self.server.node, pubsub.client)
+            by_delay.setdefault(delay, []).append(pubsub.queue)
+        for delay, queues in by_delay.items():
+            loop.call_later(delay, _deliver, queues, payload)
+        return len(subscribers)
+
+    def _sadd(self, key, *members):
+        members = {_encode(member) for member in members}
+        current = self.server.data.setdefault(key, set())
+        added = len(members - current)
+        current |= members
+        return added
+
+    def _smembers(self, key):
+        return set(self.server.data.get(key, ()))
+
+    def _scard(self, key):
+        return len(self.server.data.get(key, ()))
+
+    def _keys(self, pattern='*'):
+        return list(self.server.data)
+
+    async def get(self, key):
+        return await self._round_trip(1, 1, lambda: self._get(key))
+
+    async def set(self, key, value, nx=False):
+        return await self._round_trip(1, 1, lambda: self._set(key, value, nx))
+
+    async def mget(self, keys):
+        keys = list(keys)
+        return await self._round_trip(1, len(keys), lambda: self._mget(keys))
+
+    async def mset(self, mapping):
+        return await self._round_trip(1, len(mapping), lambda: self._mset(mapping))
+
+    async def delete(self, *keys):
+        return await self._round_trip(1, len(keys), lambda: self._delete(*keys))
+
+    async def publish(self, channel, message):
+        return await self._round_trip(1, 1, lambda: self._publish(channel, message))
+
+    async def sadd(self, key, *members):
+        return await self._round_trip(1, len(members), lambda: self._sadd(key, *members))
+
+    async def smembers(self, key):
+        return await self._round_trip(1, 1, lambda: self._smembers(key))
+
+    async def scard(self, key):
+        return await self._round_trip(1, 1, lambda: self._scard(key))
+
+    async def keys(self, pattern='*'):
+        return await self._round_trip(1, len(self.server.data), lambda: self._keys(pattern))
+
+    async def ping(self):
+        return await self._round_trip(1, 0, lambda: True)
+
+    def pipeline(self, transaction=True):
+        return SimPipeline(self)
+
+    def pubsub(self):
+        return SimPubSub(self)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class SimPipeline:
+    # queued commands go out in one round trip and are executed back to back
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, f"_{name}")
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+
+        def apply():
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
+        return await self.redis._round_trip(len(commands), len(commands), apply)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+
+class SimPubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.client = redis.client
+        self.queue = asyncio.Queue()
+        self.subscribed = []
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.redis.server.channels.setdefault(channel, []).append(self)
+            self.subscribed.append(channel)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels or list(self.subscribed):
+            self.redis.server.channels.get(channel, []).remove(self)
+            self.subscribed.remove(channel)
+
+    async def reset(self):
+        await self.unsubscribe()
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        try:
+            return self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+
+class SimTracker:
+    # client_tracking.InvalidationListener against a SimServer
+    def __init__(self, net, client, server, prefixes=None):
+        self.client = client
+        self.server = net.server(server)
+        self.prefixes = prefixes
+        self.queue = asyncio.Queue()
+
+    async def connect(self):
+        self.server.trackers[self.client] = self
+        return 0
+
+    async def invalidations(self):
+        while True:
+            yield await self.queue.get()
+
+    async def close(self):
+        self.server.trackers.pop(self.client, None)
+
+
+def attach(app, net):
+    # what CacheApp.connect_to_redis does, against the simulated servers
+    app.clock = asyncio.get_running_loop().time
+    if hasattr(app, "connections"):
+        app.connections.clock = app.clock
+    app.cache = SimRedis(net, app.host_name, app.host_name)
+    app.home = SimRedis(net, app.host_name, HOME)
+    app.pub_sub = app.home.pubsub()
+    if hasattr(app, "connect_peer"):
+        app.connect_peer = lambda peer_name: SimRedis(net, app.host_name, peer_name)
+    if hasattr(app, "connect_shards"):
+        app.connect_shard = lambda shard_name: SimRedis(net, app.host_name, shard_name)
+        app.connect_shards()
+    if getattr(app, "coherence", None) == "tracking":
+        app.tracker = SimTracker(net, app.host_name, HOME, app.tracking_prefixes())
+    if hasattr(app, "make_home_store"):
+        app.home_store = app.make_home_store()
+    else:
+        app.home_store = HomeStore(app.home, app.gen_random_data)
+
+
+async def start_manager(net, node=HOME):
+    # manager_app.Manager on the home node (or a home shard), for directory coherence
+    from manager_app import Manager
+    manager = Manager()
+    manager.home = SimRedis(net, node, node)
+    manager.directory = manager.home
+    manager.pub_sub = manager.home.pubsub()
+    await manager.pub_sub.subscribe(CHANNEL, DIRECTORY_CHANNEL)
+    return manager, asyncio.get_running_loop().create_task(manager.listen_for_updates())
+
+
+async def start_aggregators(net, hosts, aggregation, coherence, home_shards=()):
+    # aggregator_app.Aggregator for every aggregator the hosts read through
+    from aggregator_app import Aggregator
+    from protocols import aggregator_for
+    tasks = []
+    for name in sorted({aggregator_for(host, aggregation) for host in hosts}):
+        aggregator = Aggregator(name)
+        aggregator.coherence = coherence
+        aggregator.cache = aggregator.directory = SimRedis(net, name, name)
+        aggregator.home = SimRedis(net, name, HOME)
+        aggregator.pub_subs = [SimRedis(net, name, shard).pubsub() for shard in [HOME] + list(home_shards)]
+        for pub_sub in aggregator.pub_subs:
+            await pub_sub.subscribe(*aggregator.channels())
+        tasks.append(asyncio.get_running_loop().create_task(aggregator.listen_for_updates()))
+    return tasks
+
+
+async def run_cell(app_module, net, hosts, read_probability, layers_traversed, simulation_time, output_dir, options):
+    # options: CacheApp attributes to set on every node, e.g. coherence, workers, read_batch, target_rate,
+    # write_policy, state_machine, aggregation, plus protocol for the MESI node's ProtocolSelector
+    # and home_shards, the switch layers of extra home shards
+    from protocols import shard_names
+    module = importlib.import_module(app_module)
+    apps = []
+    listeners = []
+    options = dict(options)
+    home_shards = shard_names(options.pop("home_shards", None) or [])[1:]
+    if options.get("coherence") == "directory":
+        for node in [HOME] + home_shards:
+            manager, task = await start_manager(net, node)
+            listeners.append(task)
+    if options.get("aggregation") and app_module == "cache_app":
+        listeners += await start_aggregators(net, hosts, options["aggregation"], options.get("coherence", "broadcast"),
+                                             home_shards)
+    for host in hosts:
+        app = module.CacheApp(host)
+        app.read_probability = read_probability
+        app.layers_traversed = layers_traversed
+        app.sim_time = simulation_time
+        # keep simulated results apart from the Mininet ones by default
+        app.output_dir = output_dir or f"./sim_{app.output_dir[2:]}"
+        for name, value in options.items():
+            if hasattr(app, name):
+                setattr(app, name, value)
+        if "protocol" in options and hasattr(app, "selector"):
+            app.selector.policy = options["protocol"]
+        app.home_shards = home_shards
+        attach(app, net)
+        if getattr(app, "tracker", None) is not None:
+            await app.tracker.connect()
+        if hasattr(app, "pub_subs"):
+            await app.subscribe(app.shards)
+        elif hasattr(app, "subscribe"):
+            await app.subscribe()
+        else:
+            await app.pub_sub.subscribe(CHANNEL)
+        apps.append(app)
+
+    loop = asyncio.get_running_loop()
+    listeners += [loop.create_task(app.listen_for_updates()) for app in apps]
+    await asyncio.gather(*(app.generate_load(simulation_time) for app in apps))
+    await asyncio.gather(*(app.flush_dirty() for app in apps if hasattr(app, "flush_dirty")))
+    # messages still waiting out a batch window go now, none is left pending on the closed loop
+    await asyncio.gather(*(batcher.close() for app in apps if hasattr(app, "batchers") for batcher in app.batchers()))
+    await asyncio.sleep(SETTLE_TIME)  # the final write-back's invalidations reach the peers
+    for task in listeners:
+        task.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+
+    for app in apps:
+        app.flush_latencies()
+        if hasattr(app, "write_stats"):
+            app.write_stats()
+    return apps
+
+
+def simulate_cell(app_module, net, hosts, read_probability, layers_traversed, simulation_time, output_dir=None, seed=0,
+                  options=None):
+    random.seed(seed)
+    net.servers = {}
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run_cell(app_module, net, hosts, read_probability, layers_traversed, simulation_time,
+                                                output_dir, options or {}))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def run(read_probabilities, simulation_time, app_module="cache_app", net=None, output_dir=None, seed=0, name=None,
+        options=None):
+    # same sweep as network.run(): all layers active first, then the lowest
+    # switch layer is removed after every round of read fractions
+    from plotting import plot_graphs
+
+    net = net or SimNetwork()
+    options = options or {}
+    all_read_latencies = {}
+    all_write_latencies = {}
+    # network.run's sweep layout, for aggregate and plot_from_files
+    manifest = {"name": name or f"sim_{app_module}", "num_switch_layers": net.num_switch_layers,
+                "hosts_per_switch": net.hosts_per_switch, "all_hosts": net.all_hosts, "nodes_per_host": 1,
+                "read_probabilities": list(read_probabilities), "coherence": options.get("coherence", "broadcast"),
+                "aggregation": options.get("aggregation"), "home_shards": list(options.get("home_shards") or []),
+                "cells": []}
+
+    for layers_traversed in range(1, net.num_switch_layers + 1):
+        active_layers = net.num_switch_layers - layers_traversed + 1
+        hosts = net.hosts(active_layers)
+        num_servers_this_layer = len(hosts)
+        for read_probability in read_probabilities:
+            apps = simulate_cell(app_module, net, hosts, read_probability, layers_traversed, simulation_time,
+                                 output_dir, seed + layers_traversed, options)
+            manifest["cells"].append({"cell": len(manifest["cells"]) + 1, "layers_traversed": layers_traversed,
+                                      "read_probability": read_probability, "servers": num_servers_this_layer,
+                                      "flushed": len(apps), "nodes": len(apps)})
+            write_json(f"{apps[0].output_dir}/{MANIFEST_FILE}", manifest)
+            read_latencies = LatencyHistogram()
+            write_latencies = LatencyHistogram()
+            for app in apps:
+                read_latencies.merge(app.read_hist)
+                write_latencies.merge(app.write_hist)
+            all_read_latencies[f"{num_servers_this_layer} Servers - {read_probability} Read"] = read_latencies
+            if (read_probability != 1.0):
+                all_write_latencies[f"{num_servers_this_layer} Servers - {Decimal('1') - Decimal(str(read_probability))} Write"] = write_latencies
+        print(f"finished {net.num_switch_layers - layers_traversed}th layer execution")
+
+    for read in read_probabilities:
+        all_read_latencies[f"0 Servers - {read} Read"] = [0]
+        all_write_latencies[f"0 Servers - {Decimal('1') - Decimal(str(read))} Write"] = [0]
+
+    plot_graphs(all_read_latencies, all_write_latencies, name=name or f"sim_{app_module}")
+    return all_read_latencies, all_write_latencies
+
+
+def compare_topologies(read_probability, simulation_time, aggregations=(None, 5), app_module="cache_app", net=None,
+                       output_dir=None, seed=0, options=None):
+    # flat chain against aggregator tiers: read/write latency by node depth, all layers active
+    from plotting import plot_depth
+
+    net = net or SimNetwork()
+    hosts = net.hosts(net.num_switch_layers)
+    reads, writes = {}, {}
+    for aggregation in aggregations:
+        label = f"{aggregation} Layers per Aggregator" if aggregation else "Flat"
+        cell_options = dict(options or {}, aggregation=aggregation)
+        cell_dir = f"{output_dir or './sim_topologies'}/{aggregation or 'flat'}"
+        apps = simulate_cell(app_module, net, hosts, read_probability, 1, simulation_time, cell_dir, seed, cell_options)
+        reads[label], writes[label] = {}, {}
+        for app in apps:
+            layer = net.layer_of(app.host_name)
+            reads[label].setdefault(layer, LatencyHistogram()).merge(app.read_hist)
+            writes[label].setdefault(layer, LatencyHistogram()).merge(app.write_hist)
+
+    plot_depth(reads, 'Read', name=f"sim_{read_probability}")
+    plot_depth(writes, 'Write', name=f"sim_{read_probability}")
+    return reads, writes
+
+
+def compare_shards(read_probability, simulation_time, placements=((), (10,), (5, 10, 15)), app_module="cache_app", net=None,
+                   output_dir=None, seed=0, options=None):
+    # home alone against extra home shards on these switch layers, all layers active:
+    # overall latency plus the commands each shard's server executed and its clients' view of it
+    from plotting import cell_shard_load, summarize
+    from protocols import shard_names
+
+    net = net or SimNetwork()
+    hosts = net.hosts(net.num_switch_layers)
+    results = {}
+    for layers in placements:
+        label = "home + " + ",".join(str(layer) for layer in layers) if layers else "home"
+        cell_options = dict(options or {}, home_shards=list(layers))
+        cell_dir = f"{output_dir or './sim_shards'}/{'_'.join(str(layer) for layer in layers) or 'home'}"
+        apps = simulate_cell(app_module, net, hosts, read_probability, 1, simulation_time, cell_dir, seed, cell_options)
+        reads, writes = LatencyHistogram(), LatencyHistogram()
+        for app in apps:
+            reads.merge(app.read_hist)
+            writes.merge(app.write_hist)
+        load = cell_shard_load(f"{cell_dir}/1/{read_probability}")
+        commands = {shard: net.server(shard).commands for shard in shard_names(layers)}
+        results[label] = {"read": summarize(reads), "write": summarize(writes), "shards": load, "commands": commands}
+        print(f"{label}: read {reads.mean() * 1000:.3f} ms, write {writes.mean() * 1000:.3f} ms, "
+              f"{sum(app.ops_completed for app in apps)} ops")
+        for shard, count in commands.items():
+            requests = f", {load[shard]['mean_latency'] * 1000:.3f} ms mean request" if shard in load else ""
+            print(f"  {shard}: {count} commands{requests}")
+    return results
+
+
+def compare_coherence(read_probability, simulation_time, modes=(("broadcast", None), ("directory", None),
+                      ("tracking", "default"), ("tracking", "bcast")), net=None, output_dir=None, seed=0, options=None):
+    # pub/sub MESI coherence (broadcast, directory) against home's client tracking, all layers active
+    from plotting import summarize
+
+    net = net or SimNetwork()
+    hosts = net.hosts(net.num_switch_layers)
+    results = {}
+    for coherence, tracking in modes:
+        label = f"{coherence} {tracking}" if tracking else coherence
+        cell_options = dict(options or {}, coherence=coherence, tracking=tracking or "default")
+        cell_dir = f"{output_dir or './sim_coherence'}/{label.replace(' ', '_')}"
+        apps = simulate_cell("cache_app", net, hosts, read_probability, 1, simulation_time, cell_dir, seed, cell_options)
+        reads, writes = LatencyHistogram(), LatencyHistogram()
+        hits = misses = 0
+        for app in apps:
+            reads.merge(app.read_hist)
+            writes.merge(app.write_hist)
+            app_hits, app_misses = app.states.totals()
+            hits += app_hits
+            misses += app_misses
+        hit_ratio = hits / (hits + misses) if hits + misses else 0.0
+        results[label] = {"read": summarize(reads), "write": summarize(writes), "hit_ratio": hit_ratio,
+                          "home_commands": net.server(HOME).commands}
+        print(f"{label}: read {reads.mean() * 1000:.3f} ms (p99 {reads.percentile(99) * 1000:.3f}), "
+              f"write {writes.mean() * 1000:.3f} ms, hit ratio {hit_ratio:.3f}, {net.server(HOME).commands} home commands")
+    return results
+
+
+def run_load_sweep(target_rates, read_probability, simulation_time, app_module="cache_app", net=None, output_dir=None,
+                   seed=0, name=None, options=None):
+    # open-loop rate sweep per layer: achieved throughput against latency
+    from plotting import plot_throughput_latency
+
+    net = net or SimNetwork()
+    output_dir = output_dir or f"./sim_load_{app_module}"
+    curves = {}
+    for layers_traversed in range(1, net.num_switch_layers + 1):
+        hosts = net.hosts(net.num_switch_layers - layers_traversed + 1)
+        for rate in target_rates:
+            cell_options = dict(options or {}, target_rate=rate)
+            apps = simulate_cell(app_module, net, hosts, read_probability, layers_traversed, simulation_time,
+                                 f"{output_dir}/rate_{rate}", seed + layers_traversed, cell_options)
+            latencies = LatencyHistogram()
+            for app in apps:
+                latencies.merge(app.read_hist)
+                latencies.merge(app.write_hist)
+            throughput = sum(app.throughput() for app in apps)
+            curves.setdefault(f"{len(hosts)} Servers", []).append((throughput, latencies))
+        print(f"finished {net.num_switch_layers - layers_traversed}th layer execution")
+
+    plot_throughput_latency(curves, name=name or f"sim_{app_module}")
+    return curves
+
+
+def check_speed(budget=SPEED_BUDGET, app_module="cache_app", output_dir="./sim_speed", options=None):
+    # wall time of the reference cell against budget, True if within it
+    net = SimNetwork(10, 10)
+    started = time.time()
+    apps = simulate_cell(app_module, net, net.hosts(10), 0.8, 1, 30, output_dir, 0, options)
+    elapsed = time.time() - started
+    print(f"{len(apps)} hosts, {sum(app.ops_completed for app in apps)} ops in {elapsed:.1f} s (budget {budget:.1f} s)")
+    return elapsed <= budget
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the MESI sweep on virtual time")
+    parser.add_argument("--app", default="cache_app", help="cache_app (MESI) or cache_app2 (baseline)")
+    parser.add_argument("--sim-time", type=float, default=60)
+    parser.add_argument("--layers", type=int, default=20)
+    parser.add_argument("--hosts-per-switch", type=int, default=10)
+    parser.add_argument("--hop-latency", type=float, default=0.0001, help="one-way latency per link [s]")
+    parser.add_argument("--output-dir", default=None, help="latency file root (defaults to ./sim_<app's own root>)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--coherence", choices=["broadcast", "directory", "tracking"], default="broadcast")
+    parser.add_argument("--tracking", choices=["default", "bcast"], default="default", help="client tracking mode of tracking coherence")
+    parser.add_argument("--write-policy", choices=["write-back", "write-through"], default="write-back")
+    parser.add_argument("--protocol", choices=["adaptive", "invalidate", "update"], default="adaptive")
+    parser.add_argument("--state-machine", choices=["MESI", "MOESI", "MESIF"], default="MESI")
+    parser.add_argument("--aggregation", type=int, default=None, help="layers per aggregator cache (hierarchical mode)")
+    parser.add_argument("--home-shards", type=int, nargs="*", default=[], metavar="LAYER",
+                        help="switch layers of extra home shards, keys are spread by consistent hashing")
+    parser.add_argument("--compare-coherence", action="store_true",
+                        help="compare the pub/sub coherence modes with client tracking at --read-probability")
+    parser.add_argument("--compare-shards", action="store_true",
+                        help="compare home alone with --home-shards (default: 10, then 5 10 15) at --read-probability")
+    parser.add_argument("--workers", type=int, default=1, help="closed-loop clients per node")
+    parser.add_argument("--read-batch", type=int, default=1, help="consecutive reads issued together as one get_many")
+    parser.add_argument("--rate", type=float, default=None, help="open-loop arrival rate per node [ops/s]")
+    parser.add_argument("--rates", type=float, nargs="+", help="sweep these per-node open-loop rates instead of read fractions")
+    parser.add_argument("--read-probability", type=float, default=0.8, help="read fraction used by --rates and --compare")
+    parser.add_argument("--compare", type=int, nargs="+", metavar="LAYERS",
+                        help="compare the flat chain with aggregators shared by these many layers, by node depth")
+    parser.add_argument("--record-trace", action="store_true", help="write every op to trace.bin in the cell directory")
+    parser.add_argument("--replay", default=None, metavar="DIR", help="drive the nodes from the traces of this recorded run")
+    parser.add_argument("--replay-speed", choices=["original", "max"], default="original")
+    parser.add_argument("--check-speed", type=float, nargs="?", const=SPEED_BUDGET, default=None, metavar="SECONDS",
+                        help="time one cell of 100 hosts for 30 s and fail if it takes longer than SECONDS")
+    add_workload_arguments(parser)
+    args = parser.parse_args()
+
+    read_probabilities = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2]
+    net = SimNetwork(args.layers, args.hosts_per_switch, hop_latency=args.hop_latency)
+    options = {"coherence": args.coherence, "tracking": args.tracking, "workers": args.workers, "read_batch": args.read_batch,
+               "target_rate": args.rate,
+               "write_policy": args.write_policy, "protocol": args.protocol, "state_machine": args.state_machine,
+               "aggregation": args.aggregation, "home_shards": args.home_shards,
+               "workload_spec": workload_spec_from_args(args), "record_trace": args.record_trace,
+               "replay_root": args.replay, "replay_speed": args.replay_speed}
+    if args.check_speed is not None:
+        sys.exit(0 if check_speed(args.check_speed, args.app, args.output_dir or "./sim_speed", options) else 1)
+    elif args.compare_coherence:
+        compare_coherence(args.read_probability, args.sim_time, net=net, output_dir=args.output_dir, seed=args.seed,
+                          options=options)
+    elif args.compare_shards:
+        placements = [(), tuple(args.home_shards)] if args.home_shards else [(), (10,), (5, 10, 15)]
+        compare_shards(args.read_probability, args.sim_time, placements, app_module=args.app, net=net,
+                       output_dir=args.output_dir, seed=args.seed, options=options)
+    elif args.compare:
+        compare_topologies(args.read_probability, args.sim_time, [None] + args.compare, app_module=args.app, net=net,
+                           output_dir=args.output_dir, seed=args.seed, options=options)
+    elif args.rates:
+        run_load_sweep(args.rates, args.read_probability, args.sim_time, app_module=args.app, net=net,
+                       output_dir=args.output_dir, seed=args.seed, options=options)
+    else:
+        run(read_probabilities, args.sim_time, app_module=args.app, net=net, output_dir=args.output_dir, seed=args.seed,
+            options=options)
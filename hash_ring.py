@@ -0,0 +1,44 @@
+import bisect
+import hashlib
+
+
+def _hash(name):
+    return int.from_bytes(hashlib.md5(name.encode()).digest()[:8], "little")
+
+
+# Consistent hashing of keys onto home shards. Every shard owns `replicas`
+# points on a 64-bit ring and a key belongs to the first point at or after
+# its own hash, so adding or removing a shard only moves the keys between
+# its points and their predecessors, about 1/n of the keyspace.
+class HashRing:
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []  # sorted hashes
+        self.owners = []  # node of each point
+        self.cache = {}  # key -> node, cleared whenever the ring changes
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+        self.cache = {}
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+        self.cache = {}
+
+    def nodes(self):
+        return sorted(set(self.owners))
+
+    def node_for(self, key):
+        node = self.cache.get(key)
+        if node is None:
+            index = bisect.bisect_left(self.points, _hash(key)) % len(self.points)
+            node = self.cache[key] = self.owners[index]
+        return node
@@ -0,0 +1,195 @@
+import asyncio
+import time
+from coherence_protocol import sharers_key
+from latency_histogram import LatencyHistogram
+
+# Access layer for the home node. Only the requested keys are touched: reads
+# are a single MGET and keys missing at home are created with SET NX in one
+# pipelined round trip, so concurrent creators all end up with the same value.
+# In directory mode the reader is added to each key's sharer set in the same
+# round trip as the read, counts=True also returns the size of every set
+# (1: the reader is the only sharer). Writes of any number of keys are one MSET.
+class HomeStore:
+    def __init__(self, client, value_factory):
+        self.client = client
+        self.value_factory = value_factory
+        self.round_trips = 0
+        self.keys_read = 0
+        self.keys_created = 0
+        self.write_round_trips = 0
+        self.keys_written = 0
+
+    async def get(self, key, sharer=None, counts=False):
+        result = await self.get_many([key], sharer, counts)
+        return (result[0][0], result[1][0]) if counts else result[0]
+
+    async def get_many(self, keys, sharer=None, counts=False):
+        if not keys:
+            return ([], []) if counts else []
+        sharers = [0] * len(keys)
+        if sharer is None:
+            values = await self.client.mget(keys)
+        else:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.sadd(sharers_key(key), sharer)
+                    pipe.scard(sharers_key(key))
+                pipe.mget(keys)
+                results = await pipe.execute()
+            values, sharers = results[-1], results[1:-1:2]
+        self.round_trips += 1
+        self.keys_read += len(keys)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for i in missing:
+                    pipe.set(keys[i], self.value_factory(), nx=True)
+                pipe.mget([keys[i] for i in missing])
+                results = await pipe.execute()
+            self.round_trips += 1
+            self.keys_created += sum(1 for created in results[:-1] if created)
+            for i, value in zip(missing, results[-1]):
+                values[i] = value
+        return (values, sharers) if counts else values
+
+    async def set_many(self, items):
+        # items: key -> value
+        if not items:
+            return
+        await self.client.mset(items)
+        self.round_trips += 1
+        self.write_round_trips += 1
+        self.keys_written += len(items)
+
+
+# Home spread over several shards: a HashRing maps every key to the shard that
+# stores it and owns its coherence traffic. Multi-key reads and writes are
+# split by shard and sent to all of them concurrently, one HomeStore round
+# trip each, and every shard keeps its own load and latency numbers.
+class ShardedHomeStore:
+    def __init__(self, shards, ring, clock=time.time):
+        self.shards = shards  # shard name -> HomeStore
+        self.ring = ring
+        self.clock = clock
+        self.latencies = {name: LatencyHistogram() for name in shards}
+
+    def shard_of(self, key):
+        return self.ring.node_for(key)
+
+    def _total(self, counter):
+        return sum(getattr(store, counter) for store in self.shards.values())
+
+    @property
+    def round_trips(self):
+        return self._total("round_trips")
+
+    @property
+    def keys_read(self):
+        return self._total("keys_read")
+
+    @property
+    def keys_created(self):
+        return self._total("keys_created")
+
+    @property
+    def write_round_trips(self):
+        return self._total("write_round_trips")
+
+    @property
+    def keys_written(self):
+        return self._total("keys_written")
+
+    def _split(self, keys):
+        by_shard = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self.shard_of(key), []).append(i)
+        return by_shard
+
+    async def _timed(self, name, request):
+        start = self.clock()
+        result = await request
+        self.latencies[name].record(self.clock() - start)
+        return result
+
+    async def get(self, key, sharer=None, counts=False):
+        result = await self.get_many([key], sharer, counts)
+        return (result[0][0], result[1][0]) if counts else result[0]
+
+    async def get_many(self, keys, sharer=None, counts=False):
+        by_shard = self._split(keys)
+        results = await asyncio.gather(*(self._timed(name, self.shards[name].get_many([keys[i] for i in indices], sharer, True))
+                                         for name, indices in by_shard.items()))
+        values = [None] * len(keys)
+        sharers = [0] * len(keys)
+        for indices, (fetched, fetched_sharers) in zip(by_shard.values(), results):
+            for i, value, count in zip(indices, fetched, fetched_sharers):
+                values[i] = value
+                sharers[i] = count
+        return (values, sharers) if counts else values
+
+    async def set_many(self, items):
+        keys = list(items)
+        by_shard = self._split(keys)
+        await asyncio.gather(*(self._timed(name, self.shards[name].set_many({keys[i]: items[keys[i]] for i in indices}))
+                               for name, indices in by_shard.items()))
+
+    def shard_stats(self):
+        stats = {}
+        for name, store in self.shards.items():
+            latencies = self.latencies[name]
+            stats[name] = {"round_trips": store.round_trips, "keys_read": store.keys_read,
+                           "keys_created": store.keys_created, "keys_written": store.keys_written,
+                           "requests": latencies.total, "mean_latency": latencies.mean(),
+                           "p99_latency": latencies.percentile(99)}
+        return stats
+
+
+# Home reads through an aggregator cache (hierarchical topology): the
+# aggregator's Redis answers what it holds and only its misses go to home,
+# after which they are copied into it. In directory mode readers join the
+# aggregator's own sharer sets and the aggregator joins home's, so targeted
+# invalidations reach them through aggregator_app.
+class TieredHomeStore:
+    def __init__(self, home, tier, tier_node):
+        self.home = home  # HomeStore
+        self.tier = tier  # client of the aggregator's Redis
+        self.tier_node = tier_node
+        self.tier_round_trips = 0
+        self.tier_hits = 0
+        self.tier_misses = 0
+
+    def __getattr__(self, name):
+        # home traffic counters (round_trips, keys_written, ...) are the HomeStore's
+        return getattr(self.home, name)
+
+    async def get(self, key, sharer=None, counts=False):
+        result = await self.get_many([key], sharer, counts)
+        return (result[0][0], result[1][0]) if counts else result[0]
+
+    async def get_many(self, keys, sharer=None, counts=False):
+        if not keys:
+            return ([], []) if counts else []
+        if sharer is None:
+            values = await self.tier.mget(keys)
+        else:
+            async with self.tier.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.sadd(sharers_key(key), sharer)
+                pipe.mget(keys)
+                values = (await pipe.execute())[-1]
+        self.tier_round_trips += 1
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.tier_hits += len(keys) - len(missing)
+        self.tier_misses += len(missing)
+        if missing:
+            fetched = await self.home.get_many([keys[i] for i in missing], None if sharer is None else self.tier_node)
+            await self.tier.mset({keys[i]: value for i, value in zip(missing, fetched)})
+            self.tier_round_trips += 1
+            for i, value in zip(missing, fetched):
+                values[i] = value
+        # counts stay 0 (unknown): readers under other aggregators are not in this one's sets
+        return (values, [0] * len(keys)) if counts else values
+
+    async def set_many(self, items):
+        # writes go to home, the aggregator's copy is dropped by the writer's coherence message
+        await self.home.set_many(items)
@@ -0,0 +1,41 @@
+KEY_PREFIX = "data_"
+
+# keys that do not follow the data_<n> naming get ids handed out from here
+INTERNED_BASE = 1 << 31
+_interned = {}
+_interned_names = {}
+_next_interned = INTERNED_BASE
+
+
+def key_id(key):
+    # data_<n> keys map straight to n, anything else is interned
+    global _next_interned
+    if isinstance(key, int):
+        return key
+    if isinstance(key, bytes):
+        key = key.decode()
+    if key.startswith(KEY_PREFIX):
+        suffix = key[len(KEY_PREFIX):]
+        # only the canonical spelling, data_007 is another key than data_7
+        if suffix.isdecimal() and str(int(suffix)) == suffix and int(suffix) < INTERNED_BASE:
+            return int(suffix)
+    if key not in _interned:
+        _interned[key] = _next_interned
+        _interned_names[_next_interned] = key
+        _next_interned += 1
+    return _interned[key]
+
+
+def key_name(kid):
+    if kid >= INTERNED_BASE:
+        return _interned_names[kid]
+    return f"{KEY_PREFIX}{kid}"
+
+
+# logical node k of host s<l>_n<i> (agent.py --nodes) is s<l>_n<i + k*LOGICAL_STRIDE>
+LOGICAL_STRIDE = 1000
+
+
+def logical_name(host_name, index):
+    switch, host = host_name.split('_')
+    return f"{switch}_n{int(host[1:]) + index * LOGICAL_STRIDE}"
@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+# Bounded in-process LRU that sits in front of the per-host Redis. The budget
+# counts key and value bytes; the least recently used lines go first.
+class L1Cache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.invalidate(key)  # the old value goes even if the new one does not fit
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.used_bytes -= self._size(old_key, old_value)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.used_bytes -= self._size(key, value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "used_bytes": self.used_bytes}
@@ -0,0 +1,149 @@
+import glob
+import json
+import os
+from array import array
+import numpy as np
+
+# HDR-style latency histogram over integer nanoseconds. Values below
+# 2**sub_bits are counted exactly. Above that, every power of two is split
+# into 2**(sub_bits - 1) linear sub-buckets, so the relative error stays
+# below 2**-(sub_bits - 1) and memory is fixed by the largest trackable
+# value. Histograms with the same layout merge by adding counts.
+class LatencyHistogram:
+    def __init__(self, sub_bits=7, max_bits=40):
+        self.sub_bits = sub_bits
+        self.max_bits = max_bits  # 2**40 ns is about 18 minutes
+        self.sub_count = 1 << sub_bits
+        self.half_count = self.sub_count >> 1
+        self.counts = array('Q', bytes(8 * self._index((1 << max_bits) - 1) + 8))
+        self.total = 0
+        self.sum_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def _index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return self.sub_count + (shift - 1) * self.half_count + (value >> shift) - self.half_count
+
+    def _bounds(self, index):
+        # [low, high] nanoseconds covered by a bucket
+        if index < self.sub_count:
+            return index, index
+        shift = (index - self.sub_count) // self.half_count + 1
+        mantissa = (index - self.sub_count) % self.half_count + self.half_count
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = min(max(round(seconds * 1e9), 0), (1 << self.max_bits) - 1)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum_ns += value
+        self.max_ns = max(self.max_ns, value)
+        self.min_ns = value if self.min_ns is None else min(self.min_ns, value)
+
+    def record_array(self, seconds):
+        # record() over a whole array at once
+        values = np.clip(np.rint(np.asarray(seconds, dtype=float) * 1e9), 0, (1 << self.max_bits) - 1).astype(np.int64)
+        if values.size == 0:
+            return self
+        shift = np.maximum(np.frexp(values)[1] - self.sub_bits, 1)  # frexp's exponent is the bit length
+        indices = np.where(values < self.sub_count, values,
+                           self.sub_count + (shift - 1) * self.half_count + (values >> shift) - self.half_count)
+        counts = np.bincount(indices, minlength=len(self.counts))
+        self.counts = array('Q', (np.frombuffer(self.counts, dtype=np.uint64) + counts.astype(np.uint64)).tobytes())
+        self.total += int(values.size)
+        self.sum_ns += int(values.sum())
+        self.max_ns = max(self.max_ns, int(values.max()))
+        self.min_ns = int(values.min()) if self.min_ns is None else min(self.min_ns, int(values.min()))
+        return self
+
+    def merge(self, other):
+        if (other.sub_bits, other.max_bits) != (self.sub_bits, self.max_bits):
+            raise ValueError("cannot merge histograms with different bucket layouts")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum_ns += other.sum_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        if other.min_ns is not None:
+            self.min_ns = other.min_ns if self.min_ns is None else min(self.min_ns, other.min_ns)
+        return self
+
+    def __len__(self):
+        return self.total
+
+    def mean(self):
+        return self.sum_ns / self.total / 1e9 if self.total else 0.0
+
+    def percentile(self, p):
+        # value in seconds below which p percent of the recorded latencies fall
+        if not self.total:
+            return 0.0
+        rank = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                low, high = self._bounds(index)
+                return min((low + high) / 2, self.max_ns) / 1e9
+        return self.max_ns / 1e9
+
+    def cdf(self):
+        # [(upper bound in seconds, cumulative fraction)] for every non-empty bucket
+        points = []
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count:
+                seen += count
+                points.append((self._bounds(index)[1] / 1e9, seen / self.total))
+        return points
+
+    def to_dict(self):
+        return {"sub_bits": self.sub_bits, "max_bits": self.max_bits, "total": self.total,
+                "sum_ns": self.sum_ns, "min_ns": self.min_ns, "max_ns": self.max_ns,
+                "counts": {str(index): count for index, count in enumerate(self.counts) if count}}
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(data["sub_bits"], data["max_bits"])
+        for index, count in data["counts"].items():
+            hist.counts[int(index)] = count
+        hist.total = data["total"]
+        hist.sum_ns = data["sum_ns"]
+        hist.min_ns = data["min_ns"]
+        hist.max_ns = data["max_ns"]
+        return hist
+
+    def save(self, path):
+        # write-then-rename so a crash never leaves a torn snapshot behind
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def load_cell(cell_dir, latency_type):
+    # merge the hist_<type>_<host>.json snapshots of every node in a cell
+    merged = LatencyHistogram()
+    for path in glob.glob(os.path.join(cell_dir, f"hist_{latency_type}_*.json")):
+        merged.merge(LatencyHistogram.load(path))
+    return merged
+
+
+def load_cell_by_layer(cell_dir, latency_type):
+    # {switch layer: merged histogram} of the nodes s<layer>_n<i> in a cell
+    prefix = f"hist_{latency_type}_"
+    layers = {}
+    for path in glob.glob(os.path.join(cell_dir, f"{prefix}*.json")):
+        host = os.path.basename(path)[len(prefix):-len(".json")]
+        layer = int(host.split('_')[0][1:])
+        layers.setdefault(layer, LatencyHistogram()).merge(LatencyHistogram.load(path))
+    return layers
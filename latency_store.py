@@ -0,0 +1,79 @@
+import os
+import struct
+import numpy as np
+
+# Fixed-width little-endian records, shared by every node of a cell:
+# start timestamp [s], op, key id, latency [ns], node id -> 25 bytes
+RECORD = struct.Struct("<dBIQI")
+RECORD_DTYPE = np.dtype([("ts", "<f8"), ("op", "u1"), ("key", "<u4"), ("latency_ns", "<u8"), ("node", "<u4")])
+OPS_FILE = "ops.bin"
+
+OP_READ = 0
+OP_WRITE = 1
+
+HOME_NODE_ID = 0xFFFFFFFF
+
+
+def node_id(host_name):
+    # s<layer>_n<i> -> layer in the high 16 bits, i in the low 16 bits
+    if host_name == "home":
+        return HOME_NODE_ID
+    switch, host = host_name.split('_')
+    return (int(switch[1:]) << 16) | int(host[1:])
+
+
+def node_name(nid):
+    if nid == HOME_NODE_ID:
+        return "home"
+    return f"s{nid >> 16}_n{nid & 0xFFFF}"
+
+
+def write_all(fd, data):
+    # os.write may write less than asked, a dropped tail would misalign every later record
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# Buffers records in memory and appends them to <cell>/ops.bin. Every flush is
+# a single O_APPEND write of whole records, so all nodes of a cell can share
+# one file without interleaving partial records.
+class LatencyWriter:
+    def __init__(self, cell_dir, node, flush_every=4096):
+        self.path = os.path.join(cell_dir, OPS_FILE)
+        self.node = node
+        self.flush_every = flush_every
+        self.buffer = bytearray()
+        self.pending = 0
+
+    def record(self, op, key, start, latency):
+        self.buffer += RECORD.pack(start, op, key, round(latency * 1e9), self.node)
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            write_all(fd, self.buffer)
+        finally:
+            os.close(fd)
+        self.buffer = bytearray()
+        self.pending = 0
+
+
+def open_cell(cell_dir):
+    # zero-copy view of a cell's records
+    path = os.path.join(cell_dir, OPS_FILE)
+    if not os.path.exists(path) or os.path.getsize(path) < RECORD.size:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", shape=(os.path.getsize(path) // RECORD.size,))
+
+
+def cell_latencies(cell_dir, op):
+    # latencies of one op type in seconds
+    records = open_cell(cell_dir)
+    return records["latency_ns"][records["op"] == op] / 1e9
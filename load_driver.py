@@ -0,0 +1,240 @@
+import asyncio
+import random
+import os
+import time
+from latency_store import LatencyWriter, node_id, OP_READ, OP_WRITE
+from ids import key_id
+from coherence_protocol import encode_message, encode_batch, COORDINATOR_CHANNEL, READY, FLUSHED, START_DELAY, READY_TIMEOUT
+from latency_histogram import LatencyHistogram
+from op_trace import TraceWriter, node_ops
+from workload import Workload
+
+
+# Load generation, latency recording and the run barriers shared by the cache
+# apps (cache_app MESI, cache_app2 baseline). Subclasses provide get_data,
+# set_data, write_stats and publish_terminate, plus home for the barriers.
+class LoadDriver:
+    def __init__(self, host_name, output_dir):
+        self.host_name = host_name
+        self.node = node_id(host_name)
+        self.read_probability = 0.8 # Default read probability (80%)
+        self.layers_traversed = 1
+        self.write_hist = LatencyHistogram()  # constant-size, flushed every flush_interval
+        self.read_hist = LatencyHistogram()
+        self.flush_interval = 5  # seconds between latency snapshots on disk
+        self.last_flush = 0
+        self.is_last_node = False
+        self.sim_time = 10
+        self.workers = 1  # concurrent closed-loop clients sharing this node's connections
+        self.target_rate = None  # ops/s for open-loop Poisson arrivals instead of closed loops
+        self.read_batch = 1  # up to this many consecutive reads of the op stream go out as one get_many
+        self.ops_completed = 0
+        self.load_started = None
+        self.load_finished = None
+        self.load_end = None
+        self.cell = 0  # cell number of the run barriers (agent.py)
+        self.cell_start = None  # resolved with the common start time by the coordinator's START
+        self.clock = time.time  # swapped for the loop clock when run on virtual time
+        self.workload_spec = {}  # Workload keyword arguments, e.g. {"pattern": "zipf", "keyspace": 100000}
+        self.workload = None  # built for the cell on first use
+        self.record_trace = False  # append every op to <output_dir>/<layer>/<read_prob>/trace.bin
+        self.trace_log = None
+        self.replay_root = None  # output_dir of a recorded run, its trace of the same cell drives the load instead
+        self.replay_speed = "original"  # or "max": the recorded ops back to back over the workers
+        self.latency_log = None  # LatencyWriter for <output_dir>/<layer>/<read_prob>/ops.bin
+        self.output_dir = output_dir
+
+    def reset(self, read_probability, layers_traversed, sim_time, cell):
+        # next cell on an already connected node
+        self.read_probability = read_probability
+        self.layers_traversed = layers_traversed
+        self.sim_time = sim_time
+        self.cell = cell
+        self.workload = None
+        self.write_hist = LatencyHistogram()
+        self.read_hist = LatencyHistogram()
+        self.latency_log = None
+        self.trace_log = None
+        self.last_flush = self.clock()
+        self.ops_completed = 0
+        self.load_started = self.load_finished = self.load_end = None
+
+    async def connect_to_redis(self, max_retries):
+        await self.connections.connect(max_retries)
+
+    def finish_cell(self):
+        self.flush_latencies()
+        self.write_stats()
+
+    def load_stream(self):
+        # seeded per node and cell, so reruns draw the same ops
+        if self.workload is None:
+            self.workload = Workload(read_probability=self.read_probability, seed=(self.node, self.cell), **self.workload_spec)
+        return self.workload
+
+    def gen_random_data(self):
+        return self.load_stream().value()
+
+    def latency_dir(self):
+        return f"{self.output_dir}/{str(self.layers_traversed)}/{str(self.read_probability)}/"
+
+    def record_latency(self, op, key, start_time):
+        now = self.clock()
+        latency = now - start_time
+        self.ops_completed += 1
+        if op == OP_READ:
+            self.read_hist.record(latency)
+        else:
+            self.write_hist.record(latency)
+        if self.latency_log is None:
+            self.latency_log = LatencyWriter(self.latency_dir(), self.node)
+        self.latency_log.record(op, key_id(key), start_time, latency)
+        if now - self.last_flush >= self.flush_interval:
+            self.flush_latencies()
+
+    def flush_latencies(self):
+        self.last_flush = self.clock()
+        try:
+            if self.latency_log is not None:
+                self.latency_log.flush()
+            if self.trace_log is not None:
+                self.trace_log.flush()
+            os.makedirs(self.latency_dir(), exist_ok=True)
+            self.read_hist.save(os.path.join(self.latency_dir(), f"hist_read_{self.host_name}.json"))
+            self.write_hist.save(os.path.join(self.latency_dir(), f"hist_write_{self.host_name}.json"))
+        except (IOError, OSError) as e:
+            print(f"Error writing to file: {e}")
+
+    async def flush_dirty(self, keys=None):
+        pass  # nothing is written back unless the app caches writes
+
+    def record_op(self, key, write, size):
+        if self.trace_log is None:
+            self.trace_log = TraceWriter(self.latency_dir(), self.node)
+        self.trace_log.record(self.clock() - self.load_started, OP_WRITE if write else OP_READ, key_id(key),
+                              size if write else 0)
+
+    async def do_operation(self, think=True, op=None):
+        # op: (key, is_write, value size) of a replayed trace, drawn from the workload otherwise
+        stream = self.load_stream()
+        key, write, size = op or stream.next()
+
+        if think:
+            await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep)
+
+        if self.record_trace:
+            self.record_op(key, write, size)
+        if write:
+            await self.set_data(key, stream.value(size))
+            return "write", key
+        elif op is None and self.read_batch > 1:
+            return await self.read_batched(key)
+        else: # read
+            await self.get_data(key)
+            return "read", key
+
+    async def read_batched(self, key):
+        # the reads that follow key in the stream join its batch, a write ends it
+        # and runs after it, so the stream's ops are the same as unbatched
+        stream = self.load_stream()
+        keys = [key]
+        while len(keys) < self.read_batch:
+            key, write, size = stream.next()
+            if self.record_trace:
+                self.record_op(key, write, size)
+            if write:
+                await self.get_many(keys)
+                await self.set_data(key, stream.value(size))
+                return "write", key
+            keys.append(key)
+        await self.get_many(keys)
+        return "read", keys[-1]
+
+    async def closed_loop(self):
+        while self.clock() < self.load_end:
+            await self.do_operation()
+
+    async def open_loop(self):
+        # Poisson arrivals at target_rate, issued whether or not earlier ops finished
+        in_flight = set()
+        arrival = self.clock() + random.expovariate(self.target_rate)
+        while arrival < self.load_end:
+            await asyncio.sleep(max(0, arrival - self.clock()))
+            task = asyncio.ensure_future(self.do_operation(think=False))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            arrival += random.expovariate(self.target_rate)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    async def generate_load(self, duration):
+        self.load_started = self.clock()
+        self.load_end = self.load_started + duration
+        if self.replay_root is not None:
+            await self.replay(node_ops(f"{self.replay_root}/{self.layers_traversed}/{self.read_probability}", self.node))
+        elif self.target_rate:
+            await self.open_loop()
+        else:
+            await asyncio.gather(*(self.closed_loop() for _ in range(self.workers)))
+        self.load_finished = self.clock()
+
+    async def replay(self, ops):
+        # at the recorded offsets from the load start, or as fast as the workers go
+        if self.replay_speed == "max":
+            ops = iter(ops)
+            async def client():
+                for _, key, write, size in ops:
+                    await self.do_operation(think=False, op=(key, write, size))
+            await asyncio.gather(*(client() for _ in range(self.workers)))
+            return
+        in_flight = set()
+        for offset, key, write, size in ops:
+            await asyncio.sleep(max(0, self.load_started + offset - self.clock()))
+            task = asyncio.ensure_future(self.do_operation(think=False, op=(key, write, size)))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.gather(*in_flight)
+
+    def throughput(self):
+        # achieved ops/s over the load period (so far, if still running)
+        if self.load_started is None:
+            return 0.0
+        elapsed = (self.load_finished or self.clock()) - self.load_started
+        return self.ops_completed / elapsed if elapsed > 0 else 0.0
+
+    async def run_simulation(self):
+        if self.is_last_node == False:
+            await self.generate_load(float("inf"))
+        else:
+            await self.generate_load(self.sim_time)
+            while (await self.publish_terminate() > 5):
+                await asyncio.sleep(1)
+            await self.stop_event_loop()
+
+    async def run_cell(self):
+        # persistent node (agent.py): join the coordinator's start barrier,
+        # run for sim_time from the common start, flush, then acknowledge
+        self.cell_start = asyncio.get_running_loop().create_future()
+        # past this the cell is over even for a coordinator that started without us
+        give_up = self.clock() + READY_TIMEOUT + START_DELAY + self.sim_time
+        while not self.cell_start.done():
+            if self.clock() >= give_up:
+                print(f"{self.host_name}: no START for cell {self.cell}, skipped")
+                return
+            # repeated until START, the coordinator keeps one READY per node
+            await self.publish_control(READY)
+            await asyncio.wait([self.cell_start], timeout=1)
+        start = self.cell_start.result()
+        await asyncio.sleep(max(0, start - self.clock()))
+        await self.generate_load(start + self.sim_time - self.clock())
+        await self.flush_dirty()
+        self.finish_cell()
+        await self.publish_control(FLUSHED)
+
+    def start_cell(self, cell, start):
+        if cell == self.cell and self.cell_start is not None and not self.cell_start.done():
+            self.cell_start.set_result(start)
+
+    async def publish_control(self, kind):
+        await self.home.publish(COORDINATOR_CHANNEL, encode_batch([encode_message(kind, self.node, self.cell)]))
@@ -8,6 +8,14 @@ import time
 import signal
 import os
 import sys
+import argparse
+import json
+from coherence_protocol import (decode_batch, encode_batch, encode_message, node_channel, sharers_key,
+                                DIRECTORY_CHANNEL, COORDINATOR_CHANNEL, UPDATE, INVALIDATE, UPDATE_INVALIDATE,
+                                TERMINATE, READY, START, FLUSHED, FETCHED, START_DELAY, READY_TIMEOUT, FLUSH_GRACE)
+from latency_store import node_name, HOME_NODE_ID
+from agent import DONE_MARKER, read_command
+from ids import key_name
 
 REDIS_PORT = 6379
 CHANNEL = "cache_updates"
@@ -18,7 +26,15 @@ class Manager:
         self.server = None
         self.pool = None
         self.pub_sub = None
+        self.directory = None  # Redis holding the sharer sets, home's own here
         self.loop = asyncio.get_event_loop()
+        self.invalidations_sent = 0  # targeted messages forwarded to sharers
+        self.publishes = 0
+        self.coordinating = False  # run barriers for network.py instead of exiting on TERMINATE
+        self.arrivals = {}  # (cell, READY or FLUSHED) -> node ids
+        self.starts = {}  # cell -> common start time, once START went out
+        self.arrival = asyncio.Condition()
+        self.clock = time.time
     
     async def create_manager_server(self, max_retries):
         tries = 0
@@ -27,8 +43,9 @@ class Manager:
             try:
                 self.pool = aioredis.BlockingConnectionPool(host="127.0.0.1", port=REDIS_PORT, health_check_interval=30, max_connections=500)
                 self.home = await aioredis.Redis(connection_pool=self.pool)
+                self.directory = self.home
                 self.pub_sub = self.home.pubsub()
-                await self.pub_sub.subscribe(CHANNEL)
+                await self.pub_sub.subscribe(CHANNEL, DIRECTORY_CHANNEL, COORDINATOR_CHANNEL)
                 break
             except RedisError as e:
                 print(f"Connection error: {e}. Retrying in {delay} seconds...")
@@ -41,21 +58,116 @@ class Manager:
         while True:
             await asyncio.sleep(random.uniform(0.1, 0.5))  # Add some Random sleep
     
-    async def stop_event_loop():
-        manager.pool.clear()
-        manager.server.close()
+    async def stop_event_loop(self):
+        print(f"manager: {self.invalidations_sent} targeted messages in {self.publishes} publishes")
+        await self.home.close()
         os._exit(1)
+
+    async def handle_directory(self, payload):
+        # Sharer sets live in the home Redis next to the data, readers join them
+        # atomically with their read (HomeStore). For every invalidation the
+        # sharers are read and reset to just the writer in one transaction,
+        # then each sharer gets one publish on its own channel. A node that
+        # filled the line from a peer (FETCHED) joins the sharers here.
+        messages = list(decode_batch(payload))
+        async with self.directory.pipeline(transaction=True) as pipe:
+            for command, origin, kid, value in messages:
+                key = sharers_key(key_name(kid))
+                pipe.smembers(key)
+                if command in (INVALIDATE, UPDATE_INVALIDATE):
+                    pipe.delete(key)
+                    pipe.sadd(key, origin)
+                elif command == FETCHED:
+                    pipe.sadd(key, origin)
+            results = await pipe.execute()
+
+        outgoing = {}
+        position = 0
+        for command, origin, kid, value in messages:
+            sharers = results[position]
+            if command in (INVALIDATE, UPDATE_INVALIDATE):
+                position += 3
+            else:
+                position += 2 if command == FETCHED else 1
+            for sharer in sharers:
+                target = int(sharer)
+                if target != origin:
+                    outgoing.setdefault(target, []).append(encode_message(command, origin, kid, value))
+
+        for target, forwarded in outgoing.items():
+            await self.home.publish(node_channel(node_name(target)), encode_batch(forwarded))
+            self.invalidations_sent += len(forwarded)
+            self.publishes += 1
     
+    async def handle_coordinator(self, payload):
+        late = set()
+        async with self.arrival:
+            for command, origin, cell, value in decode_batch(payload):
+                if command in (READY, FLUSHED):
+                    self.arrivals.setdefault((cell, command), set()).add(origin)
+                if command == READY and cell in self.starts:
+                    late.add(cell)
+            self.arrival.notify_all()
+        # a READY after the start gets the same START again, the node runs what is left of the cell
+        for cell in late:
+            await self.publish_start(cell)
+
+    async def publish_start(self, cell):
+        await self.home.publish(CHANNEL, encode_batch([encode_message(START, HOME_NODE_ID, cell, repr(self.starts[cell]))]))
+
+    async def wait_for(self, cell, kind, count, timeout):
+        # number of distinct nodes that sent kind for cell, once count() of them did or at the timeout
+        nodes = self.arrivals.setdefault((cell, kind), set())
+        async with self.arrival:
+            try:
+                await asyncio.wait_for(self.arrival.wait_for(lambda: len(nodes) >= count()), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return len(nodes)
+
+    async def coordinate_cell(self, cell, nodes, sim_time):
+        # start barrier: one common start time once every node is connected and reset
+        await self.wait_for(cell, READY, lambda: nodes, READY_TIMEOUT)
+        self.starts[cell] = self.clock() + START_DELAY
+        await self.publish_start(cell)
+        # stop barrier: every started node, late joiners included, acknowledges once its latencies are on disk
+        readies = self.arrivals[(cell, READY)]
+        flushed = await self.wait_for(cell, FLUSHED, lambda: len(readies), START_DELAY + sim_time + FLUSH_GRACE)
+        ready = len(readies)
+        del self.starts[cell]
+        self.arrivals.pop((cell, READY), None)
+        self.arrivals.pop((cell, FLUSHED), None)
+        return {"cell": cell, "nodes": nodes, "ready": ready, "flushed": flushed}
+
+    async def serve_cells(self):
+        # network.py writes {"cell", "nodes", "sim_time"} per cell to stdin and
+        # reads one DONE_MARKER line back when the cell is complete
+        while True:
+            command = await read_command()
+            if command.get("cmd") == "exit":
+                break
+            result = await self.coordinate_cell(command["cell"], command["nodes"], command["sim_time"])
+            print(DONE_MARKER + json.dumps(result), flush=True)
+        await self.stop_event_loop()
+
     async def listen_for_updates(self):
         while self.pub_sub != None:
             try:    
                 async for message in self.pub_sub.listen():
-                    if message['type'] == 'message':
-                        data = message['data'].decode().split('|')
-                        command = data[0]
-                        if command == "TERMINATE":
-                            # print(f"{self.host_name}: Received terminate process")
-                            await self.stop_event_loop()
+                    if message['type'] != 'message':
+                        continue
+                    channel = message['channel']
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    if channel == DIRECTORY_CHANNEL:
+                        await self.handle_directory(message['data'])
+                    elif channel == COORDINATOR_CHANNEL:
+                        await self.handle_coordinator(message['data'])
+                    else:
+                        for command, origin, kid, value in decode_batch(message['data']):
+                            if command == TERMINATE and not self.coordinating:
+                                # print(f"{self.host_name}: Received terminate process")
+                                await self.stop_event_loop()
             except aioredis.exceptions.ConnectionError as e:
                 print(f"Connection error: {e}")
                 await asyncio.sleep(5)
@@ -64,15 +176,23 @@ class Manager:
 
 async def run_event_loop(manager):
     loop = asyncio.get_event_loop()
+    await manager.create_manager_server(40)
 
-    simulation_task = loop.create_task(manager.handle_requests())
+    if manager.coordinating:
+        simulation_task = loop.create_task(manager.serve_cells())
+    else:
+        simulation_task = loop.create_task(manager.handle_requests())
     update_task = loop.create_task(manager.listen_for_updates())
 
     await asyncio.gather(simulation_task, update_task)
 
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="home manager: directory and run coordinator")
+    parser.add_argument("--coordinate", action="store_true", help="run start/stop barriers for cells read from stdin")
+    args = parser.parse_args()
     manager = Manager()
+    manager.coordinating = args.coordinate
     asyncio.run(run_event_loop(manager))
     
 
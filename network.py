@@ -7,11 +7,20 @@ from mininet.link import TCLink
 from mininet.log import setLogLevel
 import time
 from mininet.cli import CLI
-import multiprocessing as mp
+import json
+import queue
+import threading
+from subprocess import PIPE, STDOUT
+from agent import DONE_MARKER
+from coherence_protocol import START_DELAY, READY_TIMEOUT, FLUSH_GRACE
+from aggregate import aggregate, write_json, MANIFEST_FILE
+from sweep import load_plan, pending_cells, done_cells, mark_done, reset_cell
+from scenarios import scenario_tag, impairment_command
 from topology import DynamicTopology
-import matplotlib.pyplot as plt
+from plotting import (plot_graphs, plot_throughput_latency, plot_depth, plot_scenarios, cell_shard_load,
+                      summarize, PERCENTILES)
+from latency_histogram import LatencyHistogram, load_cell as load_hist_cell, load_cell_by_layer
 import os
-import random
 
 REDIS_PORT = 6379
 CHANNEL = "cache_updates"
@@ -37,23 +46,14 @@ def configure_cache(net):
   home.cmd("redis-cli CONFIG SET tcp-keepalive 1")
   home.cmd("redis-cli CONFIG SET proto-max-bulk-len 8000")
 
-def set_bandwidth(net, bw):
-  print(f"Setting bandwidth to {bw} Mbps")
+def set_impairment(net, scenario):
+  # bandwidth, loss and delay of every link at once (scenarios.py), replacing whatever was set before
+  print(f"Impairing links: {scenario_tag(scenario)}")
   for link in net.links:
-    link.intf1.config(bw=bw)
-    link.intf2.config(bw=bw)
-
-def set_packet_loss(net, loss_percent):
-  for link in net.links:
-    link.intf1.cmd(f"tc qdisc add dev {link.intf1.name} root netem loss {loss_percent}%")
-    link.intf2.cmd(f"tc qdisc add dev {link.intf2.name} root netem loss {loss_percent}%")
+    for intf in (link.intf1, link.intf2):
+      intf.cmd(impairment_command(intf.name, scenario))
   time.sleep(5)
 
-def set_packet_delay(net, delay_time):
-  for link in net.links:
-    link.intf1.cmd(f"tc qdisc add dev {link.intf1.name} root netem delay {delay_time}ms")
-    link.intf2.cmd(f"tc qdisc add dev {link.intf2.name} root netem delay {delay_time}ms")
-
 def remove_hops(topo, net, layer_removed):
   switch_name = topo.all_switches[topo.num_switch_layers - layer_removed]  # remove lowest layers -> upper layers
   print(f"switch_name:{switch_name}")
@@ -68,190 +68,270 @@ def add_hops(topo, net, layer_removed):
   switch.stop()
   net.waitConnected()
 
-def plot_graphs(all_read_latencies, all_write_latencies):
-  plt.figure(figsize=(10, 6))
-
-  read_probabilities = {}
-  for label, latencies in all_read_latencies.items():
-    parts = label.split(' - ')
-    num_servers = int(parts[0].split(' ')[0])
-    read_probability = float(parts[-1].split(' ')[0])
-    if read_probability not in read_probabilities:
-      read_probabilities[read_probability] = {'num_servers': [], 'average_latencies': []}
-    read_probabilities[read_probability]['num_servers'].append(num_servers)
-    read_probabilities[read_probability]['average_latencies'].append(np.mean(latencies) * 1000)
-
-  # Plot average latencies for each read probability
-  for read_probability, data in read_probabilities.items():
-    plt.plot(data['num_servers'], data['average_latencies'], marker='o', label=f'Read Fraction: {read_probability}')
-
-  plt.xlabel('Number of Servers')
-  plt.ylabel('Average Read Response Time [ms]')
-  plt.legend()
-  new_xticks = [x for x in plt.xticks()[0] if (x >= plt.xlim()[0] and x <= plt.xlim()[1])]
-  new_xticks.append(10)
-  plt.xticks(new_xticks)
-  plt.grid(True)
-  plt.savefig('read_response_time_baseline.pdf')
-
-  ## writes
-  plt.figure(figsize=(10, 6))
-
-  write_probabilities = {}
-  for label, latencies in all_write_latencies.items():
-    parts = label.split(' - ')
-    num_servers = int(parts[0].split(' ')[0])
-    write_probability = float(parts[-1].split(' ')[0])
-    if write_probability not in write_probabilities:
-      write_probabilities[write_probability] = {'num_servers': [], 'average_latencies': []}
-    write_probabilities[write_probability]['num_servers'].append(num_servers)
-    write_probabilities[write_probability]['average_latencies'].append(np.mean(latencies) * 1000)
-
-  # Plot average latencies for each read probability
-  for write_probability, data in write_probabilities.items():
-    plt.plot(data['num_servers'], data['average_latencies'], marker='o', label=f'Write Fraction: {write_probability}')
-
-  plt.xlabel('Number of Servers')
-  plt.ylabel('Average Write Response Time [ms]')
-  plt.legend()
-  plt.grid(True)
-  plt.ylim(ymin=0)
-  new_xticks = [x for x in plt.xticks()[0] if (x >= plt.xlim()[0] and x <= plt.xlim()[1])]
-  new_xticks.append(10)
-  plt.xticks(new_xticks)
-  plt.savefig('write_response_time_baseline.pdf')
-
-def make_latency_dirs(num_switch_layers, read_probabilities):
-  os.mkdir(f'./latencies2')
+def read_lines(process):
+  # stdout lines of process on a queue (None at EOF), so they can be waited for with a timeout
+  process.lines = queue.Queue()
+  def pump():
+    for line in process.stdout:
+      process.lines.put(line)
+    process.lines.put(None)
+  threading.Thread(target=pump, daemon=True).start()
+  return process
+
+def start_agents(net, agent_args, servers=()):
+  # one persistent agent.py per cache host for the whole sweep, servers (aggregators, home shards) excluded
+  agents = {}
+  for host in net.hosts:
+    if host.name != 'home' and host.name not in servers:
+      agents[host.name] = read_lines(host.popen(f"python3 agent.py {host.name} {agent_args}", stdin=PIPE, stdout=PIPE,
+                                                stderr=STDOUT, universal_newlines=True))
+  return agents
+
+def start_aggregators(net, aggregators, coherence, home_shards=()):
+  # aggregator_app keeps each aggregator's Redis coherent, for the whole sweep
+  shard_args = " ".join(str(layer) for layer in home_shards)
+  return [net.get(name).popen(f"python3 aggregator_app.py {name} --coherence {coherence} --home-shards {shard_args}")
+          for name in aggregators]
+
+def start_shard_managers(net, shards):
+  # manager_app on every extra home shard: directory of the keys it owns
+  return [net.get(name).popen("python3 manager_app.py") for name in shards]
+
+def start_coordinator(net):
+  # manager_app on home, persistent: run barriers and (directory mode) the directory
+  return read_lines(net.get('home').popen("python3 manager_app.py --coordinate", stdin=PIPE, stdout=PIPE,
+                                          stderr=STDOUT, universal_newlines=True))
+
+def send_command(agent, command):
+  agent.stdin.write(json.dumps(command) + "\n")
+  agent.stdin.flush()
+
+def wait_cell_done(name, agent, cell, timeout=None):
+  # the DONE_MARKER result of cell, None once timeout seconds passed without it;
+  # late results of earlier cells are skipped
+  deadline = None if timeout is None else time.time() + timeout
+  while True:
+    try:
+      line = agent.lines.get(timeout=None if deadline is None else max(0, deadline - time.time()))
+    except queue.Empty:
+      print(f"{name}: cell {cell} not done after {timeout} s, not waiting any longer")
+      return None
+    if line is None:
+      raise RuntimeError(f"{name} exited during a cell")
+    if line.startswith(DONE_MARKER):
+      result = json.loads(line[len(DONE_MARKER):])
+      if result["cell"] == cell:
+        return result
+    print(f"{name}: {line.rstrip()}")
+
+def stop_agents(agents):
+  for agent in agents.values():
+    try:
+      send_command(agent, {"cmd": "exit"})
+    except (BrokenPipeError, OSError):
+      pass  # host of a removed layer, its agent is already gone
+  for agent in agents.values():
+    agent.wait()
+
+def make_latency_dirs(num_switch_layers, read_probabilities, output_dir='./latencies2'):
+  # existing ones are kept, a resumed sweep writes into the same tree
   for layer in range(1, num_switch_layers + 1):
-    os.mkdir(f'./latencies2/{layer}')
     for read_probability in read_probabilities:
       # make dir for this read_prob run
-      os.mkdir(f'./latencies2/{layer}/{read_probability}')
-
-def plot_from_files(read_probabilities):
-  topo = DynamicTopology()
-  topo.create_network()
+      os.makedirs(f'{output_dir}/{layer}/{read_probability}', exist_ok=True)
 
+def plot_from_files(read_probabilities=None, output_dir="./latencies2", write_offset=0.032, workers=None):
+  # the finished cells of the run in output_dir as listed by its manifest, only
+  # cells whose files changed since the last call are parsed again
   all_read_latencies = {}
   all_write_latencies = {}
-  none_removed = True
 
-  for layers_traversed in range(1, topo.num_switch_layers + 1):
-    for read_probability in read_probabilities:
-      read_latencies = []
-      write_latencies = []
-
-      for filename in os.listdir(f"./latencies2/{layers_traversed}/{read_probability}"):
-        if filename.startswith("read"):
-          whole_path = os.path.join(f"./latencies2/{layers_traversed}/{read_probability}", filename)
-          with open(whole_path, "r") as f:
-            read_latencies_file = [float(line.strip()) for line in f]
-            read_latencies.extend(read_latencies_file)
-        elif filename.startswith("write"):
-          whole_path = os.path.join(f"./latencies2/{layers_traversed}/{read_probability}", filename)
-          with open(whole_path, "r") as f:
-            write_latencies_file = [float(line.strip()) for line in f]
-            write_latencies_file = [write + 0.032 for write in write_latencies_file]
-            write_latencies.extend(write_latencies_file)
-      num_servers_this_layer = topo.all_hosts if none_removed == True else topo.all_hosts - (topo.hosts_per_switch * (layers_traversed - 1))
-      all_read_latencies[f"{num_servers_this_layer} Servers - {read_probability} Read"] = read_latencies
-      if (read_probability != 1.0):
-        all_write_latencies[f"{num_servers_this_layer} Servers - {Decimal('1') - Decimal(str(read_probability))} Write"] = write_latencies
-      none_removed = False
-  
+  for cell, summary in aggregate(output_dir, write_offset, workers):
+    read_probability = cell["read_probability"]
+    if read_probabilities is not None and read_probability not in read_probabilities:
+      continue
+    all_read_latencies[f"{cell['servers']} Servers - {read_probability} Read"] = summary["read"]
+    if (read_probability != 1.0):
+      all_write_latencies[f"{cell['servers']} Servers - {Decimal('1') - Decimal(str(read_probability))} Write"] = summary["write"]
+
   plot_graphs(all_read_latencies, all_write_latencies)
 
 
-def run(read_probabilities, simulation_time):
+def plot_depth_from_files(read_probability, modes):
+  # modes: {label: output_dir of a run()}, e.g. {"flat": "./latencies2", "5 layers per aggregator": "./latencies_agg5"};
+  # compares the first cell of each run, all layers active
+  for kind in ("read", "write"):
+    by_mode = {label: load_cell_by_layer(f"{output_dir}/1/{read_probability}", kind) for label, output_dir in modes.items()}
+    plot_depth(by_mode, kind.capitalize(), name=f"{read_probability}")
+
+def run(read_probabilities, simulation_time, coherence="broadcast", workers=1, read_batch=1, target_rate=None, nodes_per_host=1,
+        write_policy="write-back", protocol="adaptive", state_machine="MESI", aggregation=None,
+        home_shards=(), tracking="default", workload=None, record_trace=False, replay=None, replay_speed="original",
+        cells=None, impairment=None, output_dir="./latencies2", name="baseline"):
+  # workload: workload.Workload arguments for every cell, or a function of
+  # (layers_traversed, read_probability) returning them per cell
+  # record_trace keeps every cell's ops in trace.bin, replay (the output_dir of
+  # such a run) drives the nodes from those instead, at replay_speed
+  # Restarting with the same output_dir and settings resumes the sweep at its
+  # first unfinished cell; cells (cell numbers or (layers_traversed,
+  # read_probability) pairs) runs only those of the plan
+  # impairment: scenarios.py link scenario applied to every link for the whole sweep
   setLogLevel("debug")
 
-  topo = DynamicTopology()
+  topo = DynamicTopology(aggregation, home_shards)
   topo.create_network()
 
-  all_read_latencies = {}
-  all_write_latencies = {}
+  agent_args = f"--coherence {coherence} --workers {workers} --nodes {nodes_per_host} --write-policy {write_policy}"
+  agent_args += f" --protocol {protocol} --state-machine {state_machine} --output-dir {output_dir}"
+  if coherence == "tracking":
+    agent_args += f" --tracking {tracking}"  # home's redis-server pushes the invalidations, version 6 or later
+  if aggregation:
+    agent_args += f" --aggregation {aggregation}"
+  if home_shards:
+    agent_args += " --home-shards " + " ".join(str(layer) for layer in home_shards)
+  if read_batch > 1:
+    agent_args += f" --read-batch {read_batch}"
+  if target_rate:
+    agent_args += f" --rate {target_rate}"
+  if record_trace:
+    agent_args += " --record-trace"
+  if replay:
+    agent_args += f" --replay {replay} --replay-speed {replay_speed}"
+
+  # the plan is checked before anything is started, a mismatch raises right away
+  make_latency_dirs(topo.num_switch_layers, read_probabilities, output_dir)
+  settings = {"simulation_time": simulation_time, "agent_args": agent_args, "nodes_per_host": nodes_per_host,
+              "workload": getattr(workload, "__name__", workload), "impairment": impairment}
+  plan = load_plan(output_dir, topo.num_switch_layers, read_probabilities, settings)
+  # the sweep layout for plot_from_files, cells are added as they finish
+  manifest = {"name": name, "num_switch_layers": topo.num_switch_layers, "hosts_per_switch": topo.hosts_per_switch,
+              "all_hosts": topo.all_hosts, "nodes_per_host": nodes_per_host, "read_probabilities": list(read_probabilities),
+              "coherence": coherence, "aggregation": aggregation, "home_shards": list(home_shards),
+              "cells": done_cells(plan, output_dir)}
+  write_json(f"{output_dir}/{MANIFEST_FILE}", manifest)
 
   # Start with all servers active
   net = Mininet(topo=topo, switch=OVSSwitch, waitConnected=True, link=TCLink)
   net.start()
-  configure_cache(net)
-  make_latency_dirs(topo.num_switch_layers, read_probabilities)
-  # CLI(net)
-
-  curr_layer_removed = 0
-  layers_removed = 0
-
-  for layers_traversed in range(1, topo.num_switch_layers + 1):
-    for read_probability in read_probabilities:
-      processes = []
-
-      for i, host in enumerate(net.hosts):
-        if host.name != 'home':
+  try:
+    configure_cache(net)
+    if impairment is not None:
+      set_impairment(net, impairment)
+    coordinator = start_coordinator(net)
+    aggregators = start_aggregators(net, topo.aggregators, coherence, home_shards)
+    shard_managers = start_shard_managers(net, topo.shards)
+    servers = topo.aggregators + topo.shards
+    agents = start_agents(net, agent_args, servers)
+    # CLI(net)
+
+    curr_layer_removed = 0
+    layers_removed = 0
+
+    for entry in pending_cells(plan, output_dir, cells):
+      cell, layers_traversed, read_probability = entry["cell"], entry["layers_traversed"], entry["read_probability"]
+      # switches of the layers before this one, removed bottom up as after each layer of a full sweep
+      while layers_removed < layers_traversed - 1:
+        layers_removed += 1
+        curr_layer_removed = remove_hops(topo, net, layers_removed)
+      reset_cell(output_dir, entry)
+      active = []
+      # shards of removed layers leave the ring, their keys move to the remaining ones
+      shards = [shard for shard, layer in zip(topo.shards, topo.home_shards) if curr_layer_removed == 0 or layer < curr_layer_removed]
+      command = {"cell": cell, "read_probability": read_probability, "layers_traversed": layers_traversed,
+                 "sim_time": simulation_time, "home_shards": shards}
+      if workload is not None:
+        command["workload"] = workload(layers_traversed, read_probability) if callable(workload) else workload
+
+      for host in net.hosts:
+        if host.name != 'home' and host.name not in servers:
           num_hosts_this_layer = (topo.all_hosts - (layers_removed * topo.hosts_per_switch))
           print(num_hosts_this_layer)
           split = host.name.split('_')
           if curr_layer_removed and int(split[0][1:]) < curr_layer_removed or curr_layer_removed == 0:
-            is_last_node = (i == num_hosts_this_layer) 
-            cmd = f"python3 cache_app.py {host.name} {read_probability} {layers_traversed} {is_last_node} {simulation_time}"
-            process = mp.Process(target=host.cmd, args=(cmd,))
-            processes.append(process)
-        # else:
-        #   cmd = f"python3 manager_app.py"
-        #   process = mp.Process(target=host.cmd, args=(cmd,))
-        #   process.start()
-
-      # Start all node processes
-      for process in processes:
-        if (layers_traversed in [x for x in range(1, 8)]):
-          time.sleep(0.3)
-        process.start()
-        
-      while any(process.is_alive() for process in processes): # wait until all are dead
-        time.sleep(0.1)
-
-      read_latencies = []
-      write_latencies = []
-
-      for filename in os.listdir(f"./latencies2/{layers_traversed}/{read_probability}"):
-        if filename.startswith("read"):
-          whole_path = os.path.join(f"./latencies2/{layers_traversed}/{read_probability}", filename)
-          with open(whole_path, "r") as f:
-            read_latencies_file = [float(line.strip()) for line in f]
-            read_latencies.extend(read_latencies_file)
-        elif filename.startswith("write"):
-          whole_path = os.path.join(f"./latencies2/{layers_traversed}/{read_probability}", filename)
-          with open(whole_path, "r") as f:
-            write_latencies_file = [float(line.strip()) for line in f]
-            write_latencies.extend(write_latencies_file)
-        
+            send_command(agents[host.name], command)
+            active.append(host.name)
+
+      # the coordinator starts every node at the same instant and reports once
+      # each of them has acknowledged its flush
+      send_command(coordinator, {"cell": cell, "nodes": len(active) * nodes_per_host, "sim_time": simulation_time})
+      result = wait_cell_done("coordinator", coordinator, cell)
+      if result["flushed"] < result["nodes"]:
+        print(f"cell {cell}: only {result['flushed']} of {result['nodes']} nodes flushed")
+      # agents that never got START give up by themselves, this is only for the ones that hang
+      for name in active:
+        wait_cell_done(name, agents[name], cell, READY_TIMEOUT + START_DELAY + simulation_time + FLUSH_GRACE)
+
+      cell_dir = f"{output_dir}/{layers_traversed}/{read_probability}"
       num_servers_this_layer = topo.all_hosts if curr_layer_removed == 0 else topo.all_hosts - (topo.hosts_per_switch * (layers_traversed - 1))
-
-      all_read_latencies[f"{num_servers_this_layer} Servers - {read_probability} Read"] = read_latencies
+      num_servers_this_layer *= nodes_per_host
+      for shard, load in sorted(cell_shard_load(cell_dir).items()):
+        print(f"cell {cell} shard {shard}: {load['requests']} requests, {load['keys']} keys, {load['mean_latency'] * 1000:.3f} ms mean")
+      mark_done(output_dir, entry, {"servers": num_servers_this_layer, "flushed": result["flushed"], "nodes": result["nodes"]})
+      manifest["cells"] = done_cells(plan, output_dir)
+      write_json(f"{output_dir}/{MANIFEST_FILE}", manifest)
+
+    stop_agents(agents)
+    send_command(coordinator, {"cmd": "exit"})
+    coordinator.wait()
+    for server in aggregators + shard_managers:
+      server.terminate()
+
+    # every finished cell of the plan, this start's and earlier ones; merged
+    # per-node histograms, constant size no matter how long the cell ran
+    all_read_latencies = {}
+    all_write_latencies = {}
+    for entry in manifest["cells"]:
+      cell_dir = f"{output_dir}/{entry['layers_traversed']}/{entry['read_probability']}"
+      read_probability, servers = entry["read_probability"], entry["servers"]
+      read_latencies = load_hist_cell(cell_dir, "read")
+      all_read_latencies[f"{servers} Servers - {read_probability} Read"] = read_latencies
       if (read_probability != 1.0):
-        all_write_latencies[f"{num_servers_this_layer} Servers - {Decimal('1') - Decimal(str(read_probability))} Write"] = write_latencies
-
-    print(f"finished {topo.num_switch_layers - layers_traversed}th layer execution")
-    # Remove nodes by layer (bottom up)
-    if topo.num_switch_layers - layers_traversed != 0:
-      curr_layer_removed = remove_hops(topo, net, layers_traversed)
-    layers_removed += 1
-  
-  for read in read_probabilities:
-    all_read_latencies[f"0 Servers - {read} Read"] = [0]
-    all_write_latencies[f"0 Servers - {Decimal('1') - Decimal(str(read))} Write"] = [0]
+        all_write_latencies[f"{servers} Servers - {Decimal('1') - Decimal(str(read_probability))} Write"] = load_hist_cell(cell_dir, "write")
+
+    for read in read_probabilities:
+      all_read_latencies[f"0 Servers - {read} Read"] = [0]
+      all_write_latencies[f"0 Servers - {Decimal('1') - Decimal(str(read))} Write"] = [0]
+
+    plot_graphs(all_read_latencies, all_write_latencies, name=name)
+  finally:
+    net.stop()
+
+def run_scenarios(scenarios, read_probabilities, simulation_time, cells=None, output_dir="./scenarios", name="baseline",
+                  **options):
+  # one run() per link scenario into <output_dir>/<scenario tag>, by default only the
+  # cells with every layer active; options are run()'s. Each scenario resumes on its own.
+  cells = cells if cells is not None else [(1, read_probability) for read_probability in read_probabilities]
+  results = {}
+  for scenario in scenarios:
+    tag = scenario_tag(scenario)
+    scenario_dir = f"{output_dir}/{tag}"
+    run(read_probabilities, simulation_time, cells=cells, impairment=scenario, output_dir=scenario_dir,
+        name=f"{name}_{tag}", **options)
+    results[tag] = dict(scenario, cells=[])
+    for cell, summary in aggregate(scenario_dir, write_offset=0.0):
+      (read_mean, read_tails), (write_mean, write_tails) = summarize(summary["read"]), summarize(summary["write"])
+      results[tag]["cells"].append(dict(cell, throughput=summary["throughput"], read_mean=read_mean, read_tails=read_tails,
+                                        write_mean=write_mean, write_tails=write_tails))
+  write_json(f"{output_dir}/scenarios.json", {"percentiles": PERCENTILES, "scenarios": results})
+  plot_scenarios(results, name=name)
+  return results
+
+def run_load_sweep(target_rates, read_probability, simulation_time, output_dir="./load_sweep", name="baseline", **options):
+  # one run() per open-loop rate into <output_dir>/rate_<rate>, every layer at
+  # read_probability; options are run()'s. Achieved throughput against read
+  # and write latency, one curve per layer as discrete_sim.run_load_sweep draws it
+  curves = {}
+  for rate in target_rates:
+    rate_dir = f"{output_dir}/rate_{rate}"
+    run([read_probability], simulation_time, target_rate=rate, output_dir=rate_dir, name=f"{name}_rate_{rate}", **options)
+    for cell, summary in aggregate(rate_dir, write_offset=0.0):
+      latencies = LatencyHistogram()
+      latencies.merge(summary["read"])
+      latencies.merge(summary["write"])
+      curves.setdefault(f"{cell['servers']} Servers", []).append((summary["throughput"], latencies))
+  plot_throughput_latency(curves, name=name)
+  return curves
 
-  plot_graphs(all_read_latencies, all_write_latencies)
-    
-  bw = random.uniform(0.1, 10)  # random bandwidth between 1 and 10 Mbps
-  set_bandwidth(net, bw)
-  pl = random.randint(0, 20) # pkt loss percentage
-  set_packet_loss(net, pl) 
-  dt = random.randint(0, 10) # delay time 1 - 10ms
-  set_packet_delay(net, dt)
-  layers_removed = random.randint(2, len(net.switches))
-  remove_hops(topo, layers_removed) # remove layers # update active switches
-    
 if __name__ == "__main__":
   read_probabilities = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2] 
   # test = [0.8, 0.2]
@@ -0,0 +1,58 @@
+import os
+import struct
+import numpy as np
+from ids import key_name
+from latency_store import write_all, OP_WRITE
+
+# Operation traces, one per cell next to ops.bin: what every node issued and
+# when, so a cell can be driven again with exactly the same input.
+# offset from the node's load start [s], node id, op, key id, value size -> 21 bytes
+TRACE_RECORD = struct.Struct("<dIBII")
+TRACE_DTYPE = np.dtype([("offset", "<f8"), ("node", "<u4"), ("op", "u1"), ("key", "<u4"), ("value_size", "<u4")])
+TRACE_FILE = "trace.bin"
+
+
+# Same single O_APPEND write per flush as LatencyWriter, nodes share the file
+class TraceWriter:
+    def __init__(self, cell_dir, node, flush_every=4096):
+        self.path = os.path.join(cell_dir, TRACE_FILE)
+        self.node = node
+        self.flush_every = flush_every
+        self.buffer = bytearray()
+        self.pending = 0
+        self.recorded = 0
+
+    def record(self, offset, op, kid, value_size):
+        self.buffer += TRACE_RECORD.pack(offset, self.node, op, kid, value_size)
+        self.pending += 1
+        self.recorded += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            write_all(fd, self.buffer)
+        finally:
+            os.close(fd)
+        self.buffer = bytearray()
+        self.pending = 0
+
+
+def open_trace(cell_dir):
+    path = os.path.join(cell_dir, TRACE_FILE)
+    if not os.path.exists(path) or os.path.getsize(path) < TRACE_RECORD.size:
+        return np.zeros(0, dtype=TRACE_DTYPE)
+    return np.memmap(path, dtype=TRACE_DTYPE, mode="r", shape=(os.path.getsize(path) // TRACE_RECORD.size,))
+
+
+def node_ops(cell_dir, node):
+    # [(offset, key, is_write, value size)] of one node in issue order
+    records = open_trace(cell_dir)
+    records = np.sort(records[records["node"] == node], order="offset", kind="stable")
+    return [(offset, key_name(kid), op == OP_WRITE, size)
+            for offset, op, kid, size in zip(records["offset"].tolist(), records["op"].tolist(),
+                                             records["key"].tolist(), records["value_size"].tolist())]
@@ -0,0 +1,199 @@
+import glob
+import json
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+from latency_histogram import LatencyHistogram
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+def summarize(latencies):
+  # mean and tail percentiles [s] of a LatencyHistogram or a plain sequence
+  if isinstance(latencies, LatencyHistogram):
+    return latencies.mean(), [latencies.percentile(p) for p in PERCENTILES]
+  values = np.asarray(latencies, dtype=float)
+  if values.size == 0:
+    return 0.0, [0.0] * len(PERCENTILES)
+  return float(values.mean()), list(np.percentile(values, PERCENTILES))
+
+def cdf_points(latencies):
+  if isinstance(latencies, LatencyHistogram):
+    points = latencies.cdf()
+    return [x for x, _ in points], [y for _, y in points]
+  values = np.sort(np.asarray(latencies, dtype=float))
+  return values, np.arange(1, values.size + 1) / max(values.size, 1)
+
+def cell_throughput(cell_dir):
+  # achieved ops/s of a cell, summed over the nodes' stats_<host>.json
+  total = 0.0
+  for path in glob.glob(os.path.join(cell_dir, "stats_*.json")):
+    with open(path) as f:
+      total += json.load(f).get("throughput", 0.0)
+  return total
+
+def cell_shard_load(cell_dir):
+  # per home shard: requests, keys and mean request latency [s] of a cell, over all nodes
+  load = {}
+  for path in glob.glob(os.path.join(cell_dir, "stats_*.json")):
+    with open(path) as f:
+      shards = json.load(f).get("shards", {})
+    for name, stats in shards.items():
+      total = load.setdefault(name, {"requests": 0, "keys": 0, "latency_sum": 0.0})
+      total["requests"] += stats["requests"]
+      total["keys"] += stats["keys_read"] + stats["keys_written"]
+      total["latency_sum"] += stats["mean_latency"] * stats["requests"]
+  for total in load.values():
+    total["mean_latency"] = total.pop("latency_sum") / total["requests"] if total["requests"] else 0.0
+  return load
+
+def plot_throughput_latency(curves, name="baseline"):
+  # curves: {label: [(throughput, latencies), ...]}, one curve per layer
+  fig, (ax_mean, ax_tail) = plt.subplots(1, 2, figsize=(14, 6))
+  for label, points in curves.items():
+    points = sorted(points, key=lambda point: point[0])
+    throughputs = [throughput for throughput, _ in points]
+    summaries = [summarize(latencies) for _, latencies in points]
+    ax_mean.plot(throughputs, [mean * 1000 for mean, _ in summaries], marker='o', label=label)
+    ax_tail.plot(throughputs, [tails[PERCENTILES.index(99)] * 1000 for _, tails in summaries], marker='o', label=label)
+  for ax, title in ((ax_mean, 'Average'), (ax_tail, 'p99')):
+    ax.set_xlabel('Throughput [ops/s]')
+    ax.set_ylabel(f'{title} Response Time [ms]')
+    ax.grid(True)
+  ax_mean.legend(fontsize='small')
+  fig.tight_layout()
+  fig.savefig(f'throughput_latency_{name}.pdf')
+
+def plot_depth(by_mode, kind, name="baseline"):
+  # by_mode: {label: {switch layer: latencies}}, mean and p99 against the depth of the node
+  fig, (ax_mean, ax_tail) = plt.subplots(1, 2, figsize=(14, 6))
+  for label, layers in by_mode.items():
+    depths = sorted(layers)
+    summaries = [summarize(layers[depth]) for depth in depths]
+    ax_mean.plot(depths, [mean * 1000 for mean, _ in summaries], marker='o', label=label)
+    ax_tail.plot(depths, [tails[PERCENTILES.index(99)] * 1000 for _, tails in summaries], marker='o', label=label)
+  for ax, title in ((ax_mean, 'Average'), (ax_tail, 'p99')):
+    ax.set_xlabel('Switch Layer of the Node')
+    ax.set_ylabel(f'{title} {kind} Response Time [ms]')
+    ax.grid(True)
+  ax_mean.legend(fontsize='small')
+  fig.tight_layout()
+  fig.savefig(f'{kind.lower()}_depth_{name}.pdf')
+
+def plot_scenarios(results, name="baseline"):
+  # results: {scenario tag: {"cells": [cell summaries]}} of network.run_scenarios, mean and
+  # p99 read and write latency per scenario, one line per read fraction of the cells
+  tags = list(results)
+  fig, axes = plt.subplots(2, 2, figsize=(14, 10), sharex=True)
+  for row, kind in enumerate(("read", "write")):
+    by_fraction = {}
+    for x, tag in enumerate(tags):
+      for cell in results[tag]["cells"]:
+        if kind == "write" and cell["read_probability"] == 1.0:
+          continue
+        line = by_fraction.setdefault(cell["read_probability"], ([], [], []))
+        line[0].append(x)
+        line[1].append(cell[f"{kind}_mean"] * 1000)
+        line[2].append(cell[f"{kind}_tails"][PERCENTILES.index(99)] * 1000)
+    for fraction, (xs, means, tails) in sorted(by_fraction.items()):
+      axes[row][0].plot(xs, means, marker='o', label=f'Read Fraction: {fraction}')
+      axes[row][1].plot(xs, tails, marker='o', label=f'Read Fraction: {fraction}')
+    for ax, title in zip(axes[row], ('Average', 'p99')):
+      ax.set_ylabel(f'{title} {kind.capitalize()} Response Time [ms]')
+      ax.grid(True)
+  for ax in axes[1]:
+    ax.set_xticks(range(len(tags)))
+    ax.set_xticklabels(tags, rotation=45, ha='right', fontsize='small')
+  axes[0][0].legend(fontsize='small')
+  fig.tight_layout()
+  fig.savefig(f'scenarios_{name}.pdf')
+
+def plot_tails(groups, kind, name):
+  # one panel per percentile, one line per read/write fraction
+  fig, axes = plt.subplots(2, 2, figsize=(12, 8), sharex=True)
+  for ax, (i, p) in zip(axes.flat, enumerate(PERCENTILES)):
+    for fraction, data in groups.items():
+      ax.plot(data['num_servers'], [tails[i] * 1000 for tails in data['percentiles']], marker='o', label=f'{kind} Fraction: {fraction}')
+    ax.set_title(f'p{p}')
+    ax.set_xlabel('Number of Servers')
+    ax.set_ylabel(f'{kind} Response Time [ms]')
+    ax.grid(True)
+  axes.flat[0].legend(fontsize='small')
+  fig.tight_layout()
+  fig.savefig(f'{kind.lower()}_percentiles_{name}.pdf')
+
+def plot_cdfs(groups, kind, name):
+  # latency CDF of the largest cluster for every read/write fraction
+  plt.figure(figsize=(10, 6))
+  for fraction, data in groups.items():
+    largest = int(np.argmax(data['num_servers']))
+    xs, ys = cdf_points(data['latencies'][largest])
+    plt.plot(np.asarray(xs) * 1000, ys, label=f'{kind} Fraction: {fraction} ({data["num_servers"][largest]} Servers)')
+  plt.xscale('log')
+  plt.xlabel(f'{kind} Response Time [ms]')
+  plt.ylabel('CDF')
+  plt.legend()
+  plt.grid(True)
+  plt.savefig(f'{kind.lower()}_cdf_{name}.pdf')
+
+def plot_graphs(all_read_latencies, all_write_latencies, name="baseline"):
+  plt.figure(figsize=(10, 6))
+
+  read_probabilities = {}
+  for label, latencies in all_read_latencies.items():
+    parts = label.split(' - ')
+    num_servers = int(parts[0].split(' ')[0])
+    read_probability = float(parts[-1].split(' ')[0])
+    if read_probability not in read_probabilities:
+      read_probabilities[read_probability] = {'num_servers': [], 'average_latencies': [], 'percentiles': [], 'latencies': []}
+    mean, tails = summarize(latencies)
+    read_probabilities[read_probability]['num_servers'].append(num_servers)
+    read_probabilities[read_probability]['average_latencies'].append(mean * 1000)
+    read_probabilities[read_probability]['percentiles'].append(tails)
+    read_probabilities[read_probability]['latencies'].append(latencies)
+
+  # Plot average latencies for each read probability
+  for read_probability, data in read_probabilities.items():
+    plt.plot(data['num_servers'], data['average_latencies'], marker='o', label=f'Read Fraction: {read_probability}')
+
+  plt.xlabel('Number of Servers')
+  plt.ylabel('Average Read Response Time [ms]')
+  plt.legend()
+  new_xticks = [x for x in plt.xticks()[0] if (x >= plt.xlim()[0] and x <= plt.xlim()[1])]
+  new_xticks.append(10)
+  plt.xticks(new_xticks)
+  plt.grid(True)
+  plt.savefig(f'read_response_time_{name}.pdf')
+  plot_tails(read_probabilities, 'Read', name)
+  plot_cdfs(read_probabilities, 'Read', name)
+
+  ## writes
+  plt.figure(figsize=(10, 6))
+
+  write_probabilities = {}
+  for label, latencies in all_write_latencies.items():
+    parts = label.split(' - ')
+    num_servers = int(parts[0].split(' ')[0])
+    write_probability = float(parts[-1].split(' ')[0])
+    if write_probability not in write_probabilities:
+      write_probabilities[write_probability] = {'num_servers': [], 'average_latencies': [], 'percentiles': [], 'latencies': []}
+    mean, tails = summarize(latencies)
+    write_probabilities[write_probability]['num_servers'].append(num_servers)
+    write_probabilities[write_probability]['average_latencies'].append(mean * 1000)
+    write_probabilities[write_probability]['percentiles'].append(tails)
+    write_probabilities[write_probability]['latencies'].append(latencies)
+
+  # Plot average latencies for each read probability
+  for write_probability, data in write_probabilities.items():
+    plt.plot(data['num_servers'], data['average_latencies'], marker='o', label=f'Write Fraction: {write_probability}')
+
+  plt.xlabel('Number of Servers')
+  plt.ylabel('Average Write Response Time [ms]')
+  plt.legend()
+  plt.grid(True)
+  plt.ylim(ymin=0)
+  new_xticks = [x for x in plt.xticks()[0] if (x >= plt.xlim()[0] and x <= plt.xlim()[1])]
+  new_xticks.append(10)
+  plt.xticks(new_xticks)
+  plt.savefig(f'write_response_time_{name}.pdf')
+  plot_tails(write_probabilities, 'Write', name)
+  plot_cdfs(write_probabilities, 'Write', name)
@@ -0,0 +1,136 @@
+from coherence_protocol import UPDATE, INVALIDATE
+
+
+class _KeyStats:
+    __slots__ = ("reads", "writes", "remote_writes", "unread_updates", "sharers", "home_sharers", "announced")
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.remote_writes = 0
+        self.unread_updates = 0  # updates installed since the last local read
+        self.sharers = set()  # other nodes that announced a fill (FETCHED) or wrote it
+        self.home_sharers = 0  # other sharers home reported at our last fill (directory coherence)
+        self.announced = False  # our own fill was announced
+
+
+# Per-key choice between write-invalidate and write-update, kept only under
+# the adaptive policy.
+# Writer side: a key is sent as UPDATE (value installed by the receivers) when
+# its sharers read it at least read_write_ratio times per write (own and
+# peers') and it has at least one other sharer (and at most max_update_peers,
+# if set), otherwise as INVALIDATE. The sharers' reads are estimated as ours
+# times their number. The sharers are the nodes that announced a fill of the
+# key or wrote it, or home's sharer count where directory coherence has one;
+# a node announces only its first fill of a key peers write, so there is one
+# announcement per reader and key rather than one per fill.
+# Receiver side (competitive update): an installed update that is not read
+# before update_limit further updates arrive turns into an invalidation, so
+# nodes that stopped reading a key stop paying for its values.
+class ProtocolSelector:
+    def __init__(self, policy="adaptive", read_write_ratio=1.0, max_update_peers=None, update_limit=3, window=64):
+        self.policy = policy  # "adaptive", "invalidate" or "update"
+        self.read_write_ratio = read_write_ratio
+        self.max_update_peers = max_update_peers
+        self.update_limit = update_limit
+        self.window = window  # counts are halved past this many accesses, to follow phase changes
+        self.keys = {}
+        self.updates_sent = 0
+        self.invalidations_sent = 0
+        self.updates_installed = 0
+        self.updates_refused = 0
+
+    def _stats(self, kid):
+        stats = self.keys.get(kid)
+        if stats is None:
+            stats = self.keys[kid] = _KeyStats()
+        return stats
+
+    def adaptive(self):
+        return self.policy == "adaptive"
+
+    def _age(self, stats):
+        if stats.reads + stats.writes + stats.remote_writes > self.window:
+            stats.reads //= 2
+            stats.writes //= 2
+            stats.remote_writes //= 2
+
+    def read(self, kid):
+        if not self.adaptive():
+            return
+        stats = self._stats(kid)
+        stats.reads += 1
+        stats.unread_updates = 0
+        self._age(stats)
+
+    def write(self, kid):
+        if not self.adaptive():
+            return
+        stats = self._stats(kid)
+        stats.writes += 1
+        self._age(stats)
+
+    def remote_write(self, kid, origin):
+        if not self.adaptive():
+            return
+        stats = self._stats(kid)
+        stats.remote_writes += 1
+        stats.sharers.add(origin)
+        self._age(stats)
+
+    def fetched(self, kid, origin):
+        if self.adaptive():
+            self._stats(kid).sharers.add(origin)
+
+    def filled(self, kid, sharers):
+        # sharers: home's count for the line including us, 0 if unknown
+        if self.adaptive():
+            self._stats(kid).home_sharers = max(sharers - 1, 0)
+
+    def announce_fill(self, kid):
+        # True for our first fill of a key peers write
+        stats = self.keys.get(kid)
+        if not self.adaptive() or stats is None or stats.remote_writes == 0 or stats.announced:
+            return False
+        stats.announced = True
+        return True
+
+    def sharers(self, kid):
+        stats = self._stats(kid)
+        return max(len(stats.sharers), stats.home_sharers)
+
+    def mode(self, kid):
+        # message type for a local write of kid
+        if self.policy == "update":
+            kind = UPDATE
+        elif self.policy == "invalidate":
+            kind = INVALIDATE
+        else:
+            stats = self._stats(kid)
+            writes = max(stats.writes + stats.remote_writes, 1)
+            sharers = self.sharers(kid)
+            shared = sharers > 0 and (self.max_update_peers is None or sharers <= self.max_update_peers)
+            kind = UPDATE if shared and stats.reads * (sharers + 1) >= self.read_write_ratio * writes else INVALIDATE
+        if kind == UPDATE:
+            self.updates_sent += 1
+        else:
+            self.invalidations_sent += 1
+        return kind
+
+    def accept_update(self, kid, origin):
+        # True: install the received value, False: invalidate instead
+        if not self.adaptive():
+            self.updates_installed += 1
+            return True
+        self.remote_write(kid, origin)
+        stats = self._stats(kid)
+        if stats.unread_updates >= self.update_limit:
+            self.updates_refused += 1
+            return False
+        stats.unread_updates += 1
+        self.updates_installed += 1
+        return True
+
+    def stats(self):
+        return {"policy": self.policy, "updates_sent": self.updates_sent, "invalidations_sent": self.invalidations_sent,
+                "updates_installed": self.updates_installed, "updates_refused": self.updates_refused}
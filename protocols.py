@@ -0,0 +1,96 @@
+from cache_state import INVALID, SHARED, EXCLUSIVE, MODIFIED, OWNED, FORWARD
+from ids import LOGICAL_STRIDE
+
+# Events of the per-key state machine
+FILL_HOME = 0  # miss served by the home node
+FILL_PEER = 1  # miss served from a forwarder's local Redis
+WRITE = 2
+EVICT = 3  # valid state but the local copy is gone
+PEER_FETCH = 4  # another node filled the line from us
+PEER_WRITE = 5  # invalidation from another writer
+PEER_UPDATE = 6  # value installed from another writer (write-update)
+FILL_EXCLUSIVE = 7  # miss served by home with no other sharer (directory coherence)
+
+HOME_LAYER = -1  # home hangs one link above s0
+AGGREGATOR_INDEX = 199  # s<L>_n199 (10.0.L.200) is the aggregator cache on switch L
+SHARD_INDEX = 200  # extra home shard k on switch L is s<L>_n<200+k> (10.0.L.<201+k>)
+
+
+# Table-driven coherence protocol: (state, event) -> next state, pairs not in
+# the table keep their state. Holders in a forwarders state serve the misses
+# of other nodes directly from their local Redis. Exclusive is only entered
+# with directory coherence, where home knows the line has no other sharer,
+# and is left for Shared once a second sharer announces itself.
+class Protocol:
+    def __init__(self, name, transitions, forwarders=()):
+        self.name = name
+        self.transitions = transitions
+        self.forwarders = frozenset(forwarders)
+        # MESIF hands the forwarder role to the node that fetched the line
+        self.fetch_moves_forwarder = transitions.get((INVALID, FILL_PEER)) in self.forwarders
+
+    def next(self, state, event):
+        return self.transitions.get((state, event), state)
+
+
+def _table(fills, extra=()):
+    valid = (SHARED, EXCLUSIVE, MODIFIED, OWNED, FORWARD)
+    transitions = {(INVALID, FILL_HOME): fills, (INVALID, FILL_PEER): fills, (INVALID, FILL_EXCLUSIVE): EXCLUSIVE,
+                   (EXCLUSIVE, PEER_FETCH): SHARED}
+    for state in valid:
+        transitions[(state, WRITE)] = MODIFIED
+        transitions[(state, EVICT)] = INVALID
+        transitions[(state, PEER_WRITE)] = INVALID
+        transitions[(state, PEER_UPDATE)] = SHARED
+    transitions[(INVALID, PEER_UPDATE)] = SHARED
+    transitions[(INVALID, WRITE)] = MODIFIED  # write-allocate fill that was invalidated in flight
+    transitions.update(extra)
+    return transitions
+
+
+MESI = Protocol("MESI", _table(SHARED))
+
+# Owned: a modified line keeps serving peers after they read it
+MOESI = Protocol("MOESI", _table(SHARED, {
+    (MODIFIED, PEER_FETCH): OWNED,
+}), forwarders=(MODIFIED, OWNED, EXCLUSIVE))
+
+# Forward: the most recent reader is the one sharer that serves peers
+MESIF = Protocol("MESIF", _table(FORWARD, {
+    (FORWARD, PEER_FETCH): SHARED,
+    (MODIFIED, PEER_FETCH): SHARED,
+}), forwarders=(MODIFIED, EXCLUSIVE, FORWARD))
+
+PROTOCOLS = {protocol.name: protocol for protocol in (MESI, MOESI, MESIF)}
+
+
+def layer_of(host_name):
+    if host_name == "home":
+        return HOME_LAYER
+    return int(host_name.split('_')[0][1:])
+
+
+def hops(a, b):
+    # links between two nodes of DynamicTopology's switch chain
+    la, lb = layer_of(a), layer_of(b)
+    if la == HOME_LAYER or lb == HOME_LAYER:
+        return 2 + max(la, lb)
+    return 2 + abs(la - lb)
+
+
+def node_address(host_name):
+    # (IP, local Redis db) of a node, logical nodes live in their host's databases
+    switch, host = host_name.split('_')
+    index, logical = divmod(int(host[1:]), LOGICAL_STRIDE)
+    return f"10.0.{switch[1:]}.{logical + 1}", index
+
+
+def aggregator_for(host_name, group):
+    # hierarchical topology: every `group` layers share the aggregator on their top switch
+    layer = layer_of(host_name)
+    return f"s{layer - layer % group}_n{AGGREGATOR_INDEX}"
+
+
+def shard_names(layers):
+    # home plus one shard per entry of layers, the switch layer it hangs off
+    return ["home"] + [f"s{layer}_n{SHARD_INDEX + k}" for k, layer in enumerate(layers, 1)]
@@ -0,0 +1,35 @@
+# Link impairment scenarios for network.run_scenarios. A scenario is a dict
+# of bandwidth [Mbit/s, None for unlimited], loss [%] and delay [ms, one way
+# per interface]; grids are the cross product of the declared values. Each
+# is applied as one root netem qdisc per interface, replaced rather than
+# added, so applying a scenario twice or over another one never stacks them.
+
+
+def scenario_grid(bandwidths=(None,), losses=(0,), delays=(0,)):
+    return [{"bandwidth": bandwidth, "loss": loss, "delay": delay}
+            for bandwidth in bandwidths for loss in losses for delay in delays]
+
+
+def scenario_tag(scenario):
+    # directory and plot label, e.g. bw10_loss1_delay5ms
+    bandwidth = "inf" if scenario.get("bandwidth") is None else f"{scenario['bandwidth']:g}"
+    return f"bw{bandwidth}_loss{scenario.get('loss', 0):g}_delay{scenario.get('delay', 0):g}ms"
+
+
+def netem_args(scenario):
+    # arguments of tc's netem, None when the links are left unimpaired
+    args = []
+    if scenario.get("delay"):
+        args.append(f"delay {scenario['delay']:g}ms")
+    if scenario.get("loss"):
+        args.append(f"loss {scenario['loss']:g}%")
+    if scenario.get("bandwidth") is not None:
+        args.append(f"rate {scenario['bandwidth']:g}mbit")
+    return " ".join(args) or None
+
+
+def impairment_command(interface, scenario):
+    args = netem_args(scenario)
+    if args is None:
+        return f"tc qdisc del dev {interface} root 2>/dev/null || true"  # back to the default qdisc
+    return f"tc qdisc replace dev {interface} root netem {args}"
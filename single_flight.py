@@ -0,0 +1,64 @@
+import asyncio
+
+
+# Concurrent calls for the same key share one execution: the first caller
+# runs fn, later callers wait for its result instead of repeating the work.
+class SingleFlight:
+    def __init__(self):
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        self.calls += 1
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # shield: a cancelled waiter must not cancel the shared call
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+    async def do_many(self, keys, fn):
+        # batched do(): fn(keys nobody is running yet) returns their results in
+        # order, keys already in flight wait for those calls instead
+        unique = list(dict.fromkeys(keys))
+        self.calls += len(unique)
+        shared = {key: self.in_flight[key] for key in unique if key in self.in_flight}
+        self.coalesced += len(shared)
+        own = [key for key in unique if key not in shared]
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in own]
+        self.in_flight.update(zip(own, futures))
+        try:
+            results = await fn(own) if own else []
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+                future.exception()
+            raise
+        else:
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        finally:
+            for key in own:
+                del self.in_flight[key]
+        values = dict(zip(own, results))
+        for key, future in shared.items():
+            values[key] = await asyncio.shield(future)
+        return [values[key] for key in keys]
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced, "executed": self.calls - self.coalesced}
@@ -0,0 +1,77 @@
+import glob
+import json
+import os
+from aggregate import load_json, write_json, cell_path
+
+# Persisted plan of a network.run sweep and per-cell completion markers, so
+# an interrupted sweep resumes at its first unfinished cell. The plan lists
+# every (layers_traversed, read_probability) cell with a fixed cell number and
+# the settings it was started with; a cell is finished once DONE_FILE exists
+# in its directory. Cells always run in layer order, because removing a
+# layer's switch can not be undone in the running network.
+PLAN_FILE = "plan.json"
+DONE_FILE = ".done"
+
+
+def make_plan(num_switch_layers, read_probabilities, settings):
+    cells = []
+    for layers_traversed in range(1, num_switch_layers + 1):
+        for read_probability in read_probabilities:
+            cells.append({"cell": len(cells) + 1, "layers_traversed": layers_traversed,
+                          "read_probability": read_probability})
+    return {"settings": settings, "cells": cells}
+
+
+def load_plan(output_dir, num_switch_layers, read_probabilities, settings):
+    # the plan of an earlier start in output_dir, or a new one; an earlier
+    # plan must have the same settings and cells, or its cell numbers and
+    # done markers would not match this sweep
+    path = os.path.join(output_dir, PLAN_FILE)
+    plan = load_json(path)
+    fresh = json.loads(json.dumps(make_plan(num_switch_layers, read_probabilities, settings)))
+    if plan is None:
+        plan = fresh
+        os.makedirs(output_dir, exist_ok=True)
+        write_json(path, plan)
+    elif plan["settings"] != fresh["settings"]:
+        raise ValueError(f"{output_dir} holds a sweep with other settings: {plan['settings']}")
+    elif plan["cells"] != fresh["cells"]:
+        raise ValueError(f"{output_dir} holds a sweep with other cells: {plan['cells']}")
+    return plan
+
+
+def is_done(output_dir, cell):
+    return os.path.exists(os.path.join(cell_path(output_dir, cell), DONE_FILE))
+
+
+def mark_done(output_dir, cell, result):
+    write_json(os.path.join(cell_path(output_dir, cell), DONE_FILE), result)
+
+
+def done_result(output_dir, cell):
+    return load_json(os.path.join(cell_path(output_dir, cell), DONE_FILE))
+
+
+def selected(cell, only):
+    # only: cell numbers and/or (layers_traversed, read_probability) pairs, None for all
+    if only is None:
+        return True
+    return any(cell["cell"] == choice if isinstance(choice, int)
+               else (cell["layers_traversed"], cell["read_probability"]) == tuple(choice) for choice in only)
+
+
+def pending_cells(plan, output_dir, only=None):
+    cells = [cell for cell in plan["cells"] if selected(cell, only) and not is_done(output_dir, cell)]
+    return sorted(cells, key=lambda cell: cell["layers_traversed"])
+
+
+def done_cells(plan, output_dir):
+    # finished cells in plan order, each with the result its marker recorded
+    return [dict(cell, **done_result(output_dir, cell)) for cell in plan["cells"] if is_done(output_dir, cell)]
+
+
+def reset_cell(output_dir, cell):
+    # drop what an interrupted attempt wrote, ops.bin is appended to
+    for path in glob.glob(os.path.join(cell_path(output_dir, cell), "*")):
+        if os.path.isfile(path):
+            os.remove(path)
@@ -1,13 +1,18 @@
 from mininet.topo import Topo
+from protocols import AGGREGATOR_INDEX, node_address, shard_names
 
 class DynamicTopology(Topo):
-    def __init__(self):
+    def __init__(self, aggregation=None, home_shards=()):
         super().__init__()
         self.num_switch_layers = 20 # Number of switches
         self.hosts_per_switch = 10 # Number of hosts per switch
         self.all_hosts = self.num_switch_layers * self.hosts_per_switch
         self.server_ip = "10.0.0.254" # home server IP
         self.all_switches = []  # store all switches across layers
+        self.aggregation = aggregation  # layers per aggregator cache, None for the flat chain
+        self.aggregators = []  # aggregator host names, top switch of each group
+        self.home_shards = list(home_shards)  # switch layers of the extra home shards
+        self.shards = shard_names(self.home_shards)[1:]  # their host names
 
     def create_network(self):
         # Create home node
@@ -29,6 +34,19 @@ class DynamicTopology(Topo):
                 host = self.addHost(f"s{layer}_n{i}", ip=f"10.0.{layer}.{i+1}")
                 self.addLink(host, switch)
 
+            # Aggregator cache serving this and the next aggregation - 1 layers
+            if self.aggregation and layer % self.aggregation == 0:
+                name = f"s{layer}_n{AGGREGATOR_INDEX}"
+                aggregator = self.addHost(name, ip=f"10.0.{layer}.{AGGREGATOR_INDEX+1}")
+                self.addLink(aggregator, switch)
+                self.aggregators.append(name)
+
+            # Extra home shards hanging off this switch
+            for name, shard_layer in zip(self.shards, self.home_shards):
+                if shard_layer == layer:
+                    shard = self.addHost(name, ip=node_address(name)[0])
+                    self.addLink(shard, switch)
+
             # Connect switch from the previous layer
             if prev_switch:
                 self.addLink(prev_switch, switch)
@@ -0,0 +1,121 @@
+import numpy as np
+from ids import KEY_PREFIX
+from coherence_protocol import MAX_VALUE
+
+# Per-node op streams. Keys, read/write choices and value sizes are drawn
+# CHUNK at a time with NumPy and handed out from plain lists, so an op costs
+# a list index instead of several random calls. Keys are data_1..data_<keyspace>:
+#   uniform: every key equally likely
+#   zipf:    rank r drawn with weight 1/r^zipf_s over the finite keyspace
+#   hotspot: hot_probability of the ops go to hot_fraction of the keys
+#   scan:    each node walks the keyspace in order from its own random start
+# zipf and hotspot map ranks to keys with one shuffle that every node shares,
+# so all of them agree on which keys are hot. Values are slices of one random
+# pool: fixed value_size, uniform around it, or lognormal with that mean,
+# never longer than a coherence message can carry (MAX_VALUE).
+PATTERNS = ("uniform", "zipf", "hotspot", "scan")
+VALUE_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+ALPHABET = np.frombuffer(b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", dtype=np.uint8)
+CHUNK = 4096
+LAYOUT_SEED = 0
+LOGNORMAL_SIGMA = 1.0
+
+
+class Workload:
+    def __init__(self, pattern="uniform", keyspace=10, read_probability=0.8, zipf_s=0.99, hot_fraction=0.2,
+                 hot_probability=0.8, value_size=10, value_distribution="fixed", max_value_size=None, seed=None,
+                 chunk=CHUNK):
+        if pattern not in PATTERNS:
+            raise ValueError(f"unknown workload pattern {pattern!r}, expected one of {PATTERNS}")
+        if value_distribution not in VALUE_DISTRIBUTIONS:
+            raise ValueError(f"unknown value distribution {value_distribution!r}, expected one of {VALUE_DISTRIBUTIONS}")
+        self.pattern = pattern
+        self.keyspace = keyspace
+        self.read_probability = read_probability
+        self.value_size = value_size
+        self.value_distribution = value_distribution
+        if value_size > MAX_VALUE or (max_value_size or 0) > MAX_VALUE:
+            raise ValueError(f"values are limited to {MAX_VALUE} bytes by the coherence message format")
+        self.max_value_size = max_value_size or (value_size if value_distribution == "fixed" else min(64 * value_size, MAX_VALUE))
+        self.chunk = chunk
+        self.rng = np.random.default_rng(seed)
+        if pattern in ("zipf", "hotspot"):
+            self.layout = np.random.default_rng(LAYOUT_SEED).permutation(keyspace) + 1  # rank -> key number
+        if pattern == "zipf":
+            self.cdf = np.cumsum(1.0 / np.arange(1, keyspace + 1) ** zipf_s)
+            self.cdf /= self.cdf[-1]
+        self.hot_keys = max(1, int(keyspace * hot_fraction))
+        self.hot_probability = hot_probability
+        self.position = int(self.rng.integers(keyspace))  # scan
+        self.pool = ALPHABET[self.rng.integers(0, ALPHABET.size, self.max_value_size + chunk)].tobytes().decode()
+        self.keys = self.writes = self.op_sizes = self.sizes = self.offsets = []
+        self.next_op = self.next_value = 0
+
+    def _key_numbers(self, n):
+        if self.pattern == "uniform":
+            return self.rng.integers(1, self.keyspace + 1, n)
+        if self.pattern == "zipf":
+            return self.layout[np.minimum(np.searchsorted(self.cdf, self.rng.random(n)), self.keyspace - 1)]
+        if self.pattern == "hotspot":
+            hot = self.rng.random(n) < self.hot_probability
+            if self.hot_keys == self.keyspace:
+                hot[:] = True
+            cold = self.rng.integers(self.hot_keys, max(self.keyspace, self.hot_keys + 1), n)
+            return self.layout[np.where(hot, self.rng.integers(0, self.hot_keys, n), cold)]
+        numbers = (self.position + np.arange(n)) % self.keyspace + 1
+        self.position = (self.position + n) % self.keyspace
+        return numbers
+
+    def _value_sizes(self, n):
+        if self.value_distribution == "fixed":
+            sizes = np.full(n, self.value_size)
+        elif self.value_distribution == "uniform":
+            sizes = self.rng.integers(1, 2 * self.value_size, n, endpoint=True)
+        else:
+            mu = np.log(self.value_size) - LOGNORMAL_SIGMA ** 2 / 2
+            sizes = np.rint(self.rng.lognormal(mu, LOGNORMAL_SIGMA, n))
+        return np.clip(sizes, 1, self.max_value_size).astype(np.int64)
+
+    def _refill_ops(self):
+        self.keys = [f"{KEY_PREFIX}{number}" for number in self._key_numbers(self.chunk).tolist()]
+        self.writes = (self.rng.random(self.chunk) >= self.read_probability).tolist()
+        self.op_sizes = self._value_sizes(self.chunk).tolist()
+        self.next_op = 0
+
+    def _refill_values(self):
+        self.sizes = self._value_sizes(self.chunk).tolist()
+        self.offsets = self.rng.integers(0, len(self.pool) - self.max_value_size, self.chunk).tolist()
+        self.next_value = 0
+
+    def next(self):
+        # (key, True for a write, size of the value it writes)
+        if self.next_op == len(self.keys):
+            self._refill_ops()
+        i = self.next_op
+        self.next_op += 1
+        return self.keys[i], self.writes[i], self.op_sizes[i]
+
+    def value(self, size=None):
+        # of the given size, or one drawn from the value size distribution
+        if self.next_value == len(self.sizes):
+            self._refill_values()
+        i = self.next_value
+        self.next_value += 1
+        return self.pool[self.offsets[i]:self.offsets[i] + (size or self.sizes[i])]
+
+
+def add_arguments(parser):
+    parser.add_argument("--workload", choices=PATTERNS, default="uniform", help="key access pattern")
+    parser.add_argument("--keyspace", type=int, default=10, help="number of data_<n> keys")
+    parser.add_argument("--zipf-s", type=float, default=0.99, help="zipf skew, rank r has weight 1/r^s")
+    parser.add_argument("--hot-fraction", type=float, default=0.2, help="hotspot: fraction of the keys that are hot")
+    parser.add_argument("--hot-probability", type=float, default=0.8, help="hotspot: fraction of the ops on hot keys")
+    parser.add_argument("--value-size", type=int, default=10, help="value size in bytes, the mean if not fixed")
+    parser.add_argument("--value-distribution", choices=VALUE_DISTRIBUTIONS, default="fixed")
+
+
+def spec_from_args(args):
+    # keyword arguments of Workload, what network.py sends per cell as "workload"
+    return {"pattern": args.workload, "keyspace": args.keyspace, "zipf_s": args.zipf_s,
+            "hot_fraction": args.hot_fraction, "hot_probability": args.hot_probability,
+            "value_size": args.value_size, "value_distribution": args.value_distribution}